@@ -0,0 +1,88 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Reference image of the scene without droplet
+
+# The droplet is segmented from the difference to the reference, so everything that is also in the reference,
+# like the needle, dirt on the optics or the texture of the substrate, does not produce edges.
+# The reference is only valid for the ROI and exposure it was captured with: it is dropped if the image size
+# changes or if the brightness at the left and right image border, where usually no droplet is, drifts away.
+
+import logging
+import cv2
+import numpy as np
+
+BACKGROUND_MIN_DIFF = 15
+""" default for pipeline option `background_min_diff`: min difference in gray values to the reference of a droplet pixel """
+# width in px of the strips at the left and right image border used to detect exposure changes
+BACKGROUND_CHECK_WIDTH = 8
+# max change of the mean gray value of the border strips before the reference is dropped
+BACKGROUND_MAX_DRIFT = 10.0
+
+
+class BackgroundReference:
+    """
+    droplet free reference frame for the current ROI and exposure
+
+    capture it with :meth:`capture`, the `background` edges backend of :mod:`evaluate_droplet` uses it while it is valid
+    """
+    def __init__(self):
+        self.image: np.ndarray = None
+        """ grayscale reference image or None if there is none """
+        self._border_mean = 0.0
+
+    @staticmethod
+    def _border(img) -> float:
+        """ mean gray value of the strips at the left and right border """
+        w = min(BACKGROUND_CHECK_WIDTH, img.shape[1])
+        return (cv2.mean(img[:, :w])[0] + cv2.mean(img[:, -w:])[0])/2
+
+    def capture(self, img):
+        """
+        store a frame without droplet as reference
+
+        :param img: camera image
+        """
+        if img.ndim == 3:
+            img = img[:,:,0]
+        self.image = np.ascontiguousarray(img).copy()
+        self._border_mean = self._border(self.image)
+        logging.info(f'background: captured reference {self.image.shape}')
+
+    def clear(self):
+        """ drop the reference, eg. after ROI or exposure change """
+        if self.image is not None:
+            logging.info('background: reference dropped')
+        self.image = None
+
+    def check(self, img) -> bool:
+        """
+        check that the reference fits the image and drop it otherwise
+
+        :param img: camera image
+        :returns: True if the reference can be used for the image
+        """
+        if self.image is None:
+            return False
+        if img.ndim == 3:
+            img = img[:,:,0]
+        if img.shape != self.image.shape:
+            logging.warning('background: image size changed')
+            self.clear()
+        elif abs(self._border(img) - self._border_mean) > BACKGROUND_MAX_DRIFT:
+            logging.warning('background: brightness changed, exposure or illumination differs from reference')
+            self.clear()
+        return self.image is not None
@@ -0,0 +1,314 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Automatic detection of the substrate line
+
+# The image is divided into vertical bands, in each band the rows are averaged to an intensity profile
+# and the strongest drop of the intensity from the bright background to the dark substrate below is taken as edge candidate.
+# A line is fitted through the candidates with a consensus search over all pairs, so bands covered by the needle do not
+# disturb the result. Bands in which the droplet or needle is found above the edge are left out, the lower edge of a highlight
+# inside the droplet is an edge of the same direction and can outnumber the few substrate bands beside it.
+
+from math import atan, ceil, cos, floor, inf, isinf, sin, tan
+from typing import Tuple
+import cv2
+import numpy as np
+
+# number of column bands the substrate edge is searched in
+BASELINE_BANDS = 32
+# half height in px of the search range around the hint for the first detection
+BASELINE_DETECT_RANGE = 100
+# half height in px of the search range around the last line when refining
+BASELINE_SEARCH_RANGE = 6
+# max distance in px of an edge candidate from the line to count as part of it
+BASELINE_MAX_RESIDUAL = 1.5
+# min number of bands that have to agree on the line
+BASELINE_MIN_BANDS = 4
+# candidates weaker than this fraction of the strongest one are ignored
+BASELINE_MIN_STRENGTH = 0.2
+# distance in px from the edge of the rows whose intensity is taken as the one above and below the edge
+BASELINE_EDGE_HEIGHT = 3
+# the line found when refining only replaces the last one if its support is higher by this factor
+BASELINE_SWITCH_RATIO = 1.5
+BASELINE_CROP_MARGIN = 2
+""" rows directly above a detected baseline that are excluded from the droplet edge search, so the substrate edge is not taken as part of the droplet """
+BASELINE_LEVEL_MIN_OFFSET = 1.5
+""" min height difference in px of a tilted baseline between the image center and border for the image to be leveled,
+leveling interpolates the image and can break up the droplet outline, below it the baseline is taken as horizontal """
+
+
+def find_band_edges(img, y_lo, y_hi, bands=BASELINE_BANDS) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    find the strongest horizontal edge from a bright region above to a darker one below in each column band
+    with sub-pixel precision
+
+    :param img: grayscale image
+    :param y_lo: array of the first row to search per band
+    :param y_hi: array of the last row to search per band
+    :param bands: number of bands
+    :returns: tuple of arrays (x, y, strength) with the band centers, edge rows and intensity changes
+    """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    height, width = img.shape
+    band_width = width // bands
+    top = max(int(floor(np.min(y_lo))) - 1, 0)
+    bottom = min(int(ceil(np.max(y_hi))) + 2, height)
+    if bottom - top < 3:
+        raise ValueError('Baseline search range outside of image')
+    strip = img[top:bottom, :band_width*bands]
+    profiles = strip.reshape(bottom - top, bands, band_width).mean(axis=2)
+    # central differences of the decrease downwards, entry i belongs to row top + i + 1
+    grad = profiles[:-2] - profiles[2:]
+    rows = np.arange(top + 1, bottom - 1)
+    in_range = (rows[:,None] >= np.asarray(y_lo)[None,:]) & (rows[:,None] <= np.asarray(y_hi)[None,:])
+    idx = np.argmax(np.where(in_range, grad, -1.0), axis=0)
+    cols = np.arange(bands)
+    strength = grad[idx, cols]
+    # parabola through the maximum and its neighbours
+    g_0 = grad[np.maximum(idx - 1, 0), cols]
+    g_2 = grad[np.minimum(idx + 1, len(grad) - 1), cols]
+    denom = g_0 - 2*strength + g_2
+    offset = np.divide(0.5*(g_0 - g_2), denom, out=np.zeros_like(denom), where=denom < 0)
+    np.clip(offset, -0.5, 0.5, out=offset)
+    x = (cols + 0.5)*band_width
+    return x, rows[idx] + offset, strength
+
+def fit_line_consensus(x, y, weights, max_residual=BASELINE_MAX_RESIDUAL, min_points=BASELINE_MIN_BANDS):
+    """
+    fit a line through the points that agree with each other the most
+
+    every line through two of the points is tested, the one with the highest summed weight of points closer than
+    max_residual wins and is refined with a weighted least squares fit through these points
+
+    :param x: array of x coordinates
+    :param y: array of y coordinates
+    :param weights: array of point weights
+    :param max_residual: max distance of a point to the line to support it
+    :param min_points: min number of supporting points
+    :returns: tuple of (slope, intercept) or None if no line has enough support
+    """
+    i, j = np.triu_indices(len(x), 1)
+    slopes = (y[j] - y[i]) / (x[j] - x[i])
+    intercepts = y[i] - slopes*x[i]
+    support = np.abs(y[None,:] - (slopes[:,None]*x[None,:] + intercepts[:,None])) <= max_residual
+    best = np.argmax(support @ weights)
+    inliers = support[best]
+    if np.count_nonzero(inliers) < min_points:
+        return None
+    return fit_line_weighted(x[inliers], y[inliers], weights[inliers])
+
+def fit_line_weighted(x, y, weights) -> Tuple[float,float]:
+    """
+    weighted least squares fit of a line
+
+    :param x: array of x coordinates
+    :param y: array of y coordinates
+    :param weights: array of point weights
+    :returns: tuple of (slope, intercept)
+    """
+    sqrt_w = np.sqrt(weights)
+    design = np.column_stack((x, np.ones(len(x))))*sqrt_w[:,None]
+    slope, intercept = np.linalg.lstsq(design, y*sqrt_w, rcond=None)[0]
+    return slope, intercept
+
+
+def find_clear_bands(img, y, bands=BASELINE_BANDS) -> np.ndarray:
+    """
+    find the column bands without droplet or needle above the edge
+
+    a band is clear if its intensity from the top of the image down to the edge does not fall below the middle between
+    the intensities above and below the edge
+
+    :param img: grayscale image
+    :param y: array of the edge rows per band, see :func:`find_band_edges`
+    :param bands: number of bands
+    :returns: bool array, True for the clear bands
+    """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    height, width = img.shape
+    band_width = width // bands
+    above = np.clip(np.round(y).astype(np.intp) - BASELINE_EDGE_HEIGHT, 0, height - 1)
+    below = np.clip(above + 2*BASELINE_EDGE_HEIGHT, 0, height - 1)
+    bottom = below.max() + 1
+    profiles = cv2.resize(img[:bottom, :band_width*bands], (bands, bottom), interpolation=cv2.INTER_AREA).astype(np.float64)
+    cols = np.arange(bands)
+    middle = (profiles[above, cols] + profiles[below, cols])/2
+    darkest = np.where(np.arange(bottom)[:,None] <= above[None,:], profiles, np.inf).min(axis=0)
+    return darkest > middle
+
+
+class BaselineDetector:
+    """
+    detects the substrate line including its tilt and follows it from frame to frame
+
+    the first detection searches a wide range around a hint, afterwards only a narrow band around the last line is searched;
+    the line is described by its y coordinate in the horizontal center of the image and its tilt
+
+    :param bands: number of column bands
+    :param detect_range: half height in px of the search range of the first detection
+    :param search_range: half height in px of the search range when refining
+    """
+    def __init__(self, bands=BASELINE_BANDS, detect_range=BASELINE_DETECT_RANGE, search_range=BASELINE_SEARCH_RANGE):
+        self.bands = bands
+        self.detect_range = detect_range
+        self.search_range = search_range
+        self.line: Tuple[float,float] = None
+        """ last detected line as (y_base, tilt), tilt in rad, positive if the line descends to the right """
+
+    def reset(self):
+        """ forget the last line, next call of :meth:`update` does a full detection """
+        self.line = None
+
+    def detect(self, img, y_hint=None) -> Tuple[float,float]:
+        """
+        search the substrate line in a wide range
+
+        :param img: grayscale image
+        :param y_hint: expected y coordinate of the line, eg. from the manually placed baseline; None to search the full image
+        :returns: tuple of (y_base, tilt) or None if no line was found
+        """
+        height = img.shape[0]
+        if y_hint is None:
+            y_lo, y_hi = 0, height - 1
+        else:
+            y_lo, y_hi = y_hint - self.detect_range, y_hint + self.detect_range
+        bands = np.ones(self.bands)
+        candidates = self._candidates(img, y_lo*bands, y_hi*bands)
+        if candidates is None:
+            return None
+        return self._line(img, fit_line_consensus(*candidates))
+
+    def refine(self, img) -> Tuple[float,float]:
+        """
+        search the substrate line close to the last detected one
+
+        the line is fitted again through the edge candidates close to the last line, unless a line through other candidates
+        is supported :data:`BASELINE_SWITCH_RATIO` times as strong, so two similar edges do not take turns from frame to frame
+
+        :param img: grayscale image
+        :returns: tuple of (y_base, tilt) or None if the line was not found in the search range
+        """
+        y_base, tilt = self.line
+        width = img.shape[1]
+        band_width = width // self.bands
+        x = (np.arange(self.bands) + 0.5)*band_width
+        y_pred = y_base + (x - width/2)*tan(tilt)
+        candidates = self._candidates(img, y_pred - self.search_range, y_pred + self.search_range)
+        if candidates is None:
+            return None
+        x, y, strength = candidates
+        result = fit_line_consensus(x, y, strength)
+        last = np.abs(y - (y_base + (x - width/2)*tan(tilt))) <= BASELINE_MAX_RESIDUAL
+        if np.count_nonzero(last) >= BASELINE_MIN_BANDS:
+            best = np.abs(y - (result[0]*x + result[1])) <= BASELINE_MAX_RESIDUAL if result is not None else last
+            if strength[best].sum() < BASELINE_SWITCH_RATIO*strength[last].sum():
+                result = fit_line_weighted(x[last], y[last], strength[last])
+        return self._line(img, result)
+
+    def update(self, img, y_hint=None) -> Tuple[float,float]:
+        """
+        refine the last line or detect it if there is none or it got lost
+
+        :param img: grayscale image
+        :param y_hint: expected y coordinate of the line for a full detection
+        :returns: tuple of (y_base, tilt) or None if no line was found
+        """
+        line = self.refine(img) if self.line is not None else None
+        if line is None:
+            line = self.detect(img, y_hint)
+        self.line = line
+        return line
+
+    def _candidates(self, img, y_lo, y_hi) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        """ edge candidates (x, y, strength) of the strong bands within the row limits, without the covered ones if enough are clear """
+        try:
+            x, y, strength = find_band_edges(img, y_lo, y_hi, self.bands)
+        except ValueError:
+            return None
+        strong = strength >= BASELINE_MIN_STRENGTH*strength.max()
+        if np.count_nonzero(strong) < BASELINE_MIN_BANDS or strength.max() <= 0:
+            return None
+        clear = strong & find_clear_bands(img, y, self.bands)
+        if np.count_nonzero(clear) >= BASELINE_MIN_BANDS:
+            strong = clear
+        return x[strong], y[strong], strength[strong]
+
+    def _line(self, img, result) -> Tuple[float,float]:
+        """ convert a fitted (slope, intercept) to (y_base, tilt) """
+        if result is None:
+            return None
+        slope, intercept = result
+        return intercept + slope*img.shape[1]/2, atan(slope)
+
+
+def level_matrix(pivot, tilt, origin=(0,0)) -> np.ndarray:
+    """
+    affine transformation from the leveled frame, in which the baseline is horizontal, to image coordinates
+
+    :param pivot: (x,y) point on the baseline the image is rotated around
+    :param tilt: tilt of the baseline in rad
+    :param origin: leveled coordinates of the first pixel of the target region
+    :returns: 2x3 matrix for cv2.warpAffine with cv2.WARP_INVERSE_MAP
+    """
+    c, s = cos(tilt), sin(tilt)
+    rot = np.array(((c, -s), (s, c)))
+    trans = rot @ (np.asarray(origin, dtype=np.float64) - pivot) + pivot
+    return np.column_stack((rot, trans))
+
+def unlevel_points(points, pivot, tilt) -> np.ndarray:
+    """
+    transform points from the leveled frame back to image coordinates
+
+    :param points: N x 2 array of (x,y) points in the leveled frame
+    :param pivot: (x,y) point on the baseline the image is rotated around
+    :param tilt: tilt of the baseline in rad
+    :returns: N x 2 array of points in image coordinates
+    """
+    matrix = level_matrix(pivot, tilt)
+    return np.asarray(points, dtype=np.float64) @ matrix[:,:2].T + matrix[:,2]
+
+def level_rect(rect, pivot, tilt) -> Tuple[int,int,int,int]:
+    """
+    transform a rectangle from image coordinates into the leveled frame
+
+    :param rect: rectangle as (x,y,w,h) in image coordinates
+    :param pivot: (x,y) point on the baseline the image is rotated around
+    :param tilt: tilt of the baseline in rad
+    :returns: bounding rect of the transformed rectangle as (x,y,w,h)
+    """
+    x, y, w, h = rect
+    corners = np.array(((x, y), (x + w, y), (x, y + h), (x + w, y + h)), dtype=np.float64)
+    # inverse rotation: leveled = R^T (image - pivot) + pivot
+    leveled = unlevel_points(corners, pivot, -tilt)
+    x1, y1 = np.floor(leveled.min(axis=0)).astype(int)
+    x2, y2 = np.ceil(leveled.max(axis=0)).astype(int)
+    return int(x1), int(y1), int(x2 - x1), int(y2 - y1)
+
+def unlevel_slope(slope, tilt) -> float:
+    """
+    transform the slope dy/dx of a line from the leveled frame to image coordinates
+
+    :param slope: slope in the leveled frame
+    :param tilt: tilt of the baseline in rad
+    """
+    c, s = cos(tilt), sin(tilt)
+    if isinf(slope):
+        dx, dy = -s, c
+    else:
+        dx, dy = c - slope*s, s + slope*c
+    return dy/dx if dx != 0 else inf
@@ -122,6 +122,13 @@ class CameraControl(QGroupBox):
         self.ui.actionKalibrate_Size.triggered.connect(self.calib_size)
         self.ui.actionDelete_Size_Calibration.triggered.connect(self.remove_size_calib)
         self.ui.actionSave_Image.triggered.connect(self.save_image_dialog)
+        self.ui.actionAuto_Baseline.toggled.connect(self.ui.camera_prev.set_auto_baseline)
+        self.ui.actionAuto_Needle_Mask.toggled.connect(self.ui.camera_prev.set_auto_needle)
+        self.ui.actionMulti_Droplet.toggled.connect(self.ui.camera_prev.set_multi_droplet)
+        self.ui.actionKalman_Process_Noise.triggered.connect(self.set_process_noise)
+        self.ui.actionCapture_Background.triggered.connect(self.ui.camera_prev.capture_background)
+        self.ui.actionClear_Background.triggered.connect(self.ui.camera_prev.clear_background)
+        self.ui.actionTune_Edge_Detection.triggered.connect(self.ui.camera_prev.tune_canny)
 
     def is_streaming(self) -> bool:
         """ 
@@ -304,6 +311,15 @@ class CameraControl(QGroupBox):
         drplt = Droplet()
         drplt.set_scale(None)
 
+    @Slot()
+    def set_process_noise(self):
+        """ ask for the process noise of the kalman filter mode, larger values follow changes faster """
+        drplt = Droplet()
+        res,ok = QInputDialog.getDouble(self,"Kalman process noise", "Please enter the process noise (larger follows changes faster, smaller smoothes more):", drplt.process_noise, 0.001, 1e6, 3)
+        if not ok:
+            return
+        drplt.set_process_noise(res)
+
     @Slot()
     def save_image_dialog(self):
         raw_image = False
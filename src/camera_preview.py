@@ -14,6 +14,7 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
 from typing import List, Tuple, Union
 import cv2
 import numpy as np
@@ -21,13 +22,16 @@ import logging
 
 from PySide2 import QtGui
 from PySide2.QtWidgets import QLabel, QOpenGLWidget
-from PySide2.QtCore import  Qt, QPoint, QRect, QSize, Slot
+from PySide2.QtCore import  Qt, QPoint, QPointF, QRect, QSize, Slot
 from PySide2.QtGui import QBrush, QImage, QPaintEvent, QPainter, QPen, QPixmap, QTransform
 from needle_mask import DynamicNeedleMask
 
 from resizable_rubberband import ResizableRubberBand
 from baseline import Baseline
-from evaluate_droplet import evaluate_droplet, ContourError
+from evaluate_droplet import evaluate_droplet_result, evaluate_droplets_result, ContourError, EVAL_ERRORS, EvaluationPipeline
+from profile_library import ProfileLibrary, load_library
+from qthread_worker import CallbackWorker
+from canny_tuning import DEFAULT_PROFILE, TUNE_FRAMES, apply_profile, load_profile, profile_key, store_profile, tune_canny, tuning_template
 from droplet import Droplet
 
 class CameraPreview(QOpenGLWidget):
@@ -47,9 +51,30 @@ class CameraPreview(QOpenGLWidget):
         self._needle_mask.update_mask_signal.connect(self.update_mask)
         self._baseline = Baseline(self)
         self._droplet = Droplet()
+        self._pipeline = EvaluationPipeline(preprocess='pyramid')
+        # building the profile library takes a while on first start, young_laplace integrates the profiles until it is ready
+        self._library: ProfileLibrary = None
+        self._library_worker = CallbackWorker(self._load_library, slotOnFinished=self._library_loaded)
+        self._library_worker.start()
         self._mask = None
+        self._tune_frames: List[np.ndarray] = None
+        self._tune_worker: CallbackWorker = None
+        self._tune_result: Tuple[str, Tuple[float,float,int]] = None
         logging.debug("initialized camera preview")
 
+    def _load_library(self):
+        """ load or build the profile library, runs in :attr:`_library_worker` """
+        try:
+            self._library = load_library()
+        except Exception as ex:
+            logging.exception("Exception thrown in %s", "class:camera_preview fcn:_load_library", exc_info=ex)
+
+    @Slot()
+    def _library_loaded(self):
+        """ use the profile library for the young laplace fits once the worker is done """
+        if self._library is not None:
+            self._pipeline.configure(yl_library=self._library)
+
     def prepare(self):
         """ preset the baseline to 250 which is roughly base of the test image droplet """
         self._baseline.y_level = self.mapFromImage(y=250)
@@ -86,6 +111,11 @@ class CameraPreview(QOpenGLWidget):
         pen = QPen(Qt.magenta,1)
         pen_fine = QPen(Qt.blue,1)
         pen.setCosmetic(True)
+        # draw automatically detected needle mask if the manual one is not used
+        if self._mask is None and self._pipeline.needle is not None and self._pipeline.needle.rect is not None:
+            db_painter.setPen(pen_fine)
+            x, y, w, h = self._pipeline.needle.rect
+            db_painter.drawRect(*self.mapFromImage(x, y), *self.mapFromImage(w=w, h=h))
         db_painter.setPen(pen)
         # draw droplet outline and tangent only if evaluate_droplet was successful
         if self._droplet.is_valid:
@@ -93,39 +123,53 @@ class CameraPreview(QOpenGLWidget):
                 # transforming true image coordinates to scaled pixmap coordinates
                 db_painter.translate(offset_x, offset_y)
                 db_painter.scale(scale_x, scale_y)
-
-                # drawing tangents and baseline
-                db_painter.drawLine(*self._droplet.line_l)
-                db_painter.drawLine(*self._droplet.line_r)
-                db_painter.drawLine(*self._droplet.int_l, *self._droplet.int_r)
-
-                # move origin to ellipse origin
-                db_painter.translate(*self._droplet.center)
-
-                # draw diagnostics
-                # db_painter.setPen(pen_fine)
-                # #  lines parallel to coordinate axes
-                # db_painter.drawLine(0,0,20*scale_x,0)
-                # db_painter.drawLine(0,0,0,20*scale_y)
-                # # angle arc
-                # db_painter.drawArc(-5*scale_x, -5*scale_y, 10*scale_x, 10*scale_y, 0, -self._droplet.tilt_deg*16)
-
-                # rotate coordinates to ellipse tilt
-                db_painter.rotate(self._droplet.tilt_deg)
-
-                # draw ellipse
-                # db_painter.setPen(pen)
-                db_painter.drawEllipse(-self._droplet.maj/2, -self._droplet.min/2, self._droplet.maj, self._droplet.min)
-                
-                # # major and minor axis for diagnostics
-                # db_painter.drawLine(0, 0, self._droplet.maj/2, 0)
-                # db_painter.drawLine(0, 0, 0, self._droplet.min/2)
+                # all droplets in multi droplet mode, the filtered one otherwise
+                for drop_id, drop in (self._droplet.droplets.items() if self._droplet.droplets else ((None, self._droplet),)):
+                    db_painter.save()
+                    self._draw_droplet(db_painter, drop, drop_id)
+                    db_painter.restore()
             except Exception as ex:
                 logging.error(ex)
         db_painter.end()
         self.blockSignals(False)
         return buffer
 
+    def _draw_droplet(self, db_painter: QPainter, drop, drop_id=None):
+        """
+        draw tangents, baseline and ellipse of a droplet, the painter has to be transformed to image coordinates
+
+        :param drop: :class:`droplet.Droplet` or :class:`evaluate_droplet.DropletResult`
+        :param drop_id: ID drawn below the droplet in multi droplet mode or None
+        """
+        # drawing tangents and baseline
+        db_painter.drawLine(*drop.line_l)
+        db_painter.drawLine(*drop.line_r)
+        db_painter.drawLine(*drop.int_l, *drop.int_r)
+        if drop_id is not None:
+            db_painter.drawText(QPointF((drop.int_l[0] + drop.int_r[0])/2, drop.int_l[1] + 15), str(drop_id))
+
+        # move origin to ellipse origin
+        db_painter.translate(*drop.center)
+
+        # draw diagnostics
+        # db_painter.setPen(pen_fine)
+        # #  lines parallel to coordinate axes
+        # db_painter.drawLine(0,0,20*scale_x,0)
+        # db_painter.drawLine(0,0,0,20*scale_y)
+        # # angle arc
+        # db_painter.drawArc(-5*scale_x, -5*scale_y, 10*scale_x, 10*scale_y, 0, -drop.tilt_deg*16)
+
+        # rotate coordinates to ellipse tilt
+        db_painter.rotate(drop.tilt_deg)
+
+        # draw ellipse
+        # db_painter.setPen(pen)
+        db_painter.drawEllipse(-drop.maj/2, -drop.min/2, drop.maj, drop.min)
+        
+        # # major and minor axis for diagnostics
+        # db_painter.drawLine(0, 0, drop.maj/2, 0)
+        # db_painter.drawLine(0, 0, 0, drop.min/2)
+
     def mousePressEvent(self,event):
         """
         mouse pressed handler
@@ -174,6 +218,7 @@ class CameraPreview(QOpenGLWidget):
         """
         self._needle_mask.hide()
         self._mask = None
+        self._pipeline.reset()
 
     def show_mask(self):
         """shows the needle mask
@@ -186,6 +231,7 @@ class CameraPreview(QOpenGLWidget):
         """
         mask_rect = self._needle_mask.get_mask_geometry()
         self._mask = self.mapToImage(*mask_rect[:])
+        self._pipeline.reset()
 
     @Slot(np.ndarray, bool)
     def update_image(self, cv_img: np.ndarray, eval: bool = True):
@@ -198,23 +244,38 @@ class CameraPreview(QOpenGLWidget):
         .. seealso:: :py:meth:`camera_control.CameraControl.update_image`
         """
         self._raw_image = cv_img
+        # time of arrival of the frame, evaluation time varies and would disturb the kalman filter
+        frame_time = time.perf_counter()
         try:
+            if self._tune_frames is not None:
+                self._collect_tune_frame(cv_img)
             # evaluate droplet only if camera is running or if a oneshot eval is requested
             if eval:
                 try:
                     self._droplet.is_valid = False
-                    evaluate_droplet(cv_img, self.get_baseline_y(), self._mask)
-                except (ContourError, cv2.error, TypeError):
+                    self._droplet.droplets = {}
+                    if self._pipeline.multi is not None:
+                        self._droplet.update_multi(evaluate_droplets_result(cv_img, self.get_baseline_y(), self._mask, self._pipeline), frame_time)
+                    else:
+                        self._droplet.update(evaluate_droplet_result(cv_img, self.get_baseline_y(), self._mask, self._pipeline), frame_time)
+                except (*EVAL_ERRORS, TypeError):
                     pass
                 except Exception as ex:
                     logging.exception("Exception thrown in %s", "fcn:evaluate_droplet", exc_info=ex)
+                if self._pipeline.baseline is not None and self._pipeline.baseline.line is not None:
+                    # follow the detected substrate line with the selector, it is the hint for a new detection
+                    self._baseline.y_level = self.mapFromImage(y=self._pipeline.baseline.line[0])
             else:
                 self._droplet.is_valid = False
+                self._droplet.droplets = {}
             qt_img = self._convert_cv_qt(cv_img)
             self._pixmap = qt_img
             if self._image_size_invalid:
                 self._image_size = np.shape(cv_img)
                 self.set_new_baseline_constraints()
+                # edge detection profile tuned for this ROI
+                profile = load_profile(profile_key(cv_img))
+                apply_profile(self._pipeline, profile if profile is not None else DEFAULT_PROFILE)
                 self._image_size_invalid = False
             self.update()
             # del cv_img
@@ -357,6 +418,102 @@ class CameraPreview(QOpenGLWidget):
         y = self.mapToImage(y=y_base)
         return y
 
+    @Slot(bool)
+    def set_auto_baseline(self, enabled):
+        """
+        enable or disable the automatic detection of the baseline, the selector is moved to the detected line
+
+        :param enabled: True to detect the baseline in every evaluated frame
+        """
+        self._pipeline.set_auto_baseline(enabled)
+        logging.info(f"automatic baseline {'enabled' if enabled else 'disabled'}")
+
+    @Slot(bool)
+    def set_auto_needle(self, enabled):
+        """
+        enable or disable the automatic needle detection, it is used while the manual needle mask is hidden
+
+        :param enabled: True to detect the needle
+        """
+        self._pipeline.set_auto_needle(enabled)
+        logging.info(f"automatic needle mask {'enabled' if enabled else 'disabled'}")
+
+    @Slot(bool)
+    def set_multi_droplet(self, enabled):
+        """
+        enable or disable the evaluation of all droplets on the baseline, each one gets its own row in the data table
+
+        :param enabled: True to evaluate all droplets
+        """
+        self._pipeline.set_multi_droplet(enabled)
+        self._droplet.droplets = {}
+        logging.info(f"multi droplet mode {'enabled' if enabled else 'disabled'}")
+
+    @Slot()
+    def tune_canny(self):
+        """
+        tune the edge detection on the next frames and store the profile for the current ROI and brightness,
+        see :func:`canny_tuning.tune_canny`
+        """
+        if self._tune_worker is not None and self._tune_worker.isRunning():
+            logging.info("canny tuning: already running")
+            return
+        self._tune_frames = []
+        logging.info(f"canny tuning: collecting {TUNE_FRAMES} frames")
+
+    def _collect_tune_frame(self, cv_img: np.ndarray):
+        """ store a frame for the tuning and start it in :attr:`_tune_worker` once enough frames are collected """
+        self._tune_frames.append(cv_img.copy())
+        if len(self._tune_frames) < TUNE_FRAMES:
+            return
+        frames, self._tune_frames = self._tune_frames, None
+        mask = self._mask
+        if mask is None and self._pipeline.needle is not None:
+            mask = self._pipeline.needle.rect
+        self._tune_result = None
+        # snapshot the pipeline here, it keeps running on this thread while the worker evaluates the candidates
+        template = tuning_template(self._pipeline)
+        self._tune_worker = CallbackWorker(self._run_tuning, frames, self.get_baseline_y(), mask, template, slotOnFinished=self._tuning_finished)
+        self._tune_worker.start()
+
+    def _run_tuning(self, frames, y_base, mask, template):
+        """ evaluate the candidate profiles, runs in :attr:`_tune_worker` while the preview goes on """
+        try:
+            profile, _ = tune_canny(frames, y_base, mask, template)
+            self._tune_result = (profile_key(frames[0]), profile)
+        except ContourError as ex:
+            logging.warning(f"canny tuning: {ex}")
+        except Exception as ex:
+            logging.exception("Exception thrown in %s", "class:camera_preview fcn:_run_tuning", exc_info=ex)
+
+    @Slot()
+    def _tuning_finished(self):
+        """ store the tuned profile and use it if the setup did not change in the meantime """
+        if self._tune_result is None:
+            return
+        key, profile = self._tune_result
+        store_profile(key, profile)
+        if self._raw_image is not None and profile_key(self._raw_image) == key:
+            apply_profile(self._pipeline, profile)
+
+    @Slot()
+    def capture_background(self):
+        """
+        store the current image as droplet free reference and segment the droplet from the difference to it,
+        the reference is dropped on ROI change or if the exposure changes
+        """
+        if self._raw_image is None:
+            return
+        self._pipeline.background.capture(self._raw_image)
+        self._pipeline.set_backend('edges', 'background')
+        self._pipeline.reset()
+
+    @Slot()
+    def clear_background(self):
+        """ drop the background reference, edges are detected on the raw image again """
+        self._pipeline.background.clear()
+        self._pipeline.reset()
+
     def set_new_baseline_constraints(self):
         """ set the min and max y value for the baseline """
         pix_size = self._pixmap.size()
@@ -384,4 +541,7 @@ class CameraPreview(QOpenGLWidget):
         """
         invalidate image size, causes image size to be reevaluated on next camera image
         """
-        self._image_size_invalid = True
\ No newline at end of file
+        self._image_size_invalid = True
+        self._pipeline.reset()
+        self._pipeline.buffers.invalidate()
+        self._pipeline.background.clear()
\ No newline at end of file
@@ -0,0 +1,193 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Automatic tuning of the canny edge detection
+
+# A profile sets how the canny thresholds follow the otsu threshold of the image and how much the image is blurred before.
+# All combinations of the candidate values are run on a few frames and scored by the number of edge contours, the
+# distance of the contour to the fitted ellipse and the runtime. Candidates that fail on a frame or see a different
+# base width than the others are discarded. The best profile is stored per setup, identified by the image size of the
+# ROI and the brightness of the image, as the camera runs with fixed exposure and the brightness follows the illumination.
+
+import copy
+import logging
+import time
+from math import cos, sin, radians, log2
+from typing import List, Optional, Tuple
+import cv2
+import numpy as np
+from PySide2.QtCore import QSettings
+
+from eval_pipeline import EVAL_ERRORS, ContourError, EvaluationPipeline
+from evaluate_droplet import CANNY_BLUR
+from threshold_manager import LOW_THRESH_RATIO
+
+DEFAULT_PROFILE = (1.0, LOW_THRESH_RATIO, CANNY_BLUR)
+""" profile of the untuned edge detection as (high_factor, low_ratio, blur), see :func:`apply_profile` """
+
+TUNE_FRAMES = 5
+""" number of frames the candidates are evaluated on """
+TUNE_HIGH_FACTORS = (0.5, 0.75, 1.0, 1.5)
+""" candidate factors between otsu threshold and high canny threshold """
+TUNE_LOW_RATIOS = (0.3, 0.5, 0.7)
+""" candidate ratios between low and high canny threshold """
+TUNE_BLUR_SIZES = (0, 3, 5)
+""" candidate sizes of the gaussian blur, 0 for none """
+# score per doubling of the number of edge contours
+TUNE_CONTOUR_WEIGHT = 0.25
+# score per ms of evaluation time
+TUNE_RUNTIME_WEIGHT = 0.1
+# max relative deviation of the base width from the median of all candidates
+TUNE_MAX_WIDTH_DEVIATION = 0.05
+# gray values per brightness step of the profile key
+TUNE_BRIGHTNESS_STEP = 32
+
+Profile = Tuple[float, float, int]
+
+
+def apply_profile(pipeline: EvaluationPipeline, profile: Profile):
+    """
+    use a profile for the edge detection of the pipeline
+
+    :param pipeline: the pipeline to configure
+    :param profile: tuple of (high_factor, low_ratio, blur), see :meth:`threshold_manager.ThresholdManager.set_profile`
+        and the option `canny_blur` of :func:`evaluate_droplet.edges_canny`
+    """
+    high_factor, low_ratio, blur = profile
+    pipeline.thresholds.set_profile(high_factor, low_ratio)
+    pipeline.options['canny_blur'] = blur
+
+def profile_key(img) -> str:
+    """
+    identify the setup the image was taken with by ROI size and brightness
+
+    :param img: camera image
+    :returns: key for :func:`load_profile` and :func:`store_profile`
+    """
+    height, width = img.shape[:2]
+    brightness = int(cv2.mean(img)[0]) // TUNE_BRIGHTNESS_STEP
+    return f'{width}x{height}_{brightness}'
+
+def load_profile(key) -> Optional[Profile]:
+    """
+    load a tuned profile from persistent storage
+
+    :param key: setup key, see :func:`profile_key`
+    :returns: the stored profile or None if the setup was not tuned yet
+    """
+    value = QSettings().value(f'canny_tuning/{key}')
+    if value is None:
+        return None
+    high_factor, low_ratio, blur = value
+    return float(high_factor), float(low_ratio), int(blur)
+
+def store_profile(key, profile: Profile):
+    """
+    store a tuned profile persistently
+
+    :param key: setup key, see :func:`profile_key`
+    :param profile: tuple of (high_factor, low_ratio, blur)
+    """
+    QSettings().setValue(f'canny_tuning/{key}', list(profile))
+    logging.info(f'canny tuning: stored profile {profile} for {key}')
+
+def _fit_residual(ellipse, points) -> float:
+    """ mean distance of the points to the ellipse, measured along the ray from its center """
+    (x0, y0), (maj_ax, min_ax), phi_deg = ellipse
+    a, b = maj_ax/2, min_ax/2
+    c, s = cos(radians(phi_deg)), sin(radians(phi_deg))
+    dx, dy = points[:,0] - x0, points[:,1] - y0
+    u, v = dx*c + dy*s, dy*c - dx*s
+    r = np.hypot(u, v)
+    q = np.hypot(u/a, v/b)
+    # r/q is the distance of the ellipse from its center in direction of the point
+    return float(np.mean(np.abs(r - np.divide(r, q, out=np.zeros_like(r), where=q > 0))))
+
+def _evaluate_candidate(frames, y_base, mask, pipeline: EvaluationPipeline) -> Optional[Tuple[float,float,float,float]]:
+    """ run the pipeline on all frames, returns the means of (contours, residual, runtime in ms, base width) or None if a frame failed """
+    values = []
+    for frame in frames:
+        start = time.perf_counter()
+        try:
+            data = pipeline.run(frame, y_base, mask)
+        except EVAL_ERRORS:
+            return None
+        runtime = (time.perf_counter() - start)*1e3
+        contours = cv2.connectedComponents(data.edges, connectivity=8)[0] - 1
+        points = data.contour.reshape(-1,2).astype(np.float64)
+        ellipse = data.ellipse if data.ellipse is not None else cv2.fitEllipseDirect(points.astype(np.float32))
+        (x_int_l, x_int_r) = data.metrics[0]
+        values.append((max(contours, 1), _fit_residual(ellipse, points), runtime, x_int_r - x_int_l))
+    return tuple(np.mean(values, axis=0))
+
+def tuning_template(pipeline: EvaluationPipeline = None) -> EvaluationPipeline:
+    """
+    snapshot of the pipeline state the candidates of :func:`tune_canny` start from,
+    take it on the thread that runs the pipeline, as the pipeline keeps running while the candidates are evaluated
+
+    :param pipeline: pipeline whose backends, options and baseline and needle detectors are copied, it is not modified,
+        None for the defaults
+    :returns: untracked pipeline with the `canny` edges backend and without the profile volume
+    """
+    if pipeline is None:
+        pipeline = EvaluationPipeline(track=False)
+    template = EvaluationPipeline(track=False, **dict(pipeline.backends, edges='canny'))
+    template.options.update(pipeline.options)
+    # the candidates are scored by the contour only
+    template.options['profile_volume'] = False
+    template.baseline = copy.deepcopy(pipeline.baseline)
+    template.needle = copy.deepcopy(pipeline.needle)
+    return template
+
+def tune_canny(frames, y_base, mask=None, template: EvaluationPipeline = None) -> Tuple[Profile, float]:
+    """
+    find the best edge detection profile for the frames
+
+    every combination of :data:`TUNE_HIGH_FACTORS`, :data:`TUNE_LOW_RATIOS` and :data:`TUNE_BLUR_SIZES` is evaluated
+    with the backends and options of the template, starting from a copy of its baseline including the tilt and its needle;
+    the score is the mean fit residual in px plus :data:`TUNE_CONTOUR_WEIGHT` per doubling of the number of edge contours
+    plus :data:`TUNE_RUNTIME_WEIGHT` per ms of evaluation time, lower is better
+
+    :param frames: list of camera images of the droplet
+    :param y_base: the y coordinate of the surface the droplet sits on
+    :param mask: needle mask as (x,y,w,h) tuple
+    :param template: pipeline state from :func:`tuning_template`, it is only read, None for the defaults
+    :raises ContourError: if no candidate could evaluate all frames
+    :returns: tuple of (profile, score) of the best candidate
+    """
+    if template is None:
+        template = tuning_template()
+    candidates: List[Profile] = [(high, low, blur) for high in TUNE_HIGH_FACTORS for low in TUNE_LOW_RATIOS for blur in TUNE_BLUR_SIZES]
+    results = []
+    for profile in candidates:
+        scratch = EvaluationPipeline(track=False, **template.backends)
+        scratch.options.update(template.options)
+        scratch.baseline = copy.deepcopy(template.baseline)
+        scratch.needle = copy.deepcopy(template.needle)
+        apply_profile(scratch, profile)
+        results.append(_evaluate_candidate(frames, y_base, mask, scratch))
+    valid = [(profile, res) for profile, res in zip(candidates, results) if res is not None]
+    if not valid:
+        raise ContourError('No edge detection profile found the droplet in all frames')
+    # candidates seeing a different width found only part of the droplet or something else
+    median_width = np.median([res[3] for _, res in valid])
+    valid = [(profile, res) for profile, res in valid if abs(res[3] - median_width) <= TUNE_MAX_WIDTH_DEVIATION*median_width]
+    scores = [residual + TUNE_CONTOUR_WEIGHT*log2(contours) + TUNE_RUNTIME_WEIGHT*runtime for _, (contours, residual, runtime, _) in valid]
+    best = int(np.argmin(scores))
+    profile, (contours, residual, runtime, _) = valid[best]
+    logging.info(f'canny tuning: best profile {profile} of {len(valid)} valid candidates, '
+                 f'{contours:.0f} contours, residual {residual:.2f} px, {runtime:.2f} ms')
+    return profile, scores[best]
@@ -46,9 +46,15 @@ class DataControl(QGroupBox):
         .. note::
             - **Time**: actual point in time the dataset was aquired
             - **Cycle**: if measurement is repeated, current number of repeats
-            - **Left_Angle**: angle of left droplet side
-            - **Right_Angle**: angle of right droplet side
-            - **Base_Width**: Width of the droplet
+            - **Droplet**: ID of the droplet in multi droplet mode, every droplet gets its own row; 0 for a single droplet
+            - **Left_Angle**: angle of left droplet side, mean of all frames since the last datapoint
+            - **Left_Angle_Std**: standard deviation of the left angle over these frames
+            - **Right_Angle**: angle of right droplet side, mean of all frames since the last datapoint
+            - **Right_Angle_Std**: standard deviation of the right angle over these frames
+            - **Base_Width**: Width of the droplet, mean of all frames since the last datapoint
+            - **Base_Width_Std**: standard deviation of the width over these frames
+            - **Volume**: droplet volume in px^3, mean of all frames since the last datapoint
+            - **Frames**: number of evaluated frames since the last datapoint, if 0 the current filtered values are used
             - **Substrate_Surface_Energy**: calculated surface energy of substrate from angles
             - **Magn_Pos**: position of magnet
             - **Magn_Unit**: unit of magnet pos (mm or steps or Tesla)
@@ -57,7 +63,7 @@ class DataControl(QGroupBox):
             - **DateTime**: date and time at begin of measurement
         
         """
-        self.header = ['Time', 'Cycle', 'Left_Angle', 'Right_Angle', 'Base_Width', 'Substate_Surface_Energy', 'Magn_Pos', 'Magn_Unit', 'Fe_Vol_P', 'ID', 'DateTime']
+        self.header = ['Time', 'Cycle', 'Droplet', 'Left_Angle', 'Left_Angle_Std', 'Right_Angle', 'Right_Angle_Std', 'Base_Width', 'Base_Width_Std', 'Volume', 'Frames', 'Substate_Surface_Energy', 'Magn_Pos', 'Magn_Unit', 'Fe_Vol_P', 'ID', 'DateTime']
         self.data = pd.DataFrame(columns=self.header)
 
         self._is_time_invalid = False
@@ -98,33 +104,45 @@ class DataControl(QGroupBox):
         add new datapoint to dataframe and invoke redrawing of table
         
         :param target_time: unused
-        :param droplet: droplet data
+        :param droplet: droplet data, the statistics of the frames since the last datapoint are taken from it
         :param cycle: current cycle in case of repeated measurements
         """
         if self._is_time_invalid: self.init_time()
+        stats = droplet.take_stats()
+        n = stats['angle_l'].count
+        if n > 0:
+            angle_l, angle_r, base_diam, volume = stats['angle_l'].mean, stats['angle_r'].mean, stats['base_diam'].mean, stats['volume'].mean
+        else:
+            # no frame evaluated since the last datapoint
+            angle_l, angle_r, base_diam, volume = droplet.angle_l, droplet.angle_r, droplet.base_diam, droplet.volume
         id = self.ui.idCombo.currentText() if self.ui.idCombo.currentText() != "" else "-"
         percent = self.ui.ironContentEdit.text()
         curtime = time.monotonic() - self._time
+        multi_stats = droplet.take_multi_stats()
+        if multi_stats:
+            # one row per droplet in multi droplet mode
+            rows = [(drop_id, ds['angle_l'].mean, ds['angle_l'].std, ds['angle_r'].mean, ds['angle_r'].std, ds['base_diam'].mean, ds['base_diam'].std,
+                     ds['volume'].mean, ds['angle_l'].count) for drop_id, ds in sorted(multi_stats.items())]
+        else:
+            rows = [(0, angle_l, stats['angle_l'].std, angle_r, stats['angle_r'].std, base_diam, stats['base_diam'].std, volume, n)]
         self.data = self.data.append(
             pd.DataFrame([[
                 curtime, 
                 cycle, 
-                droplet.angle_l, 
-                droplet.angle_r, 
-                droplet.base_diam, 
+                *row,
                 "-", 
                 self.ui.magnetControl.posSpinBox.value(),
                 self.ui.magnetControl.unitComboBox.currentText(),
                 percent, 
                 id, 
                 self._meas_start_datetime
-            ]], columns=self.header)
+            ] for row in rows], columns=self.header)
         )
         #logging.debug("starte thread zum redrawing vom table")
         # self.thr = Worker(self.ui.tableControl.redraw_table)
         # self.thr.start()
         self.ui.tableControl.redraw_table_signal.emit()
-        self.update_plot_signal.emit(curtime,(droplet.angle_l + droplet.angle_r)/2)
+        self.update_plot_signal.emit(curtime,(angle_l + angle_r)/2)
 
     def export_data_csv(self, filename):
         """ Export data as csv with selected separator
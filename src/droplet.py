@@ -14,13 +14,42 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from math import degrees
+import time
+from math import degrees, sqrt
 from PySide2.QtCore import QSettings
 import logging
 
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
-from numpy.lib.function_base import angle
+import numpy as np
+
+from frame_history import FrameHistory
+
+FILTER_ROLLING = 0
+FILTER_CUMULATIVE = 1
+FILTER_NONE = 2
+FILTER_KALMAN = 3
+FILTER_MEDIAN = 4
+FILTER_TRIMMED = 5
+FILTER_HAMPEL = 6
+""" filter modes of :meth:`Droplet.change_filter_mode`, in the order of the avg. mode combobox """
+
+FILTER_LENGTH = 300
+""" default number of values of the rolling filters, see :meth:`Droplet.set_filter_length` """
+FILTER_TRIM = 0.1
+""" fraction of the smallest and of the largest values ignored by the trimmed mean mode """
+FILTER_HAMPEL_THRESHOLD = 3.0
+""" values further than this many standard deviations from the median of the window are replaced by the median in hampel mode """
+# scale from the median absolute deviation to the standard deviation of normal distributed values
+_MAD_TO_STD = 1.4826
+
+STATS_METRICS = ('angle_l', 'angle_r', 'base_diam', 'height', 'area', 'volume')
+""" unfiltered frame values collected between two datapoints, see :meth:`Droplet.take_stats` """
+
+KALMAN_PROCESS_NOISE = 10.0
+""" default process noise of the kalman filter mode, see :class:`KalmanFilter` """
+# variance of the rate of change before the first measurements, relative to the measurement variance, in 1/s^2
+KALMAN_INITIAL_RATE_VARIANCE = 100.0
 
 class Singleton(object):
     """ singleton base class """
@@ -55,13 +84,33 @@ class Droplet(Singleton):
     - **int_l**, **int_r**: left and right intersections of ellipse with baseline
     - **line_l**, **line_r**: left and right tangent as 4-Tuple (x1,y1,x2,y2)
     - **base_diam**: diameter of the contact surface of droplet
+    - **base_y**: y coordinate of the baseline in the horizontal center of the image
+    - **base_tilt**: tilt of the baseline in rad, 0 unless the baseline is detected automatically
     - **_area**: unfiltered area of droplet silouette
     - **_area_avg**: rolling average filter for area
     - **_height**: unfiltered droplet height in px
     - **_height_avg**: rolling average filter for height
+    - **volume**: droplet volume in px^3, from the profile unless the fit method models the 3D shape
+    - **surface**: liquid-air surface area of the droplet in px^2
+    - **cap_length**: capillary length in px, only set by young laplace fit
+    - **timestamp**: time of the last update in s, used by the kalman filter mode
+    - **inlier_ratio**: fraction of the contour points the last fit is based on, below 1 only for robust fit methods
     - **scale_px_to_mm**: scale to convert between px and mm, is loaded from storage on startup
+    - **process_noise**: process noise of the kalman filter mode, is loaded from storage on startup
+
+    Independent of the filter mode, the values of every frame listed in :data:`STATS_METRICS` are collected
+    in :class:`RunningStats` until they are taken with :meth:`take_stats`, in multi droplet mode also per droplet
+    until they are taken with :meth:`take_multi_stats`. The raw results of all frames are also recorded
+    in **history**, a :class:`frame_history.FrameHistory`, to aggregate or filter them again afterwards.
+
+    In kalman filter mode the rate of change of the filtered values is available as **angle_l_rate**, **angle_r_rate**,
+    **area_rate** and **height_rate**, eg. to follow spreading and receding droplets.
     """
     def __init__(self):
+        # __init__ runs on every Droplet() call, only initialize the singleton once to keep the filter state
+        if getattr(self, '_initialized', False):
+            return
+        self._initialized = True
         settings                                    = QSettings()
         self.is_valid       : bool                  = False
         self._angle_l       : float                 = 0.0
@@ -82,10 +131,25 @@ class Droplet(Singleton):
         self.int_r          : Tuple[int,int]        = (0,0)
         self.line_r         : Tuple[int,int,int,int] = (0,0,0,0)
         self.base_diam      : int                   = 0
+        self.base_y         : float                 = 0.0
+        self.base_tilt      : float                 = 0.0
         self._area          : float                 = 0.0
         self._area_avg                              = RollingAverager()
         self._height        : float                 = 0.0
         self._height_avg                            = RollingAverager()
+        self.volume         : float                 = 0.0
+        self.surface        : float                 = 0.0
+        self.cap_length     : float                 = 0.0
+        self.inlier_ratio   : float                 = 1.0
+        self.timestamp      : float                 = 0.0
+        self._stats         : Dict[str, RunningStats] = {name: RunningStats() for name in STATS_METRICS}
+        self.droplets       : Dict[int, Any]        = {}
+        """ results of all droplets of the last frame by ID in multi droplet mode, empty otherwise """
+        self._multi_stats   : Dict[int, Dict[str, RunningStats]] = {}
+        self.history        : FrameHistory          = FrameHistory()
+        self._filter_mode   : int                   = FILTER_ROLLING
+        self._filter_length : int                   = FILTER_LENGTH
+        self.process_noise  : float                 = float(settings.value("droplet/process_noise", KALMAN_PROCESS_NOISE))
         self.scale_px_to_mm : float                 = float(settings.value("droplet/scale_px_to_mm", 0.0)) # try to load from persistent storage
 
     def __str__(self) -> str:
@@ -102,6 +166,59 @@ class Droplet(Singleton):
         else:
             return 'No droplet!'
 
+    def update(self, result, timestamp=None):
+        """ take over the values of an evaluated frame and feed the filters
+
+        :param result: :class:`evaluate_droplet.DropletResult` of the frame
+        :param timestamp: time the frame was taken in s, the current time if None
+        """
+        self.timestamp = time.perf_counter() if timestamp is None else timestamp
+        self.angle_l = result.angle_l
+        self.angle_r = result.angle_r
+        self.maj = result.maj
+        self.min = result.min
+        self.center = result.center
+        self.phi = result.phi
+        self.tilt_deg = result.tilt_deg
+        self.tan_l_m = result.tan_l_m
+        self.tan_r_m = result.tan_r_m
+        self.line_l = result.line_l
+        self.line_r = result.line_r
+        self.int_l = result.int_l
+        self.int_r = result.int_r
+        self.foc_pt1 = result.foc_pt1
+        self.foc_pt2 = result.foc_pt2
+        self.base_diam = result.base_diam
+        self.base_y = result.base_y
+        self.base_tilt = result.base_tilt
+        self.area = result.area
+        self.height = result.height
+        self.volume = result.volume
+        self.surface = result.surface
+        self.cap_length = result.cap_length
+        self.inlier_ratio = result.inlier_ratio
+        self.is_valid = True
+        for name, stats in self._stats.items():
+            stats.put(getattr(result, name))
+        self.history.append(self.timestamp, result)
+
+    def update_multi(self, results, timestamp=None):
+        """ take over the results of all droplets of a frame in multi droplet mode,
+        the droplet with the lowest ID is also taken over as the filtered droplet, see :meth:`update`
+
+        :param results: dict of droplet ID to :class:`evaluate_droplet.DropletResult`
+        :param timestamp: time the frame was taken in s, the current time if None
+        """
+        self.droplets = results
+        for drop_id, result in results.items():
+            stats = self._multi_stats.get(drop_id)
+            if stats is None:
+                stats = self._multi_stats[drop_id] = {name: RunningStats() for name in STATS_METRICS}
+            for name, values in stats.items():
+                values.put(getattr(result, name))
+        if results:
+            self.update(results[min(results)], timestamp)
+
     # properties section, get returns the average, set feeds the rolling averager
     @property
     def angle_l(self):
@@ -110,7 +227,7 @@ class Droplet(Singleton):
 
     @angle_l.setter
     def angle_l(self, value):
-        self._angle_l_avg._put(value)
+        self._angle_l_avg._put(value, self.timestamp)
         self._angle_l = value
 
     @property
@@ -120,7 +237,7 @@ class Droplet(Singleton):
 
     @angle_r.setter
     def angle_r(self, value):
-        self._angle_r_avg._put(value)
+        self._angle_r_avg._put(value, self.timestamp)
         self._angle_r = value
 
     @property
@@ -130,7 +247,7 @@ class Droplet(Singleton):
 
     @height.setter
     def height(self, value):
-        self._height_avg._put(value)
+        self._height_avg._put(value, self.timestamp)
         self._height = value
 
     @property
@@ -140,9 +257,30 @@ class Droplet(Singleton):
 
     @area.setter
     def area(self, value):
-        self._area_avg._put(value)
+        self._area_avg._put(value, self.timestamp)
         self._area = value
 
+    # rates of change, only estimated by the kalman filter
+    @property
+    def angle_l_rate(self):
+        """ rate of change of the left tangent angle in deg/s, 0 if not in kalman filter mode """
+        return self._angle_l_avg.rate if self._filter_mode == FILTER_KALMAN else 0.0
+
+    @property
+    def angle_r_rate(self):
+        """ rate of change of the right tangent angle in deg/s, 0 if not in kalman filter mode """
+        return self._angle_r_avg.rate if self._filter_mode == FILTER_KALMAN else 0.0
+
+    @property
+    def height_rate(self):
+        """ rate of change of the droplet height in px/s, 0 if not in kalman filter mode """
+        return self._height_avg.rate if self._filter_mode == FILTER_KALMAN else 0.0
+
+    @property
+    def area_rate(self):
+        """ rate of change of the droplet area in px^2/s, 0 if not in kalman filter mode """
+        return self._area_avg.rate if self._filter_mode == FILTER_KALMAN else 0.0
+
     # return values after converting to metric
     @property
     def height_mm(self):
@@ -164,6 +302,30 @@ class Droplet(Singleton):
     def area_mm(self):
         return self._area_avg.average * self.scale_px_to_mm**2
 
+    @property
+    def volume_mm(self):
+        """ droplet volume in mm^3 (µl)
+
+        .. seealso:: :meth:`set_scale` 
+        """
+        return self.volume * self.scale_px_to_mm**3
+
+    @property
+    def surface_mm(self):
+        """ liquid-air surface area in mm^2
+
+        .. seealso:: :meth:`set_scale` 
+        """
+        return self.surface * self.scale_px_to_mm**2
+
+    @property
+    def cap_length_mm(self):
+        """ capillary length in mm
+
+        .. seealso:: :meth:`set_scale` 
+        """
+        return self.cap_length * self.scale_px_to_mm
+
     def set_scale(self, scale):
         """ set and store a scalefactor to calculate mm from pixels
 
@@ -177,15 +339,51 @@ class Droplet(Singleton):
         settings = QSettings()
         settings.setValue("droplet/scale_px_to_mm", scale)
 
+    def set_process_noise(self, value):
+        """ set and store the process noise of the kalman filter mode
+
+        :param value: new process noise, see :class:`KalmanFilter`
+        """
+        logging.info(f"droplet: set process noise to {value}")
+        self.process_noise = value
+        if self._filter_mode == FILTER_KALMAN:
+            for filt in (self._angle_l_avg, self._angle_r_avg, self._height_avg, self._area_avg):
+                filt.process_noise = value
+        settings = QSettings()
+        settings.setValue("droplet/process_noise", value)
+
     def set_filter_length(self, value):
-        """ adjust the filter length for the rolling average
+        """ adjust the filter length for the rolling average, it is kept when the filter mode changes;
+        in kalman filter mode it is only applied once a rolling mode is selected again
         
         :param value: new filter length
         """
-        self._angle_l_avg.set_length(value)
-        self._angle_r_avg.set_length(value)
-        self._height_avg.set_length(value)
-        self._area_avg.set_length(value)
+        self._filter_length = value
+        if self._filter_mode == FILTER_KALMAN:
+            return
+        for filt in (self._angle_l_avg, self._angle_r_avg, self._height_avg, self._area_avg):
+            # also the length a reset or mode change returns to
+            filt.default_len = value
+            filt.set_length(value)
+
+    def take_stats(self) -> Dict[str, 'RunningStats']:
+        """ return the statistics of all frames since the last call and start collecting anew
+
+        :returns: dict with a :class:`RunningStats` per name in :data:`STATS_METRICS`
+        """
+        stats = self._stats
+        self._stats = {name: RunningStats() for name in STATS_METRICS}
+        return stats
+
+    def take_multi_stats(self) -> Dict[int, Dict[str, 'RunningStats']]:
+        """ return the statistics of every droplet since the last call in multi droplet mode and start collecting anew
+
+        :returns: dict of droplet ID to dict with a :class:`RunningStats` per name in :data:`STATS_METRICS`,
+            only droplets evaluated since the last call are included
+        """
+        stats = self._multi_stats
+        self._multi_stats = {}
+        return stats
 
     def reset_filters(self):
         """reset the filters for special modes
@@ -198,8 +396,22 @@ class Droplet(Singleton):
     def change_filter_mode(self, mode):
         """change the filter modes
 
-        :param mode: modes: 0 default; 1 average until read
+        :param mode: modes: 0 default; 1 average until read; 2 no averaging; 3 kalman filter; 4 rolling median;
+            5 rolling trimmed mean; 6 rolling mean with hampel outlier rejection, see :data:`FILTER_HAMPEL`
         """
+        if mode == FILTER_KALMAN:
+            self._angle_l_avg = KalmanFilter(self.process_noise)
+            self._angle_r_avg = KalmanFilter(self.process_noise)
+            self._height_avg = KalmanFilter(self.process_noise)
+            self._area_avg = KalmanFilter(self.process_noise)
+            self._filter_mode = mode
+            return
+        if self._filter_mode == FILTER_KALMAN:
+            self._angle_l_avg = RollingAverager(self._filter_length)
+            self._angle_r_avg = RollingAverager(self._filter_length)
+            self._height_avg = RollingAverager(self._filter_length)
+            self._area_avg = RollingAverager(self._filter_length)
+        self._filter_mode = mode
         self._angle_l_avg.change_mode(mode)
         self._angle_r_avg.change_mode(mode)
         self._height_avg.change_mode(mode)
@@ -208,55 +420,163 @@ class Droplet(Singleton):
 class RollingAverager:
     """ 
     rolling average filter of variable length
+
+    the values are kept in a ring buffer with a running sum, so reading the rolling mean does not depend on the length;
+    the median based modes additionally keep a sorted copy of the window that is updated with every new value by moving
+    the values between the outgoing and the new one, the window is never sorted again; the trimmed mean keeps a running
+    sum of the middle of the sorted window and the hampel mode finds the median absolute deviation by bisection on it;
+    in hampel mode the buffer holds the cleaned values for the mean, the outliers are detected on the raw values
     
     :param length: length of the filter
     """
-    def __init__(self, length=300):
+    def __init__(self, length=FILTER_LENGTH):
         # lenght of filter
         self.length = length
         self.default_len = length
-        self.buffer = [0.0]*length
+        self.buffer = np.zeros(length)
         self.counter = 0
-        self.mode = 0
+        self.mode = FILTER_ROLLING
         self.first_number = True
+        self._sum = 0.0
+        # sorted window, only kept in the median based modes
+        self._sorted: np.ndarray = None
+        # sum of the sorted window without the trimmed values
+        self._trim_sum = 0.0
+        # raw values in hampel mode, parallel to the buffer
+        self._raw: np.ndarray = None
+        # sum and number of values in cumulative mode
+        self._cum_sum = 0.0
+        self._cum_count = 0
+        self._last = 0.0
 
     def _rotate(self):
         """
         shift  internal index to next position
         """
-        if self.mode == 0:
-            # increase current index by 1 or loop back to 0
-            if self.counter == (self.length - 1):
-                self.counter = 0
-            else:
-                self.counter += 1
+        # increase current index by 1 or loop back to 0
+        if self.counter == (self.length - 1):
+            self.counter = 0
+            # sum up again once per round, so rounding errors of the running sums do not accumulate
+            self._sum = float(self.buffer.sum())
+            self._sum_trimmed()
+        else:
+            self.counter += 1
 
-    def _put(self, value):
+    def _put(self, value, timestamp=None):
         """ set value at current index
 
         :param float value: the new value to set
+        :param timestamp: not used, for compatibility with :class:`KalmanFilter`
         """ 
-        if self.mode == 1:
-            self.buffer.append(value)
-            self.length += 1
+        self._last = value
+        if self.mode == FILTER_CUMULATIVE:
+            self._cum_sum += value
+            self._cum_count += 1
+            return
+        if self.first_number:
+            # initialize buffer with first value
+            self.buffer.fill(value)
+            self._sum = value*self.length
+            if self._sorted is not None: self._sorted.fill(value)
+            if self._raw is not None: self._raw.fill(value)
+            self._sum_trimmed()
+            self.first_number = False
+        else:
+            old = self.buffer[self.counter]
+            if self._raw is not None:
+                # test against the raw window, so replaced outliers do not narrow it
+                self._replace_sorted(self._raw[self.counter], value)
+                self._raw[self.counter] = value
+                value = self._hampel(value)
+            elif self._sorted is not None:
+                self._replace_sorted(old, value)
+            # replace value at current index then rotate index
+            self.buffer[self.counter] = value
+            self._sum += value - old
+        self._rotate()
+
+    def _trim_range(self) -> Tuple[int,int]:
+        """ start and end index of the values of the sorted window kept by the trimmed mean """
+        trim = int(FILTER_TRIM*self.length)
+        return trim, self.length - trim
+
+    def _sum_trimmed(self):
+        """ sum up the kept values of the sorted window for the trimmed mean """
+        if self._sorted is not None:
+            start, end = self._trim_range()
+            self._trim_sum = float(self._sorted[start:end].sum())
+
+    def _replace_sorted(self, old, new):
+        """ remove the old value from the sorted window and insert the new one, keeping the order and the trimmed sum """
+        srt = self._sorted
+        i = int(np.searchsorted(srt, old))
+        j = int(np.searchsorted(srt, new))
+        start, end = self._trim_range()
+        if j > i:
+            # values between old and new move one place down, the kept range loses its first and gains its next value
+            first, last = max(start, i), min(end - 1, j - 1)
+            if first <= last:
+                self._trim_sum += (new if last == j - 1 else srt[last + 1]) - srt[first]
+            srt[i:j-1] = srt[i+1:j]
+            srt[j-1] = new
         else:
-            if self.first_number:
-                # initialize buffer with first value
-                self.buffer = [value]*self.length
-                self.first_number = False
+            # values between new and old move one place up, the kept range gains its previous and loses its last value
+            first, last = max(start, j), min(end - 1, i)
+            if first <= last:
+                self._trim_sum += (new if first == j else srt[first - 1]) - srt[last]
+            srt[j+1:i+1] = srt[j:i]
+            srt[j] = new
+
+    def _median(self) -> float:
+        """ median of the window from the sorted values """
+        srt = self._sorted
+        return 0.5*(srt[(self.length - 1)//2] + srt[self.length//2])
+
+    def _deviation(self, median, k) -> float:
+        """
+        k-th smallest absolute deviation of the window from the median
+
+        the deviations of the values below and above the median are both ascending when read outwards from the median,
+        the k-th smallest of the two sequences is found by bisection on how many are taken from the lower one
+        """
+        srt = self._sorted
+        split = int(np.searchsorted(srt, median))
+        low, high = max(0, k + 1 - (self.length - split)), min(k + 1, split)
+        while low < high:
+            below = (low + high)//2
+            if median - srt[split - 1 - below] < srt[split + k - below] - median:
+                low = below + 1
             else:
-                # add value to current line then rotate index
-                self.buffer[self.counter] = value
-            self._rotate()
+                high = below
+        below = low
+        deviation = median - srt[split - below] if below > 0 else 0.0
+        if below <= k:
+            deviation = max(deviation, srt[split + k - below] - median)
+        return deviation
+
+    def _hampel(self, value) -> float:
+        """ return the value, or the median of the window if it is an outlier """
+        median = self._median()
+        mad = 0.5*(self._deviation(median, (self.length - 1)//2) + self._deviation(median, self.length//2))
+        # a constant window has no spread, accept everything until it has one
+        if mad > 0 and abs(value - median) > FILTER_HAMPEL_THRESHOLD*_MAD_TO_STD*mad:
+            return median
+        return value
 
     @property
     def average(self) -> float:
         """ Return the averaged value """
-        avg = sum(self.buffer) / self.length
-        if self.mode == 1: 
-            self.buffer = []
-            self.length = 0
-        return avg
+        if self.mode == FILTER_CUMULATIVE:
+            avg = self._cum_sum / self._cum_count if self._cum_count else self._last
+            self._cum_sum = 0.0
+            self._cum_count = 0
+            return avg
+        if self.mode == FILTER_MEDIAN:
+            return float(self._median())
+        if self.mode == FILTER_TRIMMED:
+            start, end = self._trim_range()
+            return self._trim_sum / (end - start)
+        return self._sum / self.length
 
     def set_length(self, value):
         """
@@ -264,31 +584,152 @@ class RollingAverager:
 
         :param int value: the new filter length
         """
-        if value > self.length:
-            # append delta len to exisiting buffer, fill w/ current average
-            self.buffer = self.buffer + [self.average]*(value - self.length)
-        else:
+        fill = self._sum / self.length
+        def resize(buffer):
+            # values from oldest to newest
+            ordered = np.roll(buffer, -self.counter)
+            if value > self.length:
+                # prepend delta len to exisiting buffer, fill w/ current average
+                return np.concatenate((np.full(value - self.length, fill), ordered))
             # keep last numbers
-            self.buffer = self.buffer[-value:]
-            # roll counter over if too large
-            if self.counter > (value -1 ): self.counter = 0
+            return np.ascontiguousarray(ordered[-value:])
+        self.buffer = resize(self.buffer)
+        if self._raw is not None: self._raw = resize(self._raw)
+        self.counter = 0
         self.length = value
+        self._sum = float(self.buffer.sum())
+        if self._sorted is not None: self._sorted = np.sort(self.buffer if self._raw is None else self._raw)
+        self._sum_trimmed()
         logging.info(f"set filter length to {value}")
 
     def reset(self):
-        self.mode == 0
+        """ forget all values and restore the default length, the next value fills the buffer """
         self.counter = 0
+        self.first_number = True
+        self._cum_sum = 0.0
+        self._cum_count = 0
         self.set_length(self.default_len)
 
     def change_mode(self, mode):
+        """
+        change the filter mode
+
+        :param mode: one of the filter modes, see :meth:`Droplet.change_filter_mode`
+        """
         self.mode = mode
-        if mode == 0:
-            self.reset()
-        elif mode == 1:
-            self.buffer = []
-            self.length = 0
-        elif mode == 2:
+        self._sorted = None
+        self._raw = None
+        self.reset()
+        if mode == FILTER_NONE:
             self.set_length(1)
+        elif mode in (FILTER_MEDIAN, FILTER_TRIMMED, FILTER_HAMPEL):
+            self._sorted = np.sort(self.buffer)
+            if mode == FILTER_HAMPEL: self._raw = self.buffer.copy()
+            self._sum_trimmed()
 
-        
 
+class RunningStats:
+    """
+    mean, standard deviation, min and max of a stream of values with constant memory,
+    using welford's algorithm for numerically stable variance updates
+    """
+    __slots__ = ('count', 'mean', 'min', 'max', '_m2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = float('nan')
+        self.min = float('nan')
+        self.max = float('nan')
+        self._m2 = 0.0
+
+    def put(self, value):
+        """ add a value
+
+        :param float value: the new value
+        """
+        self.count += 1
+        if self.count == 1:
+            self.mean = self.min = self.max = value
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta*(value - self.mean)
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+
+    @property
+    def variance(self) -> float:
+        """ sample variance, nan for less than two values """
+        return self._m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def std(self) -> float:
+        """ sample standard deviation, nan for less than two values """
+        return sqrt(self.variance)
+
+
+class KalmanFilter:
+    """
+    kalman filter with constant velocity model for a single measured value
+
+    estimates the value and its rate of change from measurements at arbitrary times, the rate is assumed to change
+    randomly with white noise acceleration; all variances are relative to the measurement variance,
+    so the filter behaves the same for every unit of the measured value
+
+    offers the interface of :class:`RollingAverager` used by :class:`Droplet`
+
+    :param process_noise: spectral density of the acceleration relative to the measurement variance in 1/s^3,
+        larger values follow changes faster but smooth less
+    """
+    def __init__(self, process_noise=KALMAN_PROCESS_NOISE):
+        self.process_noise = process_noise
+        self.reset()
+
+    def reset(self):
+        """ forget the state, the next value initializes the filter """
+        self.value = 0.0
+        self.rate = 0.0
+        # covariance of (value, rate)
+        self._p00 = self._p01 = self._p11 = 0.0
+        self._time = None
+
+    def _put(self, value, timestamp=None):
+        """ add a measurement
+
+        :param float value: the measured value
+        :param timestamp: time of the measurement in s, the current time if None
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if self._time is None:
+            self.value, self.rate = value, 0.0
+            self._p00, self._p01, self._p11 = 1.0, 0.0, KALMAN_INITIAL_RATE_VARIANCE
+            self._time = timestamp
+            return
+        dt = timestamp - self._time
+        if dt > 0:
+            # predict with constant rate
+            q = self.process_noise
+            self.value += dt*self.rate
+            self._p00 += dt*(2*self._p01 + dt*self._p11) + q*dt**3/3
+            self._p01 += dt*self._p11 + q*dt**2/2
+            self._p11 += q*dt
+            self._time = timestamp
+        # correct with the measurement, its variance is 1
+        s = self._p00 + 1.0
+        k0, k1 = self._p00/s, self._p01/s
+        residual = value - self.value
+        self.value += k0*residual
+        self.rate += k1*residual
+        self._p11 -= k1*self._p01
+        self._p00 *= 1 - k0
+        self._p01 *= 1 - k0
+
+    @property
+    def average(self) -> float:
+        """ Return the filtered value """
+        return self.value
+
+    def change_mode(self, mode):
+        """ the kalman filter has no modes, only resets """
+        self.reset()
@@ -0,0 +1,166 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Droplet position tracking between frames
+
+from typing import List, Tuple
+import cv2
+import numpy as np
+
+# default margin in px around the last droplet bounding rect that is searched in tracking mode
+TRACKER_PADDING = 20
+# default number of tracked frames after which the full image is searched again
+TRACKER_REFRESH_INTERVAL = 100
+# default max distance in px the center of a droplet moves between frames to keep its ID
+MATCHER_MAX_SHIFT = 30.0
+# default number of frames a droplet may be missing before its ID is dropped
+MATCHER_MAX_MISSED = 10
+
+
+class DropletTracker:
+    """
+    keeps the bounding rect of the droplet from the previous frame,
+    so the edge search can be restricted to a padded window around it
+
+    :param padding: margin in px added around the last bounding rect
+    :param refresh_interval: number of tracked frames after which a full image search is forced
+    """
+    def __init__(self, padding=TRACKER_PADDING, refresh_interval=TRACKER_REFRESH_INTERVAL):
+        self.padding = padding
+        self.refresh_interval = refresh_interval
+        self.rect: Tuple[int,int,int,int] = None
+        self._frames_tracked = 0
+
+    @property
+    def is_tracking(self) -> bool:
+        """ whether a droplet position from a previous frame is available """
+        return self.rect is not None
+
+    def reset(self):
+        """ forget the last droplet position, next frame will be searched completely """
+        self.rect = None
+        self._frames_tracked = 0
+
+    def get_window(self, width, y_base):
+        """
+        return the search window for the next frame
+
+        :param width: width of the image
+        :param y_base: the y coordinate of the surface the droplet sits on
+        :returns: window as (x1,y1,x2,y2) tuple or None if the full image has to be searched
+        """
+        if self.rect is None:
+            return None
+        if self._frames_tracked >= self.refresh_interval:
+            # search full image from time to time in case tracking locked onto something else
+            self._frames_tracked = 0
+            return None
+        x,y,w,h = self.rect
+        x1 = max(x - self.padding, 0)
+        y1 = max(y - self.padding, 0)
+        x2 = min(x + w + self.padding, width)
+        y2 = y_base
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return x1, y1, x2, y2
+
+    @staticmethod
+    def touches_border(contour, window, width, y_base) -> bool:
+        """
+        check if the contour touches an edge of the window that is not also an edge of the image,
+        in that case the droplet might extend beyond the window
+
+        :param contour: the droplet contour in image coordinates
+        :param window: the search window as (x1,y1,x2,y2) tuple
+        :param width: width of the image
+        :param y_base: the y coordinate of the surface the droplet sits on
+        """
+        x1, y1, x2, y2 = window
+        x,y,w,h = cv2.boundingRect(contour)
+        return (x <= x1 and x1 > 0) or (y <= y1 and y1 > 0) or (x + w >= x2 and x2 < width)
+
+    def update(self, contour):
+        """
+        store the bounding rect of the current droplet contour
+
+        :param contour: the droplet contour in image coordinates
+        """
+        self._frames_tracked += 1
+        self.rect = cv2.boundingRect(contour)
+
+
+class DropletMatcher:
+    """
+    assigns stable IDs to several droplets by matching their centers to the ones of the previous frames
+
+    the closest pairs of known and new centers are matched first, droplets without a match within max_shift get a new ID;
+    a droplet that is not found keeps its ID for max_missed frames, eg. if its fit failed once
+
+    :param max_shift: max distance in px the center of a droplet moves between frames
+    :param max_missed: number of frames a droplet may be missing before its ID is dropped
+    """
+    def __init__(self, max_shift=MATCHER_MAX_SHIFT, max_missed=MATCHER_MAX_MISSED):
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self._ids: List[int] = []
+        self._centers = np.empty((0,2))
+        self._missed = np.empty(0, dtype=np.intp)
+        self._next_id = 1
+
+    def reset(self):
+        """ forget all droplets, IDs start at 1 again """
+        self._ids = []
+        self._centers = np.empty((0,2))
+        self._missed = np.empty(0, dtype=np.intp)
+        self._next_id = 1
+
+    def match(self, centers) -> List[int]:
+        """
+        assign IDs to the droplets of the current frame
+
+        :param centers: N x 2 array of droplet centers (x,y)
+        :returns: list of N IDs in the order of the centers
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1,2)
+        ids = [0]*len(centers)
+        matched = np.zeros(len(self._ids), dtype=bool)
+        if len(self._ids) > 0 and len(centers) > 0:
+            dist = np.hypot(*(centers[:,None,:] - self._centers[None,:,:]).transpose(2,0,1))
+            new, old = np.unravel_index(np.argsort(dist, axis=None), dist.shape)
+            close = dist[new, old] <= self.max_shift
+            for n, o in zip(new[close], old[close]):
+                if ids[n] == 0 and not matched[o]:
+                    ids[n] = self._ids[o]
+                    matched[o] = True
+        # update the known droplets, unmatched ones are kept until they were missed too often
+        self._missed[matched] = 0
+        self._missed[~matched] += 1
+        keep = self._missed <= self.max_missed
+        index = {drop_id: i for i, drop_id in enumerate(self._ids)}
+        for n, drop_id in enumerate(ids):
+            if drop_id != 0:
+                self._centers[index[drop_id]] = centers[n]
+        self._ids = [drop_id for drop_id, k in zip(self._ids, keep) if k]
+        self._centers = self._centers[keep]
+        self._missed = self._missed[keep]
+        for n in range(len(centers)):
+            if ids[n] == 0:
+                ids[n] = self._next_id
+                self._next_id += 1
+                self._ids.append(ids[n])
+                self._centers = np.vstack((self._centers, centers[n]))
+                self._missed = np.append(self._missed, 0)
+        return ids
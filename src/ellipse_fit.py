@@ -0,0 +1,265 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Sub-pixel edge refinement and direct least squares ellipse fit
+
+from math import degrees, atan2, log, log1p, ceil
+from typing import Tuple
+import cv2
+import numpy as np
+
+# margin around contour bounding rect used for gradient calculation
+GRADIENT_MARGIN = 2
+RANSAC_ITERATIONS = 256
+""" default for pipeline option `ransac_iterations`: max number of random samples tested by :func:`fit_ellipse_ransac` """
+RANSAC_THRESHOLD = 1.5
+""" default for pipeline option `ransac_threshold`: max distance in px of a point to the ellipse to count as inlier """
+# samples are tested in batches of this size, after each batch the required number of samples is updated
+RANSAC_BATCH = 32
+# probability of drawing at least one sample without outliers, used to stop early
+RANSAC_CONFIDENCE = 0.99
+# max number of evenly spaced contour points the samples are scored on
+RANSAC_SCORE_POINTS = 256
+
+
+class EllipseFitError(Exception):
+    pass
+
+
+def subpixel_edge_points(img, contour) -> np.ndarray:
+    """
+    refine integer contour pixels to sub-pixel precision
+
+    the gradient magnitude is sampled at the pixel and one pixel before and after it along the gradient direction,
+    the position of the maximum of a parabola through these three values gives the sub-pixel offset
+
+    :param img: grayscale image the contour was extracted from
+    :param contour: contour as returned by cv2.findContours, in image coordinates
+    :returns: N x 2 float array of refined (x,y) points
+    """
+    points = contour.reshape(-1,2).astype(np.float64)
+    if img.ndim == 3:
+        img = img[:,:,0]
+    # calculate gradient only on the part of the image covered by the contour
+    x,y,w,h = cv2.boundingRect(contour)
+    x1 = max(x - GRADIENT_MARGIN, 0)
+    y1 = max(y - GRADIENT_MARGIN, 0)
+    x2 = min(x + w + GRADIENT_MARGIN, img.shape[1])
+    y2 = min(y + h + GRADIENT_MARGIN, img.shape[0])
+    roi = img[y1:y2, x1:x2].astype(np.float32)
+    grad_x = cv2.Sobel(roi, cv2.CV_32F, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(roi, cv2.CV_32F, 0, 1, ksize=3)
+    magnitude = cv2.magnitude(grad_x, grad_y)
+
+    px = points[:,0] - x1
+    py = points[:,1] - y1
+    ix = px.astype(np.intp)
+    iy = py.astype(np.intp)
+    gx = grad_x[iy, ix].astype(np.float64)
+    gy = grad_y[iy, ix].astype(np.float64)
+    norm = np.hypot(gx, gy)
+    valid = norm > 0
+    nx = np.divide(gx, norm, out=np.zeros_like(gx), where=valid)
+    ny = np.divide(gy, norm, out=np.zeros_like(gy), where=valid)
+
+    m_center = magnitude[iy, ix].astype(np.float64)
+    m_before = _bilinear(magnitude, px - nx, py - ny)
+    m_after = _bilinear(magnitude, px + nx, py + ny)
+    denom = m_before - 2*m_center + m_after
+    # only refine at real maxima, curvature of parabola has to be negative
+    valid &= denom < 0
+    offset = np.divide(0.5*(m_before - m_after), denom, out=np.zeros_like(denom), where=valid)
+    np.clip(offset, -0.5, 0.5, out=offset)
+
+    points[:,0] += offset*nx
+    points[:,1] += offset*ny
+    return points
+
+def _bilinear(arr, x, y) -> np.ndarray:
+    """ sample 2D array at float coordinates with bilinear interpolation, coordinates are clamped to array """
+    h, w = arr.shape
+    x = np.clip(x, 0, w - 1.000001)
+    y = np.clip(y, 0, h - 1.000001)
+    x0 = x.astype(np.intp)
+    y0 = y.astype(np.intp)
+    fx = x - x0
+    fy = y - y0
+    top = arr[y0, x0]*(1 - fx) + arr[y0, x0 + 1]*fx
+    bottom = arr[y0 + 1, x0]*(1 - fx) + arr[y0 + 1, x0 + 1]*fx
+    return top*(1 - fy) + bottom*fy
+
+def calc_baseline_weights(points, y_base, decay_length) -> np.ndarray:
+    """
+    calculate fit weights that decay exponentially with the distance of the points to the baseline
+
+    :param points: N x 2 array of (x,y) points
+    :param y_base: y coordinate of the baseline
+    :param decay_length: distance in px over which the weight drops to 1/e
+    :returns: array of N weights in (0,1]
+    """
+    dist = np.maximum(y_base - points[:,1], 0)
+    return np.exp(-dist / decay_length)
+
+def fit_ellipse_direct(points, weights=None):
+    """
+    fit an ellipse to the points with the direct least squares method by Fitzgibbon,
+    using the numerically stable formulation by Halir and Flusser
+
+    result has the same format as cv2.fitEllipse
+
+    :param points: N x 2 array of (x,y) points, N >= 5
+    :param weights: optional array of N per-point weights
+    :raises EllipseFitError: if no ellipse could be fitted
+    :returns: ((x0,y0), (width,height), angle) with the full axis lengths and the angle in deg
+    """
+    x, y, mean, scale = _normalize(points)
+    conic = _fit_conic_direct(x, y, weights)
+    (x0, y0), (a, b), phi = conic_to_ellipse(conic)
+    return (x0*scale + mean[0], y0*scale + mean[1]), (2*a*scale, 2*b*scale), degrees(phi) % 180
+
+def fit_ellipse_ransac(points, weights=None, iterations=RANSAC_ITERATIONS, threshold=RANSAC_THRESHOLD, rng=None):
+    """
+    robust ellipse fit that ignores outliers like needle remnants, reflections or dust on the contour
+
+    ellipses through random samples of 5 points are scored by the number of points closer than threshold,
+    measured with the Sampson approximation of the geometric distance on up to :data:`RANSAC_SCORE_POINTS` points; the points supporting the best one
+    are fitted with :func:`fit_ellipse_direct`, the inliers of that fit are fitted once more.
+    Sampling stops as soon as a sample without outliers was drawn with :data:`RANSAC_CONFIDENCE`
+    according to the inlier ratio found so far, at the latest after `iterations` samples
+
+    :param points: N x 2 array of (x,y) points, N >= 5
+    :param weights: optional array of N per-point weights, used for scoring and fitting
+    :param iterations: max number of samples
+    :param threshold: max distance in px of an inlier
+    :param rng: numpy random generator, a fixed seed is used if None so results are reproducible
+    :raises EllipseFitError: if no ellipse could be fitted
+    :returns: tuple of (ellipse, inliers) with the ellipse in the format of cv2.fitEllipse and the boolean inlier mask
+    """
+    x, y, mean, scale = _normalize(points)
+    if rng is None:
+        rng = np.random.default_rng(0)
+    weights = np.ones(len(x)) if weights is None else np.asarray(weights, dtype=np.float64)
+    design = np.column_stack((x*x, x*y, y*y, x, y, np.ones_like(x)))
+    thresh = threshold / scale
+    step = max(len(x) // RANSAC_SCORE_POINTS, 1)
+    score_design, score_weights = design[::step], weights[::step]
+    best_score = -1.0
+    best_conic = None
+    required = iterations
+    done = 0
+    while done < min(required, iterations):
+        # conics through 5 points are the null space of the 5 x 6 design matrix
+        samples = rng.integers(0, len(x), (RANSAC_BATCH, 5))
+        conics = np.linalg.svd(design[samples])[2][:, -1, :]
+        conics = conics[conics[:,1]**2 - 4*conics[:,0]*conics[:,2] < 0]
+        done += RANSAC_BATCH
+        if len(conics) == 0:
+            continue
+        inliers = _sampson_inliers(conics, score_design, thresh)
+        scores = inliers @ score_weights
+        best = np.argmax(scores)
+        if scores[best] > best_score:
+            best_score = scores[best]
+            best_conic = conics[best]
+            ratio = np.count_nonzero(inliers[best]) / len(score_design)
+            required = ceil(log(1 - RANSAC_CONFIDENCE) / log1p(-ratio**5)) if ratio < 1 else 0
+    if best_conic is None:
+        raise EllipseFitError('No elliptical sample')
+    conic = best_conic
+    for _ in range(2):
+        inliers = _sampson_inliers(conic[None,:], design, thresh)[0]
+        if np.count_nonzero(inliers) < 5:
+            raise EllipseFitError('Not enough inliers for ellipse fit')
+        conic = _fit_conic_direct(x[inliers], y[inliers], weights[inliers])
+    inliers = _sampson_inliers(conic[None,:], design, thresh)[0]
+    (x0, y0), (a, b), phi = conic_to_ellipse(conic)
+    return ((x0*scale + mean[0], y0*scale + mean[1]), (2*a*scale, 2*b*scale), degrees(phi) % 180), inliers
+
+def _normalize(points):
+    """ center the points and scale them to unit mean distance for numerical stability, returns (x, y, mean, scale) """
+    points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+    if len(points) < 5:
+        raise EllipseFitError('Not enough points for ellipse fit')
+    mean = points.mean(axis=0)
+    scale = np.sqrt(((points - mean)**2).sum(axis=1).mean()/2)
+    if scale == 0:
+        raise EllipseFitError('Degenerate point set')
+    return (points[:,0] - mean[0]) / scale, (points[:,1] - mean[1]) / scale, mean, scale
+
+def _sampson_inliers(conics, design, threshold) -> np.ndarray:
+    """
+    K x N mask of the points whose first order approximation of the distance to each of the K conics is within threshold,
+    compared squared to avoid the division by the gradient
+    """
+    A, B, C, D, E = conics[:,:5].T
+    # gradient of the conic at every point as linear combination of (x, y, 1), the last 3 columns of the design matrix
+    linear = design[:,3:].T
+    grad_x = np.column_stack((2*A, B, D)) @ linear
+    grad_y = np.column_stack((B, 2*C, E)) @ linear
+    residual = conics @ design.T
+    return residual*residual <= threshold*threshold*(grad_x*grad_x + grad_y*grad_y)
+
+def _fit_conic_direct(x, y, weights=None) -> np.ndarray:
+    """ direct least squares ellipse fit of normalized coordinates, returns the conic coefficients (A,B,C,D,E,F) """
+    # quadratic and linear part of the design matrix
+    d1 = np.column_stack((x*x, x*y, y*y))
+    d2 = np.column_stack((x, y, np.ones_like(x)))
+    if weights is not None:
+        sqrt_w = np.sqrt(np.asarray(weights, dtype=np.float64))[:,None]
+        d1 *= sqrt_w
+        d2 *= sqrt_w
+    s1 = d1.T @ d1
+    s2 = d1.T @ d2
+    s3 = d2.T @ d2
+    try:
+        t = -np.linalg.solve(s3, s2.T)
+    except np.linalg.LinAlgError:
+        raise EllipseFitError('Singular scatter matrix')
+    m = s1 + s2 @ t
+    # premultiply with inverse of constraint matrix
+    m = np.array([m[2]/2, -m[1], m[0]/2])
+    eig_val, eig_vec = np.linalg.eig(m)
+    eig_vec = np.real(eig_vec)
+    cond = 4*eig_vec[0]*eig_vec[2] - eig_vec[1]**2
+    candidates = np.nonzero(cond > 0)[0]
+    if len(candidates) == 0:
+        raise EllipseFitError('No elliptical solution')
+    a1 = eig_vec[:, candidates[0]]
+    return np.concatenate((a1, t @ a1))
+
+def conic_to_ellipse(conic):
+    """
+    convert the coefficients of the conic Ax^2 + Bxy + Cy^2 + Dx + Ey + F = 0 to geometric ellipse parameters
+
+    :param conic: array of (A,B,C,D,E,F)
+    :raises EllipseFitError: if the conic is not an ellipse
+    :returns: ((x0,y0), (a,b), phi) with the semi-axes a,b and the tilt phi of axis a in rad
+    """
+    A, B, C, D, E, F = conic
+    disc = B*B - 4*A*C
+    if disc >= 0:
+        raise EllipseFitError('Conic is not an ellipse')
+    x0 = (2*C*D - B*E) / disc
+    y0 = (2*A*E - B*D) / disc
+    # constant term after moving origin to center
+    f0 = A*x0*x0 + B*x0*y0 + C*y0*y0 + D*x0 + E*y0 + F
+    eig_val, eig_vec = np.linalg.eigh(np.array([[A, B/2], [B/2, C]]))
+    axes_sq = -f0 / eig_val
+    if np.any(axes_sq <= 0):
+        raise EllipseFitError('Imaginary ellipse')
+    a, b = np.sqrt(axes_sq)
+    phi = atan2(eig_vec[1,0], eig_vec[0,0])
+    return (x0, y0), (a, b), phi
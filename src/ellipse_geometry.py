@@ -0,0 +1,163 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Vectorized droplet geometry for arrays of ellipse fits
+
+# Array versions of the calculations in evaluate_droplet, for batch reprocessing and parameter sweeps.
+# Ellipses are passed as N x 5 arrays of (x0,y0,a,b,phi) rows, with semi axes a,b and phi in rad,
+# baselines as scalar or array of N y coordinates. Fits without two intersections with the baseline
+# are marked invalid instead of raising, their values are NaN.
+
+from typing import Tuple
+import numpy as np
+
+DROPLET_METRICS_DTYPE = np.dtype([
+    ('valid',       np.bool_),
+    ('x_int_l',     np.float64),
+    ('x_int_r',     np.float64),
+    ('m_t_l',       np.float64),
+    ('m_t_r',       np.float64),
+    ('angle_l',     np.float64),
+    ('angle_r',     np.float64),
+    ('area',        np.float64),
+    ('height',      np.float64),
+])
+""" record layout returned by :func:`droplet_metrics`, angles in rad like :func:`evaluate_droplet.calc_droplet_metrics` """
+
+
+def _split(ellipse_pars) -> Tuple[np.ndarray,...]:
+    """ return the columns x0, y0, a, b, phi of an N x 5 array """
+    pars = np.asarray(ellipse_pars, dtype=np.float64)
+    if pars.ndim != 2 or pars.shape[1] != 5:
+        raise ValueError('Ellipse parameters have to be an N x 5 array of (x0,y0,a,b,phi)')
+    return tuple(pars.T)
+
+def half_heights(ellipse_pars) -> np.ndarray:
+    """
+    vertical distance from the center to the top and bottom of the ellipses
+
+    :param ellipse_pars: N x 5 array of (x0,y0,a,b,phi)
+    :returns: array of N half heights
+    """
+    _, _, a, b, phi = _split(ellipse_pars)
+    return np.sqrt((a*np.sin(phi))**2 + (b*np.cos(phi))**2)
+
+def intersect_horizontal(ellipse_pars, y_line) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    intersections of ellipses with horizontal lines
+
+    :param ellipse_pars: N x 5 array of (x0,y0,a,b,phi)
+    :param y_line: y coordinate of the lines, scalar or array of N
+    :returns: tuple of arrays (x_l, x_r, valid), x_l <= x_r are NaN where the line does not cross the ellipse twice
+    """
+    x0, y0, h, v, phi = _split(ellipse_pars)
+    # see evaluate_droplet.calc_intersection_line_ellipse
+    y = y_line - y0
+    cos_p, sin_p = np.cos(phi), np.sin(phi)
+    a = v**2 * cos_p**2 + h**2 * sin_p**2
+    b = 2*y*cos_p*sin_p * (v**2 - h**2)
+    c = y**2 * (v**2 * sin_p**2 + h**2 * cos_p**2) - (h**2 * v**2)
+    det = b**2 - 4*a*c
+    valid = det > 0
+    root = np.sqrt(np.where(valid, det, np.nan))
+    # a > 0 for non degenerate ellipses, so the first root is the left one
+    x_l = (-b - root)/(2*a) + x0
+    x_r = (-b + root)/(2*a) + x0
+    return x_l, x_r, valid
+
+def ellipse_slopes(ellipse_pars, x, y) -> np.ndarray:
+    """
+    slopes of the tangents at points on the ellipses
+
+    :param ellipse_pars: N x 5 array of (x0,y0,a,b,phi)
+    :param x: x coordinates of the points, array of N
+    :param y: y coordinates of the points, scalar or array of N
+    :returns: array of N slopes, +-inf for vertical tangents
+    """
+    x0, y0, a, b, phi = _split(ellipse_pars)
+    cos_p, sin_p = np.cos(phi), np.sin(phi)
+    # see evaluate_droplet.calc_slope_of_ellipse
+    x_rot = (x - x0)*cos_p + (y - y0)*sin_p
+    y_rot = (y - y0)*cos_p - (x - x0)*sin_p
+    tan_a = x_rot/a**2
+    tan_b = y_rot/b**2
+    tan_a_r = tan_a*cos_p - tan_b*sin_p
+    tan_b_r = tan_b*cos_p + tan_a*sin_p
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -(tan_a_r / tan_b_r)
+
+def contact_angles(m_t_l, m_t_r) -> Tuple[np.ndarray,np.ndarray]:
+    """
+    contact angles from the tangent slopes at the left and right contact points
+
+    :param m_t_l: array of slopes at the left contact points
+    :param m_t_r: array of slopes at the right contact points
+    :returns: tuple of arrays (angle_l, angle_r) in rad
+    """
+    angle_l = np.mod(np.pi - np.arctan(m_t_l), np.pi)
+    angle_r = np.mod(np.arctan(m_t_r) + np.pi, np.pi)
+    return angle_l, angle_r
+
+def cap_areas(ellipse_pars, y_base) -> np.ndarray:
+    """
+    area of the part of the ellipses above the baseline
+
+    the ellipse is mapped onto the unit circle, where the baseline cuts off a circular segment;
+    its area is scaled back by the product of the semi axes
+
+    :param ellipse_pars: N x 5 array of (x0,y0,a,b,phi)
+    :param y_base: y coordinate of the baseline, scalar or array of N
+    :returns: array of N areas in px^2, 0 if the ellipse is below and a*b*pi if it is above the baseline
+    """
+    _, y0, a, b, _ = _split(ellipse_pars)
+    # signed distance of the baseline from the center in the unit circle frame
+    d = np.clip((y_base - y0)/half_heights(ellipse_pars), -1.0, 1.0)
+    return a*b*(np.pi - np.arccos(d) + d*np.sqrt(1 - d**2))
+
+def cap_heights(ellipse_pars, y_base) -> np.ndarray:
+    """
+    distance between baseline and the top of the ellipses
+
+    :param ellipse_pars: N x 5 array of (x0,y0,a,b,phi)
+    :param y_base: y coordinate of the baseline, scalar or array of N
+    :returns: array of N heights in px
+    """
+    y0 = _split(ellipse_pars)[1]
+    return y_base - (y0 - half_heights(ellipse_pars))
+
+def droplet_metrics(ellipse_pars, y_base) -> np.ndarray:
+    """
+    calculate the droplet metrics of many ellipse fits at once, array version of :func:`evaluate_droplet.calc_droplet_metrics`
+
+    fits from :func:`evaluate_droplet.evaluate_droplet_batch` without tilted baseline can be passed as
+    `np.column_stack((res['center'], res['axes']/2, res['phi']))`
+
+    :param ellipse_pars: N x 5 array of (x0,y0,a,b,phi)
+    :param y_base: y coordinate of the baseline, scalar or array of N, eg. to sweep the baseline
+    :returns: structured array of :data:`DROPLET_METRICS_DTYPE`, entries without two baseline intersections are
+        not valid and NaN
+    """
+    x_l, x_r, valid = intersect_horizontal(ellipse_pars, y_base)
+    res = np.empty(len(x_l), dtype=DROPLET_METRICS_DTYPE)
+    res['valid'] = valid
+    res['x_int_l'] = x_l
+    res['x_int_r'] = x_r
+    res['m_t_l'] = ellipse_slopes(ellipse_pars, x_l, y_base)
+    res['m_t_r'] = ellipse_slopes(ellipse_pars, x_r, y_base)
+    res['angle_l'], res['angle_r'] = contact_angles(res['m_t_l'], res['m_t_r'])
+    res['area'] = np.where(valid, cap_areas(ellipse_pars, y_base), np.nan)
+    res['height'] = np.where(valid, cap_heights(ellipse_pars, y_base), np.nan)
+    return res
@@ -0,0 +1,385 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Staged droplet evaluation pipeline with swappable backends
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from math import floor, tan
+from types import FunctionType
+from typing import Any, Callable, Dict, List, Tuple
+import cv2
+import numpy as np
+
+from background_reference import BackgroundReference
+from baseline_detection import BaselineDetector, BASELINE_CROP_MARGIN, BASELINE_LEVEL_MIN_OFFSET, level_rect
+from droplet_tracker import DropletTracker, DropletMatcher
+from needle_detection import NeedleDetector
+from frame_buffers import FrameBuffers
+from threshold_manager import ThresholdManager
+
+STAGES = ('preprocess', 'edges', 'contour', 'fit', 'metrics')
+""" the stages of the evaluation pipeline in order of execution """
+
+DEFAULT_BACKENDS = {
+    'preprocess':   'crop',
+    'edges':        'canny',
+    'contour':      'largest',
+    'fit':          'ellipse',
+    'metrics':      'auto',
+}
+""" backends used if nothing else is configured, registered by :mod:`evaluate_droplet` """
+
+MULTI_CONTOUR_BACKEND = 'all'
+""" contour backend used in multi droplet mode, it has to store the contours of all droplets in extra `contours` """
+MULTI_DROPLET_THREADS = 4
+""" number of threads fitting the droplets in multi droplet mode """
+
+_BACKENDS: Dict[str, Dict[str, Callable]] = {stage: {} for stage in STAGES}
+
+
+class ContourError(Exception):
+    pass
+
+EVAL_ERRORS = (ContourError, cv2.error, ValueError, ZeroDivisionError)
+""" exceptions raised by backends if a frame could not be evaluated """
+
+
+def register_backend(stage, name):
+    """
+    decorator to register a function or class as backend for a pipeline stage
+
+    functions are called with (data, pipeline), classes are instantiated once per pipeline
+    and the instance is called the same way, so it can keep state between frames;
+    if the instance has a `reset` method it is called when the pipeline is reset
+
+    :param stage: one of :data:`STAGES`
+    :param name: name under which the backend can be selected
+    """
+    if stage not in STAGES:
+        raise KeyError(f'Unknown pipeline stage {stage}')
+    def decorator(backend):
+        _BACKENDS[stage][name] = backend
+        return backend
+    return decorator
+
+def available_backends(stage) -> List[str]:
+    """
+    return the names of all backends registered for a stage
+
+    :param stage: one of :data:`STAGES`
+    """
+    return list(_BACKENDS[stage].keys())
+
+
+class FrameData:
+    """
+    container for the intermediate results of a frame passed through the pipeline stages
+
+    - **img**: the full camera image
+    - **y_base**: y coordinate of the baseline, in the horizontal center of the image if it is tilted
+    - **tilt**: tilt of the baseline in rad; if not 0 preprocess replaces img by a leveled copy rotated around
+      (width/2, y_base), so all later stages work with a horizontal baseline, see :func:`baseline_detection.level_matrix`
+    - **y_crop**: row below the evaluated region, the integer baseline or a few rows above a detected baseline
+    - **mask**: needle mask as (x,y,w,h) or None, in leveled coordinates if the baseline is tilted
+    - **full_search**: set if a previous attempt on a restricted window failed, preprocess has to use the full image
+    - **window**: evaluated region as (x1,y1,x2,y2), set by preprocess
+    - **tracked**: whether the window is restricted to the surroundings of the droplet, eg. by the droplet tracker
+    - **crop**: image of the evaluated region, set by preprocess
+    - **thresholds**: (low, high) canny thresholds, set by preprocess
+    - **edges**: binary edge image of the evaluated region, set by edges
+    - **masked**: whether the needle mask crosses the droplet outline, so its contour may be split in two
+    - **contour**: droplet contour in image coordinates, set by contour
+    - **points**: optional N x 2 float array of refined contour points
+    - **weights**: optional per-point fit weights
+    - **ellipse**: fitted ellipse as ((x0,y0),(maj_ax,min_ax),phi_deg), set by ellipse fit backends
+    - **tangents**: optional ((x_l, m_l), (x_r, m_r)) contact points and tangent slopes, set by fit backends that do not fit an ellipse
+    - **metrics**: ((x_int_l, x_int_r), (m_t_l, m_t_r), (angle_l, angle_r), area, height), set by metrics
+    - **extra**: dict for additional backend specific results
+    """
+    __slots__ = ('img', 'y_base', 'tilt', 'y_crop', 'mask', 'full_search', 'window', 'tracked', 'crop', 'thresholds', 'edges', 'masked', 'contour',
+                 'points', 'weights', 'ellipse', 'tangents', 'metrics', 'extra')
+
+    def __init__(self, img, y_base, mask=None, tilt=0.0, y_crop=None):
+        self.img = img
+        self.y_base = y_base
+        self.tilt = tilt
+        self.y_crop: int = y_base if y_crop is None else y_crop
+        self.mask: Tuple[int,int,int,int] = mask
+        self.full_search = False
+        self.window: Tuple[int,int,int,int] = None
+        self.tracked = False
+        self.crop = None
+        self.thresholds: Tuple[float,float] = None
+        self.edges = None
+        self.masked = False
+        self.contour = None
+        self.points = None
+        self.weights = None
+        self.ellipse = None
+        self.tangents = None
+        self.metrics = None
+        self.extra: Dict[str, Any] = {}
+
+    def split(self, contour) -> 'FrameData':
+        """
+        copy of the data up to the contour stage for one of several droplets in the frame
+
+        :param contour: contour of the droplet, refined points are only kept if it is the contour of this frame
+        """
+        data = FrameData(self.img, self.y_base, self.mask, self.tilt, self.y_crop)
+        for name in ('full_search', 'window', 'tracked', 'crop', 'thresholds', 'edges', 'masked'):
+            setattr(data, name, getattr(self, name))
+        data.contour = contour
+        if contour is self.contour:
+            data.points = self.points
+        return data
+
+
+class EvaluationPipeline:
+    """
+    runs the droplet evaluation as sequence of stages: preprocess -> edges -> contour -> fit -> metrics
+
+    every stage uses one of the registered backends, which can be swapped at runtime with :meth:`set_backend`;
+    the duration of every stage is measured
+
+    :param track: if True, use a :class:`droplet_tracker.DropletTracker` to only search around the last droplet
+    :param auto_baseline: if True, detect the baseline in every frame, see :meth:`set_auto_baseline`
+    :param auto_needle: if True, detect the needle if no mask is passed, see :meth:`set_auto_needle`
+    :param multi_droplet: if True, keep the IDs of several droplets for :meth:`run_multi`, see :meth:`set_multi_droplet`
+    :param backends: backend names per stage, overriding :data:`DEFAULT_BACKENDS`
+    """
+    def __init__(self, track=True, auto_baseline=False, auto_needle=False, multi_droplet=False, **backends):
+        self.tracker: DropletTracker = DropletTracker() if track else None
+        self.baseline: BaselineDetector = BaselineDetector() if auto_baseline else None
+        """ detector of the substrate line or None if the passed baseline is used as is """
+        self.needle: NeedleDetector = NeedleDetector() if auto_needle else None
+        """ detector of the needle or None if only the passed mask is used """
+        self.multi: DropletMatcher = DropletMatcher() if multi_droplet else None
+        """ keeps the droplet IDs in multi droplet mode or None if a single droplet is evaluated """
+        self._executor: ThreadPoolExecutor = None
+        self.thresholds = ThresholdManager()
+        self.background = BackgroundReference()
+        """ droplet free reference frame used by the `background` edges backend, checked against every frame """
+        self.buffers = FrameBuffers()
+        """ image buffers reused by the backends, invalidate on image size change """
+        self.options: Dict[str, Any] = {}
+        """ backend parameters, see the individual backends """
+        self.backends: Dict[str, str] = {}
+        self._stage_fns: Dict[str, Callable] = {}
+        self.timings: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        """ duration of each stage for the last frame in s """
+        self._timing_sums: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        self._frame_count = 0
+        for stage in STAGES:
+            self.set_backend(stage, backends.get(stage, DEFAULT_BACKENDS[stage]))
+
+    def set_backend(self, stage, name):
+        """
+        select the backend of a stage
+
+        :param stage: one of :data:`STAGES`
+        :param name: name of a registered backend
+        :raises KeyError: if stage or backend is unknown
+        """
+        try:
+            backend = _BACKENDS[stage][name]
+        except KeyError:
+            raise KeyError(f'No backend {name} registered for stage {stage}')
+        self._stage_fns[stage] = backend() if isinstance(backend, type) else backend
+        self.backends[stage] = name
+        logging.debug(f"eval pipeline: using {name} for {stage}")
+
+    def configure(self, **kwargs):
+        """
+        set backends and options at once, keys that are a stage name select the backend, all others are stored in :attr:`options`
+        """
+        for key, value in kwargs.items():
+            if key in STAGES:
+                self.set_backend(key, value)
+            else:
+                self.options[key] = value
+
+    def set_auto_baseline(self, enabled):
+        """
+        enable or disable the automatic baseline detection
+
+        if enabled, the y_base passed to :meth:`run` is only used as hint for the first detection,
+        afterwards the line is refined in a narrow band around the last one; the detected baseline can be tilted
+        and lies between pixel rows, see :class:`baseline_detection.BaselineDetector`; a tilt that moves the baseline
+        less than :data:`baseline_detection.BASELINE_LEVEL_MIN_OFFSET` at the image border is ignored
+
+        :param enabled: True to detect the baseline
+        """
+        self.baseline = BaselineDetector() if enabled else None
+        self.reset()
+
+    def set_auto_needle(self, enabled):
+        """
+        enable or disable the automatic needle detection
+
+        if enabled, frames evaluated without mask are masked with the detected needle,
+        see :class:`needle_detection.NeedleDetector`
+
+        :param enabled: True to detect the needle
+        """
+        self.needle = NeedleDetector() if enabled else None
+        self.reset()
+
+    def set_multi_droplet(self, enabled):
+        """
+        enable or disable the multi droplet mode
+
+        if enabled, every droplet resting on the baseline is evaluated by :meth:`run_multi` and keeps its ID
+        as long as it does not move too far between frames, see :class:`droplet_tracker.DropletMatcher`
+
+        :param enabled: True to evaluate all droplets
+        """
+        self.multi = DropletMatcher() if enabled else None
+        if not enabled and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.reset()
+
+    def reset(self):
+        """ reset tracking, baseline, cached thresholds and stateful backends, eg. after ROI change """
+        if self.tracker is not None: self.tracker.reset()
+        if self.baseline is not None: self.baseline.reset()
+        if self.needle is not None: self.needle.reset()
+        if self.multi is not None: self.multi.reset()
+        self.thresholds.invalidate()
+        for fn in self._stage_fns.values():
+            if hasattr(fn, 'reset'): fn.reset()
+
+    def reset_timings(self):
+        """ clear the accumulated stage timings """
+        self._timing_sums = {stage: 0.0 for stage in STAGES}
+        self._frame_count = 0
+
+    @property
+    def average_timings(self) -> Dict[str, float]:
+        """ mean duration of each stage in s since the last :meth:`reset_timings` """
+        n = max(self._frame_count, 1)
+        return {stage: total / n for stage, total in self._timing_sums.items()}
+
+    def _prepare(self, img, y_base, mask) -> FrameData:
+        """ check the background reference, detect baseline and needle and return the data for the stages """
+        # drop the reference if the frame does not fit it anymore, eg. after exposure change
+        if self.background.image is not None: self.background.check(img)
+        tilt = 0.0
+        y_crop = y_base
+        if self.baseline is not None:
+            line = self.baseline.update(img, y_base)
+            # keep the passed baseline if the substrate was not found
+            if line is not None:
+                y_base, tilt = line
+                if abs(tan(tilt))*img.shape[1]/2 < BASELINE_LEVEL_MIN_OFFSET:
+                    tilt = 0.0
+                y_crop = int(floor(y_base - BASELINE_CROP_MARGIN))
+        if mask is None and self.needle is not None:
+            mask = self.needle.update(img, y_crop)
+        if mask is not None and tilt != 0:
+            mask = level_rect(mask, (img.shape[1]/2, y_base), tilt)
+        return FrameData(img, y_base, mask, tilt, y_crop)
+
+    def run(self, img, y_base, mask=None) -> FrameData:
+        """
+        evaluate a single frame
+
+        if the tracked search window did not yield a droplet, the frame is evaluated again on the full image
+
+        :param img: the image to be evaluated as np.ndarray
+        :param y_base: the y coordinate of the surface the droplet sits on, only a hint if the baseline is detected automatically
+        :param mask: needle mask as (x,y,w,h) tuple, if None and automatic needle detection is enabled the detected needle is masked
+        :raises ContourError: or other :data:`EVAL_ERRORS` if no droplet could be found
+        :returns: :class:`FrameData` with the results of all stages
+        """
+        data = self._prepare(img, y_base, mask)
+        try:
+            self._record(self._run_stages(data))
+        except EVAL_ERRORS:
+            if self.tracker is not None: self.tracker.reset()
+            if not data.tracked: raise
+            # lost droplet, retry with full image
+            data = FrameData(img, data.y_base, data.mask, data.tilt, data.y_crop)
+            data.full_search = True
+            self._record(self._run_stages(data))
+        if self.tracker is not None and data.contour is not None: self.tracker.update(data.contour)
+        return data
+
+    def run_multi(self, img, y_base, mask=None) -> Dict[int, FrameData]:
+        """
+        evaluate all droplets resting on the baseline of a frame
+
+        preprocess and edges run once on the full image, the contours are found by the :data:`MULTI_CONTOUR_BACKEND`,
+        fit and metrics run for every droplet; with stateless backends the droplets are fitted in a pool of
+        :data:`MULTI_DROPLET_THREADS` threads, stateful ones fit them one after the other and are reset before every droplet;
+        the timings of fit and metrics are summed up over all droplets
+
+        :param img: the image to be evaluated as np.ndarray
+        :param y_base: the y coordinate of the surface the droplets sit on, only a hint if the baseline is detected automatically
+        :param mask: needle mask as (x,y,w,h) tuple, if None and automatic needle detection is enabled the detected needle is masked
+        :raises ContourError: or other :data:`EVAL_ERRORS` if no contours could be found
+        :returns: dict of droplet ID to :class:`FrameData` for every droplet that could be evaluated, IDs are only
+            stable between frames if the multi droplet mode is enabled, otherwise they count from the left starting at 1
+        """
+        data = self._prepare(img, y_base, mask)
+        # the tracker follows a single droplet only
+        data.full_search = True
+        durations = self._run_stages(data, ('preprocess', 'edges'))
+        start = time.perf_counter()
+        _BACKENDS['contour'][MULTI_CONTOUR_BACKEND](data, self)
+        durations['contour'] = time.perf_counter() - start
+        drops = [data.split(contour) for contour in data.extra['contours']]
+        stateful = [fn for fn in (self._stage_fns['fit'], self._stage_fns['metrics']) if not isinstance(fn, FunctionType)]
+        def evaluate(drop: FrameData):
+            # the state of one droplet does not fit the next one, eg. the start values of a fit
+            for fn in stateful:
+                if hasattr(fn, 'reset'): fn.reset()
+            try:
+                return self._run_stages(drop, ('fit', 'metrics'))
+            except EVAL_ERRORS:
+                return None
+        if len(drops) > 1 and not stateful:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(MULTI_DROPLET_THREADS, thread_name_prefix='droplet_fit')
+            drop_durations = list(self._executor.map(evaluate, drops))
+        else:
+            drop_durations = [evaluate(drop) for drop in drops]
+        drops = [drop for drop, dur in zip(drops, drop_durations) if dur is not None]
+        for stage in ('fit', 'metrics'):
+            durations[stage] = sum(dur[stage] for dur in drop_durations if dur is not None)
+        self._record(durations)
+        centers = np.array([(x + w/2, y + h/2) for x, y, w, h in map(cv2.boundingRect, (drop.contour for drop in drops))]).reshape(-1,2)
+        ids = self.multi.match(centers) if self.multi is not None else range(1, len(drops) + 1)
+        return dict(zip(ids, drops))
+
+    def _run_stages(self, data: FrameData, stages=STAGES) -> Dict[str, float]:
+        """ execute the stages and return their durations """
+        durations = {}
+        for stage in stages:
+            start = time.perf_counter()
+            self._stage_fns[stage](data, self)
+            durations[stage] = time.perf_counter() - start
+        return durations
+
+    def _record(self, durations: Dict[str, float]):
+        """ record the stage durations of an evaluated frame """
+        for stage, duration in durations.items():
+            self.timings[stage] = duration
+            self._timing_sums[stage] += duration
+        self._frame_count += 1
@@ -16,15 +16,24 @@
 
 # Droplet eval function
 
-# TODO add rolling average, with outlier ingoring and 1 sec worth of averaging
-# ideally to the whole contour before fitting the ellipse
-
-from math import acos, cos, sin, pi, sqrt, atan2, radians, degrees
-from typing import Tuple
+from math import acos, cos, sin, pi, sqrt, atan2, radians, degrees, ceil
+from typing import Dict, List, Tuple
 import cv2
 import numpy as np
 
 from droplet import Droplet
+from eval_pipeline import ContourError, EVAL_ERRORS, EvaluationPipeline, FrameData, register_backend
+from frame_buffers import FrameBuffers
+from background_reference import BACKGROUND_MIN_DIFF
+from baseline_detection import level_matrix, unlevel_points, unlevel_slope
+from droplet_tracker import DropletTracker, TRACKER_PADDING
+from threshold_manager import calc_otsu_thresholds
+from ellipse_fit import (GRADIENT_MARGIN, RANSAC_ITERATIONS, RANSAC_THRESHOLD, EllipseFitError, subpixel_edge_points, calc_baseline_weights,
+                         fit_ellipse_direct, fit_ellipse_ransac)
+from scanline_edges import SCANLINE_MIN_CONTRAST, scan_profile
+from tangent_fit import TANGENT_FIT_DISTANCE, TANGENT_FIT_MARGIN, TANGENT_FIT_ORDER, TANGENT_FIT_SUBPIXEL, split_sides, fit_contact_tangent
+import young_laplace # registers young_laplace fit backend
+import profile_library # registers young_laplace_lookup fit backend
 
 DBG_NONE = 0x0
 DBG_SHOW_CONTOURS = 0x1
@@ -32,185 +41,834 @@ DBG_DRAW_ELLIPSE = 0x2
 DBG_DRAW_TAN_ANGLE = 0x4
 DEBUG = DBG_NONE
 
-USE_GPU = False
+BASELINE_WEIGHT_DECAY = 0
+""" default for pipeline option `baseline_weight_decay` of the `ellipse_subpixel` fit: distance in px from the baseline over which the point weights drop to 1/e, 0 disables weighting """
+
+CANNY_BLUR = 0
+""" default for pipeline option `canny_blur` of the `canny` edges backends: size of the gaussian blur before edge detection, 0 disables it """
+
+FIT_BAND_HEIGHT = 0
+""" default for pipeline option `fit_band_height` of the ellipse fits: only contour points up to this distance in px above the baseline are fitted, 0 fits the whole contour """
+
+CONTOUR_LABEL_DENSITY = 0.02
+""" fraction of edge pixels above which :func:`find_contour` labels connected edges instead of tracing all contours """
+
+MULTI_MIN_WIDTH = 20
+""" default for pipeline option `multi_min_width` of the `all` contour backend: min width in px of a droplet """
+# max distance in px between the lowest point of a contour and the baseline for the droplet to rest on it
+MULTI_BASE_MARGIN = 3
+
+PYRAMID_LEVELS = 2
+""" default for pipeline option `pyramid_levels` of the `pyramid` preprocess backend, the droplet is located on an image downsampled by 2^levels """
+
+PROFILE_VOLUME = True
+""" default for pipeline option `profile_volume` of the metrics backends: integrate volume and surface from the profile, disable it if they are not recorded """
 
-class ContourError(Exception):
-    pass
+BATCH_CHUNK_SIZE = 1024
+""" number of entries the result array of :func:`evaluate_droplet_batch` grows by if the frame count is unknown """
 
+DROPLET_RESULT_DTYPE = np.dtype([
+    ('valid',       np.bool_),
+    ('angle_l',     np.float64),
+    ('angle_r',     np.float64),
+    ('base_diam',   np.float64),
+    ('area',        np.float64),
+    ('height',      np.float64),
+    ('center',      np.float64, (2,)),
+    ('axes',        np.float64, (2,)),
+    ('phi',         np.float64),
+    ('base_y',      np.float64),
+    ('base_tilt',   np.float64),
+    ('inlier_ratio', np.float64),
+    ('volume',      np.float64),
+    ('surface',     np.float64),
+])
+""" record layout of a single frame result, angles in deg, axes are the full major and minor axis lengths, phi and base_tilt in rad """
+
+_INVALID_RESULT = (False, np.nan, np.nan, np.nan, np.nan, np.nan, (np.nan, np.nan), (np.nan, np.nan), np.nan, np.nan, np.nan, np.nan, np.nan, np.nan)
+
+
+class DropletResult:
+    """
+    immutable result of the evaluation of a single frame, see :func:`evaluate_droplet_result`
+
+    has the same attributes as :class:`droplet.Droplet`, but without filtering:
+
+    - **angle_l**, **angle_r**: left and right tangent angles in deg
+    - **center**: center point of fitted ellipse (x,y)
+    - **maj**, **min**: length of major and minor ellipse axis
+    - **phi**: tilt of ellipse in rad, relative to the image x axis
+    - **foc_pt1**, **foc_pt2**: focal points of ellipse (x,y)
+    - **tan_l_m**, **tan_r_m**: slope of left and right tangent
+    - **int_l**, **int_r**: left and right intersections of droplet with baseline
+    - **line_l**, **line_r**: left and right tangent as 4-Tuple (x1,y1,x2,y2)
+    - **base_diam**: diameter of the contact surface of droplet
+    - **base_y**: y coordinate of the baseline in the horizontal center of the image
+    - **base_tilt**: tilt of the baseline in rad, angles are measured relative to the baseline
+    - **area**: area of droplet silouette in px^2
+    - **height**: droplet height in px
+    - **volume**: droplet volume in px^3, from the model of the fit method if it has one, else from the profile assuming rotational symmetry
+    - **surface**: liquid-air surface area of the droplet in px^2 from the profile, assuming rotational symmetry
+    - **cap_length**: capillary length in px, 0 if not determined by the fit method
+    - **inlier_ratio**: fraction of the contour points the fit is based on, 1 unless a robust fit method is used
+    """
+    __slots__ = ('angle_l', 'angle_r', 'center', 'maj', 'min', 'phi', 'foc_pt1', 'foc_pt2', 'tan_l_m', 'tan_r_m',
+                 'int_l', 'int_r', 'line_l', 'line_r', 'base_diam', 'base_y', 'base_tilt', 'area', 'height', 'volume', 'surface',
+                 'cap_length', 'inlier_ratio')
 
-def evaluate_droplet(img, y_base, mask: Tuple[int,int,int,int] = None) -> Droplet:
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DropletResult is immutable')
+
+    def __repr__(self) -> str:
+        return 'DropletResult(' + ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__) + ')'
+
+    @property
+    def tilt_deg(self) -> float:
+        """ tilt of ellipse in deg """
+        return degrees(self.phi)
+
+    def to_record(self) -> tuple:
+        """ return the result as entry of :data:`DROPLET_RESULT_DTYPE` """
+        return (True, self.angle_l, self.angle_r, self.base_diam, self.area, self.height, self.center, (self.maj, self.min), self.phi,
+                self.base_y, self.base_tilt, self.inlier_ratio, self.volume, self.surface)
+
+
+def evaluate_droplet(img, y_base, mask: Tuple[int,int,int,int] = None, pipeline: EvaluationPipeline = None, timestamp=None) -> Droplet:
     """ 
-    Analyze an image for a droplet and determine the contact angles
+    Analyze an image for a droplet and determine the contact angles, results are written into the :class:`droplet.Droplet` singleton
 
     :param img: the image to be evaluated as np.ndarray
     :param y_base: the y coordinate of the surface the droplet sits on
+    :param mask: needle mask as (x,y,w,h) tuple
+    :param pipeline: the :class:`eval_pipeline.EvaluationPipeline` to use, keeps tracking and threshold state between frames;
+        if omitted a pipeline with default backends and without tracking is used
+    :param timestamp: time the image was taken in s, used by the kalman filter mode of the droplet, the current time if None
     :returns: a Droplet() object with all the informations
+
+    .. seealso:: :func:`evaluate_droplet_result` for evaluation without side effects
     """
+    if pipeline is None:
+        pipeline = EvaluationPipeline(track=False)
+    data = pipeline.run(img, y_base, mask)
+    result = _make_result(data, img.shape[0])
+    if DEBUG != DBG_NONE:
+        _draw_debug(img, data, result)
     drplt = Droplet()
-    # crop img from baseline down (contains no useful information)
-    crop_img = img[:y_base,:]
-    shape = img.shape
-    height = shape[0]
-    width = shape[1]
-    if USE_GPU:
-        crop_img = cv2.UMat(crop_img)
-    # calculate thrresholds
-    thresh_high, thresh_im = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    thresh_low = 0.5*thresh_high
-    # thresh_high = 179
-    # thresh_low = 76
+    drplt.update(result, timestamp)
+    return drplt
 
-    # values only for 8bit images!
+def evaluate_droplet_result(img, y_base, mask: Tuple[int,int,int,int] = None, pipeline: EvaluationPipeline = None) -> DropletResult:
+    """
+    Analyze an image for a droplet and determine the contact angles without touching any global state
 
-    # apply canny filter to image
-    # FIXME adjust canny params, detect too much edges
-    bw_edges = cv2.Canny(crop_img, thresh_low, thresh_high)
-    
-    # block detection of syringe
-    if (not mask is None):
-        x,y,w,h = mask
-        bw_edges[:, x:x+w] = 0
-        #img[:, x:x+w] = 0
-        masked = True
-    else:
-        masked = False
+    Only the passed pipeline is modified, so frames can be evaluated in worker threads with one pipeline per thread.
+    Filtering of the results is up to the caller, eg. with :meth:`droplet.Droplet.update`.
 
-    edge = find_contour(bw_edges, masked)
+    :param img: the image to be evaluated as np.ndarray
+    :param y_base: the y coordinate of the surface the droplet sits on
+    :param mask: needle mask as (x,y,w,h) tuple
+    :param pipeline: the :class:`eval_pipeline.EvaluationPipeline` to use, if omitted a pipeline with default backends and without tracking is used
+    :raises ContourError: or other :data:`eval_pipeline.EVAL_ERRORS` if no droplet could be found
+    :returns: :class:`DropletResult` of the frame
+    """
+    if pipeline is None:
+        pipeline = EvaluationPipeline(track=False)
+    return _make_result(pipeline.run(img, y_base, mask), img.shape[0])
 
-    if USE_GPU:
-        # fetch contours from gpu memory
-        # cntrs = [cv2.UMat.get(c) for c in contours]
-        edge = cv2.UMat.get(edge)
-        if DEBUG & DBG_SHOW_CONTOURS:
-            # img = cv2.drawContours(img,cntrs,-1,(100,100,255),2)
-            img = cv2.drawContours(img,edge,-1,(255,0,0),2)
+def evaluate_droplets_result(img, y_base, mask: Tuple[int,int,int,int] = None, pipeline: EvaluationPipeline = None) -> Dict[int, DropletResult]:
+    """
+    Analyze an image for all droplets resting on the baseline without touching any global state,
+    see :meth:`eval_pipeline.EvaluationPipeline.run_multi`
 
-    # apply ellipse fitting algorithm to droplet
-    (x0,y0), (maj_ax,min_ax), phi_deg = cv2.fitEllipse(edge)
+    :param img: the image to be evaluated as np.ndarray
+    :param y_base: the y coordinate of the surface the droplets sit on
+    :param mask: needle mask as (x,y,w,h) tuple
+    :param pipeline: the :class:`eval_pipeline.EvaluationPipeline` to use, keeps the droplet IDs between frames if its
+        multi droplet mode is enabled; if omitted a pipeline with default backends is used and the IDs count from the left
+    :raises ContourError: or other :data:`eval_pipeline.EVAL_ERRORS` if no contours could be found
+    :returns: dict of droplet ID to :class:`DropletResult` for every droplet that could be evaluated
+    """
+    if pipeline is None:
+        pipeline = EvaluationPipeline(track=False)
+    return {drop_id: _make_result(data, img.shape[0]) for drop_id, data in pipeline.run_multi(img, y_base, mask).items()}
+
+def _make_result(data: FrameData, img_height) -> DropletResult:
+    """
+    build the result from the pipeline output, tangent lines are extended over the full image height;
+    positions evaluated in the leveled frame of a tilted baseline are transformed back to image coordinates
+    """
+    y_base = data.y_base
+    (x_int_l, x_int_r), (m_t_l, m_t_r), (angle_l, angle_r), area, drplt_height = data.metrics
+    if data.ellipse is not None:
+        (x0,y0), (maj_ax,min_ax), phi_deg = data.ellipse
+    else:
+        # fit backend without ellipse model, nothing to draw
+        (x0,y0), (maj_ax,min_ax), phi_deg = ((x_int_l + x_int_r)/2, y_base), (0,0), 0
     phi = radians(phi_deg)
-    a = maj_ax/2
-    b = min_ax/2
-
-    # diesen fit vllt zum laufen bringen https://scikit-image.org/docs/0.15.x/api/skimage.measure.html
-    #points = edge.reshape(-1,2)
-    #points[:,[0,1]] = points[:,[1,0]]
-    # ell = EllipseModel()
-    # if not ell.estimate(points): raise RuntimeError('Couldn\'t fit ellipse')
-    # x0, y0, a, b, phi = ell.params
-    # maj_ax = 2*a
-    # min_ax = 2*b
-    # phi_deg = degrees(phi)
+    foc_len = sqrt(abs(maj_ax**2 - min_ax**2))/2
+    points = ((x0, y0), (x0 + foc_len*cos(phi), y0 + foc_len*sin(phi)), (x0 - foc_len*cos(phi), y0 - foc_len*sin(phi)),
+              (x_int_l, y_base), (x_int_r, y_base))
+    if data.tilt != 0:
+        points = tuple(map(tuple, unlevel_points(points, (data.img.shape[1]/2, y_base), data.tilt)))
+        phi += data.tilt
+        m_t_l, m_t_r = unlevel_slope(m_t_l, data.tilt), unlevel_slope(m_t_r, data.tilt)
+    center, foc_pt1, foc_pt2, int_l, int_r = points
+    return DropletResult(
+        angle_l     = degrees(angle_l),
+        angle_r     = degrees(angle_r),
+        center      = center,
+        maj         = maj_ax,
+        min         = min_ax,
+        phi         = phi,
+        foc_pt1     = foc_pt1,
+        foc_pt2     = foc_pt2,
+        tan_l_m     = m_t_l,
+        tan_r_m     = m_t_r,
+        int_l       = int_l,
+        int_r       = int_r,
+        line_l      = (int_l[0] - int_l[1]/m_t_l, 0, int_l[0] + (img_height - int_l[1])/m_t_l, img_height),
+        line_r      = (int_r[0] - int_r[1]/m_t_r, 0, int_r[0] + (img_height - int_r[1])/m_t_r, img_height),
+        base_diam   = x_int_r - x_int_l,
+        base_y      = y_base,
+        base_tilt   = data.tilt,
+        area        = area,
+        height      = drplt_height,
+        volume      = data.extra.get('volume', 0.0),
+        surface     = data.extra.get('surface', 0.0),
+        cap_length  = data.extra.get('cap_length', 0.0),
+        inlier_ratio= data.extra.get('inlier_ratio', 1.0),
+    )
+
+def _draw_debug(img, data: FrameData, result: DropletResult):
+    """ draw contour, ellipse and tangents into the image according to :data:`DEBUG` """
+    height, width = img.shape[:2]
+    if DEBUG & DBG_SHOW_CONTOURS:
+        img = cv2.drawContours(img,data.contour,-1,(255,0,0),2)
 
+    (x0, y0), a, b, phi = result.center, result.maj/2, result.min/2, result.phi
     if DEBUG & DBG_DRAW_ELLIPSE:
         img = cv2.ellipse(img, (int(round(x0)),int(round(y0))), (int(round(a)),int(round(b))), int(round(phi*180/pi)), 0, 360, (255,0,255), thickness=1, lineType=cv2.LINE_AA)
         #img = cv2.ellipse(img, (int(round(x0)),int(round(y0))), (int(round(a)),int(round(b))), 0, 0, 360, (0,0,255), thickness=1, lineType=cv2.LINE_AA)
 
+    if DEBUG & DBG_DRAW_TAN_ANGLE:
+        # painting
+        (x_int_l, _), (x_int_r, _) = result.int_l, result.int_r
+        m_t_l, m_t_r = result.tan_l_m, result.tan_r_m
+        angle_l, angle_r = radians(result.angle_l), radians(result.angle_r)
+        y_int = int(round(data.y_base))
+        img = cv2.line(img, (int(round(x_int_l - (y_int/m_t_l))), 0), (int(round(x_int_l + ((height - y_int)/m_t_l))), int(round(height))), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
+        img = cv2.line(img, (int(round(x_int_r - (y_int/m_t_r))), 0), (int(round(x_int_r + ((height - y_int)/m_t_r))), int(round(height))), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
+        img = cv2.ellipse(img, (int(round(x_int_l)),y_int), (20,20), 0, 0, -int(round(angle_l*180/pi)), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
+        img = cv2.ellipse(img, (int(round(x_int_r)),y_int), (20,20), 0, 180, 180 + int(round(angle_r*180/pi)), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
+        img = cv2.line(img, (0,y_int), (width, y_int), (255,0,0), thickness=2, lineType=cv2.LINE_AA)
+        img = cv2.putText(img, '<' + str(round(angle_l*180/pi,1)), (5,y_int-5), cv2.FONT_HERSHEY_COMPLEX, .5, (0,0,0))
+        img = cv2.putText(img, '<' + str(round(angle_r*180/pi,1)), (width - 80,y_int-5), cv2.FONT_HERSHEY_COMPLEX, .5, (0,0,0))
+
+def evaluate_droplet_batch(frames, y_base, mask: Tuple[int,int,int,int] = None, pipeline: EvaluationPipeline = None) -> np.ndarray:
+    """
+    Analyze a stack of images for droplets without going through the :class:`droplet.Droplet` singleton
+
+    Intended for offline re-evaluation of recordings, all results are written into one preallocated array.
+    Frames that cannot be evaluated are marked with `valid` = False and contain NaN.
+
+    :param frames: N x H x W (x 1) image stack as np.ndarray or an iterable yielding single images
+    :param y_base: the y coordinate of the surface the droplet sits on, used for all frames
+    :param mask: needle mask as (x,y,w,h) tuple, used for all frames
+    :param pipeline: the :class:`eval_pipeline.EvaluationPipeline` to use, if omitted a tracking pipeline with default backends is used
+    :returns: structured array of :data:`DROPLET_RESULT_DTYPE` with one entry per frame
+    """
+    try:
+        size = len(frames)
+    except TypeError:
+        # plain iterator, grow result array in chunks
+        size = BATCH_CHUNK_SIZE
+    results = np.empty(size, dtype=DROPLET_RESULT_DTYPE)
+    if pipeline is None:
+        pipeline = EvaluationPipeline(track=True)
+    count = 0
+    for frame in frames:
+        if count == len(results):
+            results = np.concatenate((results, np.empty(BATCH_CHUNK_SIZE, dtype=DROPLET_RESULT_DTYPE)))
+        try:
+            data = pipeline.run(frame, y_base, mask)
+            (x0,y0), (maj_ax,min_ax), phi_deg = data.ellipse if data.ellipse is not None else ((np.nan,np.nan), (np.nan,np.nan), np.nan)
+            (x_int_l, x_int_r), _, (angle_l, angle_r), area, drplt_height = data.metrics
+            phi = radians(phi_deg)
+            if data.tilt != 0:
+                (x0,y0), = unlevel_points(((x0,y0),), (data.img.shape[1]/2, data.y_base), data.tilt)
+                phi += data.tilt
+            results[count] = (True, degrees(angle_l), degrees(angle_r), x_int_r - x_int_l, area, drplt_height, (x0,y0), (maj_ax,min_ax), phi,
+                              data.y_base, data.tilt, data.extra.get('inlier_ratio', 1.0), data.extra.get('volume', 0.0),
+                              data.extra.get('surface', 0.0))
+        except EVAL_ERRORS:
+            results[count] = _INVALID_RESULT
+        count += 1
+    return results[:count]
+
+### pipeline backends ###
+
+@register_backend('preprocess', 'crop')
+def preprocess_crop(data: FrameData, pipeline: EvaluationPipeline):
+    """ crop the image from the baseline down or to the tracked window and determine the canny thresholds on that region """
+    width = data.img.shape[1]
+    window = pipeline.tracker.get_window(width, data.y_crop) if pipeline.tracker is not None else None
+    set_window(data, pipeline, window)
+
+@register_backend('preprocess', 'pyramid')
+def preprocess_pyramid(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    like :func:`preprocess_crop`, but if no tracked window is available, the droplet is first located on a downsampled image
+    and only its surroundings are evaluated in full resolution, see :func:`locate_droplet`
+
+    option `pyramid_levels`: number of times the image is downsampled by 2
+    """
+    width = data.img.shape[1]
+    window = pipeline.tracker.get_window(width, data.y_crop) if pipeline.tracker is not None else None
+    if window is None and not data.full_search:
+        levels = pipeline.options.get('pyramid_levels', PYRAMID_LEVELS)
+        window = locate_droplet(data.img, data.y_crop, data.mask, levels, tilt=data.tilt)
+    set_window(data, pipeline, window)
+
+def set_window(data: FrameData, pipeline: EvaluationPipeline, window):
+    """
+    set the evaluated region to the window or the full image above the baseline if None, crop the image and determine the thresholds;
+    with a tilted baseline the region is leveled first, see :func:`level_window`
+    """
+    width = data.img.shape[1]
+    data.tracked = window is not None
+    # crop img from baseline down (contains no useful information)
+    data.window = window if window is not None else (0, 0, width, data.y_crop)
+    if data.tilt != 0:
+        level_window(data, pipeline.buffers)
+    x1, y1, x2, y2 = data.window
+    data.crop = data.img[y1:y2, x1:x2]
+    # calculate thrresholds on evaluated region only
+    data.thresholds = pipeline.thresholds.get_thresholds(data.crop)
+    # thresh_high = 179
+    # thresh_low = 76
+
+def level_window(data: FrameData, buffers: FrameBuffers):
+    """
+    rotate the image so the baseline is horizontal and replace data.img by the result
+
+    only the window and a small margin for the sub-pixel refinement are transformed,
+    the rest of the leveled image is undefined
+    """
+    data.img = _level_region(data.img, data, buffers, 'leveled')
+
+def _level_region(img, data: FrameData, buffers: FrameBuffers, name) -> np.ndarray:
+    """ rotate the window of img and a small margin into the buffer name and return the full size buffer """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    height, width = img.shape
+    x1, y1, x2, y2 = data.window
+    x1, y1 = max(x1 - GRADIENT_MARGIN, 0), max(y1 - GRADIENT_MARGIN, 0)
+    x2, y2 = min(x2 + GRADIENT_MARGIN, width), min(y2 + GRADIENT_MARGIN, height)
+    leveled = buffers.get(name, (height, width))
+    cv2.warpAffine(img, level_matrix((width/2, data.y_base), data.tilt, (x1, y1)), (x2 - x1, y2 - y1), dst=leveled[y1:y2, x1:x2],
+                   flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+    return leveled
+
+@register_backend('edges', 'canny')
+def edges_canny(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    canny filter on the cropped region, needle is masked out afterwards
+
+    option `canny_blur`: size of a gaussian blur applied before, 0 disables it; see :mod:`canny_tuning` for the thresholds
+    """
+    crop = data.crop
+    blur = pipeline.options.get('canny_blur', CANNY_BLUR)
+    if blur > 1:
+        crop = cv2.GaussianBlur(crop, (blur, blur), 0, dst=pipeline.buffers.get('blurred', crop.shape[:2]))
+    data.edges = cv2.Canny(crop, *data.thresholds, edges=pipeline.buffers.get('edges', data.crop.shape[:2]))
+    mask_needle(data)
+
+@register_backend('edges', 'canny_gpu')
+def edges_canny_gpu(data: FrameData, pipeline: EvaluationPipeline):
+    """ canny filter using the opencv transparent API, runs on the GPU if OpenCL is available; option `canny_blur` as for `canny` """
+    crop = cv2.UMat(data.crop)
+    blur = pipeline.options.get('canny_blur', CANNY_BLUR)
+    if blur > 1:
+        crop = cv2.GaussianBlur(crop, (blur, blur), 0)
+    data.edges = cv2.Canny(crop, *data.thresholds).get()
+    mask_needle(data)
+
+@register_backend('edges', 'background')
+def edges_background(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    segment the droplet from the difference to the background reference and take the outline of the segmented region as edges,
+    see :class:`background_reference.BackgroundReference`; without valid reference :func:`edges_canny` is used
+
+    option `background_min_diff`: min difference in gray values to the reference of a droplet pixel,
+    the otsu threshold of the difference image is used if it is higher
+    """
+    ref = pipeline.background.image
+    if ref is None:
+        edges_canny(data, pipeline)
+        return
+    x1, y1, x2, y2 = data.window
+    if data.tilt != 0:
+        ref = _level_region(ref, data, pipeline.buffers, 'leveled_background')
+    crop = data.crop if data.crop.ndim == 2 else data.crop[:,:,0]
+    diff = cv2.absdiff(crop, ref[y1:y2, x1:x2], dst=pipeline.buffers.get('difference', crop.shape))
+    segmented = pipeline.buffers.get('segmented', crop.shape)
+    thresh, _ = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=segmented)
+    min_diff = pipeline.options.get('background_min_diff', BACKGROUND_MIN_DIFF)
+    if thresh < min_diff:
+        cv2.threshold(diff, min_diff, 255, cv2.THRESH_BINARY, dst=segmented)
+    data.edges = cv2.Canny(segmented, 127, 255, edges=pipeline.buffers.get('edges', crop.shape))
+    mask_needle(data)
+
+@register_backend('edges', 'scanline')
+def edges_scanline(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    droplet outline from scanlines between apex and baseline instead of an edge image, see :func:`scanline_edges.scan_profile`;
+    sets the sub-pixel points and the contour directly, so the contour stage only checks it
+
+    option `scanline_min_contrast`: min difference in gray values between droplet and background
+    """
+    x1, y1, x2, y2 = data.window
+    mask = None
+    if data.mask is not None:
+        x,y,w,h = data.mask
+        mask = (x - x1, y - y1, w, h)
+    min_contrast = pipeline.options.get('scanline_min_contrast', SCANLINE_MIN_CONTRAST)
+    points, clipped = scan_profile(data.crop, mask, min_contrast)
+    if data.tracked and clipped:
+        raise ContourError('Droplet left tracking window')
+    if len(points) < 5:
+        raise ContourError('Not enough edge points found')
+    points += (x1, y1)
+    data.points = points
+    data.contour = np.round(points).astype(np.int32).reshape(-1,1,2)
+
+def mask_needle(data: FrameData):
+    """
+    block detection of syringe by clearing the masked region of the edge image
+
+    only the rows of the mask are cleared, so a mask limited to the needle does not cut off the droplet below it;
+    data.masked is set if edges continue on both sides of the cleared region, ie. the mask crosses the droplet outline
+    """
+    data.masked = False
+    if data.mask is None:
+        return
+    x1, y1, x2, y2 = data.window
+    x,y,w,h = data.mask
+    c1, c2 = max(x - x1, 0), min(x + w - x1, x2 - x1)
+    r1, r2 = max(y - y1, 0), min(y + h - y1, y2 - y1)
+    if c1 >= c2 or r1 >= r2:
+        return
+    data.edges[r1:r2, c1:c2] = 0
+    # columns next to the cleared region including the row below it, which touches its lower corners
+    r3 = min(r2 + 1, y2 - y1)
+    data.masked = (c1 > 0 and cv2.countNonZero(data.edges[r1:r3, c1 - 1]) > 0
+                   and c2 < x2 - x1 and cv2.countNonZero(data.edges[r1:r3, c2]) > 0)
+
+@register_backend('contour', 'largest')
+def contour_largest(data: FrameData, pipeline: EvaluationPipeline):
+    """ select the contour with the largest bounding rect, see :func:`find_contour`; keeps a contour set by the edges backend """
+    x1, y1, x2, y2 = data.window
+    if data.contour is None:
+        data.contour = find_contour(data.edges, data.masked, (x1, y1), pipeline.buffers)
+    if data.tracked and DropletTracker.touches_border(data.contour, data.window, data.img.shape[1], data.y_base):
+        raise ContourError('Droplet left tracking window')
+
+def _in_fit_band(points, data: FrameData, pipeline: EvaluationPipeline) -> np.ndarray:
+    """
+    select the points within option `fit_band_height` above the baseline, the apex and a needle above the band are not fitted;
+    a band much lower than the droplet leaves too little curvature for a stable ellipse
+
+    :param points: contour as returned by cv2.findContours or N x 2 array of points
+    :raises ContourError: if less than 5 points are left for the fit
+    :returns: the selected points in the same format
+    """
+    band = pipeline.options.get('fit_band_height', FIT_BAND_HEIGHT)
+    if band <= 0:
+        return points
+    points = points[points.reshape(-1,2)[:,1] >= data.y_base - band]
+    if len(points) < 5:
+        raise ContourError('Not enough contour points in fit band')
+    return points
+
+def _fit_points(data: FrameData, pipeline: EvaluationPipeline) -> np.ndarray:
+    """
+    sub-pixel refined points within the fit band, points already refined by the edges backend are used as they are;
+    the refined contour is kept in `data.points` as profile of the droplet unless only the band was refined
+    """
+    if data.points is not None:
+        return _in_fit_band(data.points, data, pipeline)
+    if pipeline.options.get('fit_band_height', FIT_BAND_HEIGHT) > 0:
+        return subpixel_edge_points(data.img, _in_fit_band(data.contour, data, pipeline))
+    data.points = subpixel_edge_points(data.img, data.contour)
+    return data.points
+
+@register_backend('contour', 'all')
+def contour_all(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    find the contours of all droplets resting on the baseline, see :func:`find_droplet_contours`;
+    they are stored in extra `contours` from left to right, the widest one is the contour of the frame;
+    a contour set by the edges backend is the only one
+
+    option `multi_min_width`: min width of a droplet in px
+    """
+    if data.contour is None:
+        min_width = pipeline.options.get('multi_min_width', MULTI_MIN_WIDTH)
+        x1, y1, x2, y2 = data.window
+        contours = find_droplet_contours(data.edges, y2 - y1, (x1, y1), data.mask, min_width, pipeline.buffers)
+        data.contour = max(contours, key=lambda contour: np.ptp(contour[:,:,0]))
+        data.extra['contours'] = contours
+    else:
+        data.extra['contours'] = [data.contour]
+
+@register_backend('fit', 'ellipse')
+def fit_ellipse(data: FrameData, pipeline: EvaluationPipeline):
+    """ least squares ellipse fit with cv2.fitEllipse, option `fit_band_height` as for `ellipse_subpixel` """
+    data.ellipse = cv2.fitEllipse(_in_fit_band(data.contour, data, pipeline))
+
+@register_backend('fit', 'ellipse_direct')
+def fit_ellipse_cv_direct(data: FrameData, pipeline: EvaluationPipeline):
+    """ direct least squares ellipse fit with cv2.fitEllipseDirect, option `fit_band_height` as for `ellipse_subpixel` """
+    data.ellipse = cv2.fitEllipseDirect(_in_fit_band(data.contour, data, pipeline))
+
+@register_backend('fit', 'ellipse_ams')
+def fit_ellipse_ams(data: FrameData, pipeline: EvaluationPipeline):
+    """ approximate mean square ellipse fit with cv2.fitEllipseAMS, option `fit_band_height` as for `ellipse_subpixel` """
+    data.ellipse = cv2.fitEllipseAMS(_in_fit_band(data.contour, data, pipeline))
+
+@register_backend('fit', 'ellipse_subpixel')
+def fit_ellipse_subpixel(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    refine the contour to sub-pixel precision and fit with :func:`ellipse_fit.fit_ellipse_direct`,
+    points already refined by the edges backend are used as they are
+
+    option `baseline_weight_decay`: weight points by distance to baseline, see :func:`ellipse_fit.calc_baseline_weights`;
+    option `fit_band_height`: only fit the points close to the baseline, see :func:`_in_fit_band`
+    """
+    points = _fit_points(data, pipeline)
+    decay = pipeline.options.get('baseline_weight_decay', BASELINE_WEIGHT_DECAY)
+    if decay > 0:
+        data.weights = calc_baseline_weights(points, data.y_base, decay)
+    try:
+        data.ellipse = fit_ellipse_direct(points, data.weights)
+    except EllipseFitError as ex:
+        raise ContourError(str(ex))
+
+@register_backend('fit', 'ellipse_ransac')
+def fit_ellipse_robust(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    robust ellipse fit of the sub-pixel refined contour that ignores outliers, see :func:`ellipse_fit.fit_ellipse_ransac`
+
+    options `ransac_iterations` and `ransac_threshold`: max number of random samples and max distance in px of an inlier;
+    options `baseline_weight_decay` and `fit_band_height` as for `ellipse_subpixel`; the fraction of inliers is stored in extra `inlier_ratio`
+    """
+    points = _fit_points(data, pipeline)
+    decay = pipeline.options.get('baseline_weight_decay', BASELINE_WEIGHT_DECAY)
+    if decay > 0:
+        data.weights = calc_baseline_weights(points, data.y_base, decay)
+    iterations = pipeline.options.get('ransac_iterations', RANSAC_ITERATIONS)
+    threshold = pipeline.options.get('ransac_threshold', RANSAC_THRESHOLD)
+    try:
+        data.ellipse, inliers = fit_ellipse_ransac(points, data.weights, iterations, threshold)
+    except EllipseFitError as ex:
+        raise ContourError(str(ex))
+    data.extra['inlier_ratio'] = np.count_nonzero(inliers) / len(inliers)
+
+@register_backend('fit', 'polynomial')
+def fit_polynomial(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    local polynomial fit of the contour at both contact points, see :func:`tangent_fit.fit_contact_tangent`
+
+    options `tangent_fit_distance` and `tangent_fit_order`: size of the fitted region in px and order of the polynomial;
+    option `tangent_fit_margin`: height in px above the baseline whose points are left out of the fit;
+    option `tangent_fit_subpixel`: refine the points close to the baseline to sub-pixel precision before fitting
+
+    within about 2 deg on synthetic drops, on real images the angle follows the outline close to the contact point
+    and can differ a lot from the global fits; scanline edges miss the contact of strongly undercut drops (above about 140 deg),
+    which raises a :class:`ContourError`
+    """
+    distance = pipeline.options.get('tangent_fit_distance', TANGENT_FIT_DISTANCE)
+    order = pipeline.options.get('tangent_fit_order', TANGENT_FIT_ORDER)
+    margin = pipeline.options.get('tangent_fit_margin', TANGENT_FIT_MARGIN)
+    points = data.contour.reshape(-1,2)
+    # only the points close to the baseline can be part of the fit
+    near = points[(points[:,1] < data.y_base) & (points[:,1] >= data.y_base - margin - distance - 1)]
+    if pipeline.options.get('tangent_fit_subpixel', TANGENT_FIT_SUBPIXEL) and len(near) > 0:
+        near = subpixel_edge_points(data.img, near.reshape(-1,1,2))
+    left, right = split_sides(near.astype(np.float64), data.y_base)
+    data.tangents = (fit_contact_tangent(left, data.y_base, True, distance, order, margin),
+                     fit_contact_tangent(right, data.y_base, False, distance, order, margin))
+
+@register_backend('fit', 'skimage')
+def fit_ellipse_skimage(data: FrameData, pipeline: EvaluationPipeline):
+    """ ellipse fit with scikit-image EllipseModel, https://scikit-image.org/docs/0.15.x/api/skimage.measure.html """
+    from skimage.measure import EllipseModel
+    ell = EllipseModel()
+    if not ell.estimate(_in_fit_band(data.contour, data, pipeline).reshape(-1,2).astype(np.float64)):
+        raise ContourError('Couldn\'t fit ellipse')
+    x0, y0, a, b, phi = ell.params
+    data.ellipse = ((x0, y0), (2*a, 2*b), degrees(phi))
+
+@register_backend('metrics', 'auto')
+def metrics_auto(data: FrameData, pipeline: EvaluationPipeline):
+    """ use :func:`metrics_tangent` if the fit backend provided tangents, otherwise :func:`metrics_ellipse` """
+    if data.tangents is not None:
+        metrics_tangent(data, pipeline)
+    else:
+        metrics_ellipse(data, pipeline)
+
+def _profile_points(data: FrameData) -> np.ndarray:
+    """ refined contour points if available, else the contour """
+    return data.points if data.points is not None else data.contour.reshape(-1,2)
+
+def profile_volume(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    integrate volume and surface from the droplet profile, see :func:`calc_profile_volume`;
+    stored in extra `volume` and `surface`, a volume from the model of the fit backend is kept;
+    skipped if pipeline option `profile_volume` is off, see :data:`PROFILE_VOLUME`
+    """
+    if not pipeline.options.get('profile_volume', PROFILE_VOLUME):
+        return
+    volume, surface = calc_profile_volume(_profile_points(data), data.y_base)
+    data.extra.setdefault('volume', volume)
+    data.extra['surface'] = surface
+
+@register_backend('metrics', 'ellipse')
+def metrics_ellipse(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    intersections, tangent angles, area and height from the fitted ellipse, see :func:`calc_droplet_metrics`;
+    volume and surface from the profile, see :func:`profile_volume`
+    """
+    (x0,y0), (maj_ax,min_ax), phi_deg = data.ellipse
+    data.metrics = calc_droplet_metrics((x0,y0,maj_ax/2,min_ax/2,radians(phi_deg)), data.y_base)
+    profile_volume(data, pipeline)
+
+@register_backend('metrics', 'tangent')
+def metrics_tangent(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    tangent angles from the contact points and slopes set by the fit backend,
+    area and height are taken from the fit backend if provided, else from the contour;
+    volume and surface as for :func:`metrics_ellipse`
+    """
+    (x_int_l, m_t_l), (x_int_r, m_t_r) = data.tangents
+    angle_l = (pi - atan2(m_t_l,1)) % pi
+    angle_r = (atan2(m_t_r,1) + pi) % pi
+    points = _profile_points(data)
+    if 'area' in data.extra:
+        area = data.extra['area']
+    else:
+        area = calc_profile_area(points, data.y_base)
+    if 'height' in data.extra:
+        drplt_height = data.extra['height']
+    else:
+        drplt_height = data.y_base - points[:,1].min()
+    data.metrics = (x_int_l, x_int_r), (m_t_l, m_t_r), (angle_l, angle_r), area, drplt_height
+    profile_volume(data, pipeline)
+
+### calculations ###
+
+def calc_droplet_metrics(ellipse_pars, y_base):
+    """
+    calculate the droplet metrics from the fitted ellipse and the baseline
+
+    :param ellipse_pars: tuple of (x0,y0,a,b,phi): x0,y0 center of ellipse; a,b sem-axis of ellipse; phi tilt rel to x axis
+    :param y_base: the y coordinate of the surface the droplet sits on
+    :raises ContourError: if the ellipse does not intersect the baseline twice
+    :returns: tuple of ((x_int_l, x_int_r), (m_t_l, m_t_r), (angle_l, angle_r), area, height), angles in rad
+    """
+    (x0,y0,a,b,phi) = ellipse_pars
     # calculate intersections of ellipse with baseline
-    intersection = calc_intersection_line_ellipse((x0,y0,a,b,phi),(0,y_base))
+    intersection = calc_intersection_line_ellipse(ellipse_pars,(0,y_base))
 
-    if intersection is None or not isinstance(intersection, list):
+    if intersection is None or not isinstance(intersection, tuple):
         raise ContourError('No valid intersections found')
     x_int_l = min(intersection)
     x_int_r = max(intersection)
 
-    foc_len = sqrt(abs(a**2 - b**2))
-
     # calc slope and angle of tangent at intersections
-    m_t_l = calc_slope_of_ellipse((x0,y0,a,b,phi), x_int_l, y_base)
-    m_t_r = calc_slope_of_ellipse((x0,y0,a,b,phi), x_int_r, y_base)
+    m_t_l = calc_slope_of_ellipse(ellipse_pars, x_int_l, y_base)
+    m_t_r = calc_slope_of_ellipse(ellipse_pars, x_int_r, y_base)
 
     # calc angle from inclination of tangents
     angle_l = (pi - atan2(m_t_l,1)) % pi
     angle_r = (atan2(m_t_r,1) + pi) % pi
 
     # calc area of droplet
-    area = calc_area_of_droplet((x_int_l, x_int_r), (x0,y0,a,b,phi), y_base)
+    area = calc_area_of_droplet((x_int_l, x_int_r), ellipse_pars, y_base)
 
     # calc height of droplet
-    drplt_height = calc_height_of_droplet((x0,y0,a,b,phi), y_base)
-    
-    # write values to droplet object
-    drplt.angle_l = degrees(angle_l)
-    drplt.angle_r = degrees(angle_r)
-    drplt.maj = maj_ax
-    drplt.min = min_ax
-    drplt.center = (x0, y0)
-    drplt.phi = phi
-    drplt.tilt_deg = phi_deg
-    drplt.tan_l_m = m_t_l
-    drplt.tan_r_m = m_t_r
-    drplt.line_l = (x_int_l - y_base/m_t_l, 0, x_int_l + (height - y_base)/m_t_l, height)
-    drplt.line_r = (x_int_r - y_base/m_t_r, 0, x_int_r + (height - y_base)/m_t_r, height)
-    drplt.int_l = (x_int_l, y_base)
-    drplt.int_r = (x_int_r, y_base)
-    drplt.foc_pt1 = (x0 + foc_len*cos(phi), y0 + foc_len*sin(phi))
-    drplt.foc_pt2 = (x0 - foc_len*cos(phi), y0 - foc_len*sin(phi))
-    drplt.base_diam = x_int_r - x_int_l
-    drplt.area = area
-    drplt.height = drplt_height
-    drplt.is_valid = True
+    drplt_height = calc_height_of_droplet(ellipse_pars, y_base)
 
-    if DEBUG & DBG_DRAW_TAN_ANGLE:
-        # painting
-        y_int = int(round(y_base))
-        img = cv2.line(img, (int(round(x_int_l - (y_int/m_t_l))), 0), (int(round(x_int_l + ((height - y_int)/m_t_l))), int(round(height))), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
-        img = cv2.line(img, (int(round(x_int_r - (y_int/m_t_r))), 0), (int(round(x_int_r + ((height - y_int)/m_t_r))), int(round(height))), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
-        img = cv2.ellipse(img, (int(round(x_int_l)),y_int), (20,20), 0, 0, -int(round(angle_l*180/pi)), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
-        img = cv2.ellipse(img, (int(round(x_int_r)),y_int), (20,20), 0, 180, 180 + int(round(angle_r*180/pi)), (255,0,255), thickness=1, lineType=cv2.LINE_AA)
-        img = cv2.line(img, (0,y_int), (width, y_int), (255,0,0), thickness=2, lineType=cv2.LINE_AA)
-        img = cv2.putText(img, '<' + str(round(angle_l*180/pi,1)), (5,y_int-5), cv2.FONT_HERSHEY_COMPLEX, .5, (0,0,0))
-        img = cv2.putText(img, '<' + str(round(angle_r*180/pi,1)), (width - 80,y_int-5), cv2.FONT_HERSHEY_COMPLEX, .5, (0,0,0))
+    return (x_int_l, x_int_r), (m_t_l, m_t_r), (angle_l, angle_r), area, drplt_height
 
-    #return drplt#, img
+def locate_droplet(img, y_base, mask=None, levels=PYRAMID_LEVELS, padding=TRACKER_PADDING, tilt=0.0):
+    """
+    find the droplet on a downsampled image to restrict the full resolution evaluation to its surroundings
 
-def find_contour(img, is_masked):
+    :param img: the image to be evaluated as np.ndarray
+    :param y_base: the y coordinate of the surface the droplet sits on
+    :param mask: needle mask as (x,y,w,h) tuple
+    :param levels: number of times the image is downsampled by 2 with cv2.pyrDown
+    :param padding: margin in px around the located droplet in full resolution
+    :param tilt: tilt of the baseline in rad, the downsampled image is leveled around (width/2, y_base) and the window is in leveled coordinates
+    :returns: window as (x1,y1,x2,y2) tuple or None if no droplet was found
+    """
+    scale = 2**levels
+    rows = y_base
+    if tilt != 0:
+        # the region above a tilted baseline reaches further down on the side the baseline descends to
+        rows = min(y_base + int(ceil(img.shape[1]/2*abs(sin(tilt)))) + scale, img.shape[0])
+    small = img[:rows]
+    if small.ndim == 3:
+        small = small[:,:,0]
+    for _ in range(levels):
+        small = cv2.pyrDown(small)
+    if tilt != 0:
+        # leave out the last row, it is blurred with the substrate edge
+        small = cv2.warpAffine(small, level_matrix((img.shape[1]/2/scale, y_base/scale), tilt), (small.shape[1], y_base//scale - 1),
+                               flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+    edges = cv2.Canny(small, *calc_otsu_thresholds(small))
+    masked = False
+    if mask is not None:
+        x,y,w,h = mask
+        edges[:, x//scale:-(-(x + w)//scale)] = 0
+        masked = True
+    try:
+        x,y,w,h = cv2.boundingRect(find_contour(edges, masked))
+    except ContourError:
+        return None
+    # one extra pixel of the downsampled image to cover the blur of the pyramid
+    x1 = max((x - 1)*scale - padding, 0)
+    y1 = max((y - 1)*scale - padding, 0)
+    x2 = min((x + w + 1)*scale + padding, img.shape[1])
+    if x2 <= x1 or y1 >= y_base:
+        return None
+    return x1, y1, x2, y_base
+
+def find_contour(img, is_masked, offset=(0,0), buffers: FrameBuffers = None):
     """searches for contours and returns the ones with largest bounding rect
 
+    the bounding rects of all contours are calculated at once, for sparse edge images on the concatenated contour points;
+    noisy images with many edge pixels are labeled with cv2.connectedComponentsWithStats instead and
+    only the selected contours are traced, see :data:`CONTOUR_LABEL_DENSITY`
+
     :param img: grayscale or bw image
     :param is_masked: if image was masked
     :type is_masked: bool
+    :param offset: offset added to all contour points, eg. origin of the search window
+    :param buffers: optional :class:`frame_buffers.FrameBuffers` for the label images
     :raises ContourError: if no contours are detected
     :return: if not is_masked: contour with largest bounding rect
 
             else: the two contours with largest bounding rect merged
     :rtype: [type]
     """
-    # find all contours in image, https://docs.opencv.org/3.4/d3/dc0/group__imgproc__shape.html#ga17ed9f5d79ae97bd4c7cf18403e1689a
-    # https://docs.opencv.org/3.4/d9/d8b/tutorial_py_contours_hierarchy.html 
-    # https://docs.opencv.org/3.4/d3/dc0/group__imgproc__shape.html#ga4303f45752694956374734a03c54d5ff
-    # contours, hierarchy = cv2.findContours(bw_edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-    contours, hierarchy = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    if len(contours) == 0:
-        raise ContourError('No contours found!')
-    # edge = max(contours, key=cv2.contourArea)
-
-    cntr_area_list = []
-    for cont in contours:
-        x,y,w,h = cv2.boundingRect(cont)
-        # store contour, area of bounding rect and bounding rect in array
-        cntr_area_list.append([cont, w*h, x, y, x+w, y+h])
-    # sort contours by bounding rect area
-    cntr_area_list_sorted = sorted(cntr_area_list, key=lambda item: item[1])
-    
-    if is_masked:
-        # select largest 2 non overlapping contours, assumes mask splits largest contour in the middle
-        rects = [elem[2:] for elem in cntr_area_list_sorted[-2:]]
-        largest_conts = [elem[0] for elem in cntr_area_list_sorted[-2:]]
+    if cv2.countNonZero(img) > CONTOUR_LABEL_DENSITY*img.shape[0]*img.shape[1]:
+        rects, get_contour = _label_edges(img, offset, buffers)
+    else:
+        rects, get_contour = _trace_edges(img, offset)
+    rect_areas = (rects[:,2] - rects[:,0]) * (rects[:,3] - rects[:,1])
 
+    if is_masked and len(rects) > 1:
+        # select largest 2 non overlapping contours, assumes mask splits largest contour in the middle
+        second, largest = np.argpartition(rect_areas, -2)[-2:]
+        if rect_areas[second] > rect_areas[largest]:
+            second, largest = largest, second
         #check if second largest contour is not from inside the droplet by checking overlap of bounding rects
-        BR = rects[-1] # biggest rect
-        SR = rects[0] # slightly smaller rect
+        BR = rects[largest] # biggest rect
+        SR = rects[second] # slightly smaller rect
         # check if smaller rect overaps with larger rect
         if (BR[2] < SR[0] or BR[0] > SR[2] or BR[1] > SR[3] or BR[3] < SR[1]):
             # if not both rects are valid droplet contours, merge them
-            contour = np.concatenate((largest_conts[0], largest_conts[1]))
-        else:
-            # else only biggest is valid droplet contour
-            contour = cntr_area_list_sorted[-1][0]
+            return np.concatenate((get_contour(second), get_contour(largest)))
     else:
-        # contour with largest area
-        contour = cntr_area_list_sorted[-1][0]
-    return contour
+        largest = np.argmax(rect_areas)
+    # contour with largest area
+    return get_contour(largest)
+
+def find_droplet_contours(img, y_bottom, offset=(0,0), mask=None, min_width=MULTI_MIN_WIDTH, buffers: FrameBuffers = None) -> List[np.ndarray]:
+    """
+    searches for the contours of all droplets resting on the baseline
+
+    contours reaching down to the baseline and at least min_width wide are droplets, contours within the bounding rect
+    of a larger one are ignored; neighbouring droplets separated only by the needle mask are the two halves of one droplet
+    and are merged
+
+    :param img: bw edge image of the region above the baseline
+    :param y_bottom: row of the baseline in the image
+    :param offset: offset added to all contour points, eg. origin of the search window
+    :param mask: needle mask as (x,y,w,h) tuple in image coordinates of the offset or None
+    :param min_width: min width of a droplet in px
+    :param buffers: optional :class:`frame_buffers.FrameBuffers` for the label images
+    :raises ContourError: if no droplet is found
+    :returns: list of droplet contours ordered from left to right
+    """
+    if cv2.countNonZero(img) > CONTOUR_LABEL_DENSITY*img.shape[0]*img.shape[1]:
+        rects, get_contour = _label_edges(img, offset, buffers)
+    else:
+        rects, get_contour = _trace_edges(img, offset)
+    candidates = np.flatnonzero((rects[:,3] >= offset[1] + y_bottom - MULTI_BASE_MARGIN) & (rects[:,2] - rects[:,0] >= min_width))
+    # largest first, so a contour inside a droplet is checked against it
+    candidates = candidates[np.argsort(-(rects[candidates,2] - rects[candidates,0]), kind='stable')]
+    kept = []
+    for i in candidates:
+        x1, y1, x2, y2 = rects[i]
+        if not any(rects[k,0] <= x1 and rects[k,1] <= y1 and rects[k,2] >= x2 and rects[k,3] >= y2 for k in kept):
+            kept.append(i)
+    if not kept:
+        raise ContourError('No droplets found on baseline')
+    kept.sort(key=lambda i: rects[i,0])
+    contours = [get_contour(kept[0])]
+    for prev, i in zip(kept[:-1], kept[1:]):
+        if mask is not None and mask[0] <= rects[prev,2] + MULTI_BASE_MARGIN and mask[0] + mask[2] >= rects[i,0] - MULTI_BASE_MARGIN:
+            # gap covered by the needle mask
+            contours[-1] = np.concatenate((contours[-1], get_contour(i)))
+        else:
+            contours.append(get_contour(i))
+    return contours
+
+def _trace_edges(img, offset):
+    """ trace all contours and calculate their bounding rects as (x1,y1,x2,y2) on the concatenated points """
+    # find all contours in image, https://docs.opencv.org/3.4/d3/dc0/group__imgproc__shape.html#ga17ed9f5d79ae97bd4c7cf18403e1689a
+    # https://docs.opencv.org/3.4/d9/d8b/tutorial_py_contours_hierarchy.html 
+    # https://docs.opencv.org/3.4/d3/dc0/group__imgproc__shape.html#ga4303f45752694956374734a03c54d5ff
+    contours, hierarchy = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset)
+    if len(contours) == 0:
+        raise ContourError('No contours found!')
+    lengths = np.fromiter(map(len, contours), dtype=np.intp, count=len(contours))
+    starts = np.zeros_like(lengths)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    points = np.concatenate(contours).reshape(-1,2)
+    rects = np.empty((len(contours), 4), dtype=points.dtype)
+    rects[:,:2] = np.minimum.reduceat(points, starts, axis=0)
+    rects[:,2:] = np.maximum.reduceat(points, starts, axis=0) + 1
+    return rects, contours.__getitem__
+
+def _label_edges(img, offset, buffers: FrameBuffers):
+    """ label connected edges and return their bounding rects as (x1,y1,x2,y2), contours are traced on request """
+    if buffers is None:
+        buffers = FrameBuffers()
+    # 8-connectivity like cv2.findContours
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(img, labels=buffers.get('labels', img.shape[:2], np.int32), connectivity=8)
+    if count <= 1:
+        raise ContourError('No contours found!')
+    # label 0 is the background
+    stats = stats[1:]
+    rects = np.empty((count - 1, 4), dtype=stats.dtype)
+    rects[:,0] = stats[:, cv2.CC_STAT_LEFT] + offset[0]
+    rects[:,1] = stats[:, cv2.CC_STAT_TOP] + offset[1]
+    rects[:,2] = rects[:,0] + stats[:, cv2.CC_STAT_WIDTH]
+    rects[:,3] = rects[:,1] + stats[:, cv2.CC_STAT_HEIGHT]
+    def get_contour(index):
+        x, y, w, h = stats[index, :4]
+        # trace the outer contour only within the bounding rect of the component
+        component = cv2.compare(labels[y:y+h, x:x+w], int(index + 1), cv2.CMP_EQ, dst=buffers.get('component', (h, w)))
+        contours, _ = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(int(offset[0] + x), int(offset[1] + y)))
+        return max(contours, key=len)
+    return rects, get_contour
 
 def calc_intersection_line_ellipse(ellipse_pars, line_pars):
     """
@@ -267,39 +925,96 @@ def calc_slope_of_ellipse(ellipse_pars, x, y):
 
 def calc_area_of_droplet(line_intersections, ellipse_pars, y_int) -> float:
     """
-    calculate the are of the droplet by approximating the area of the ellipse cut off at the baseline
+    calculate the area of the droplet as the area of the ellipse cut off at the baseline
 
+    the ellipse is mapped onto the unit circle, where the baseline cuts off a circular segment;
+    its area is scaled back by the product of the semi axes
+
+    :param line_intersections: unused, the area follows from the ellipse and the baseline alone
     :param ellipse_params: tuple of (x0,y0,a,b,phi): x0,y0 center of ellipse; a,b sem-axis of ellipse; phi tilt rel to x axis
     :param y_int: y coordinate of baseline
     :returns: area of droplet in px^2 
     """
     (x0, y0, a, b, phi) = ellipse_pars
-    (x1,x2) = line_intersections
-    # calculate the angles of the vectors from ellipse origin to the intersections
-    dy = abs(y_int - y0)
-    dx1 = abs(x1 - x0)
-    ang_x1 = acos(dx1 / sqrt(dy**2 + dx1**2))
-    dx2 = abs(x2 - x0) 
-    ang_x2 = acos(dx2 / sqrt(dy**2 + dx2**2))
-    if y_int > y0:
-        ang_x1 += pi
-        ang_x2 -= pi/2
-    else:
-        ang_x1 = pi - ang_x1
-    # adjust for ellipse tilt
-    ang_x1 -= phi
-    ang_x2 -= phi
-
-    # calculate the surface area of the segment between x1 and x2, https://rechneronline.de/pi/elliptical-sector.php
-    dphi = ang_x1 - ang_x2
-    sec_area = a*b/2 * (dphi - atan2( (b-a)*sin(2*ang_x1), (a+b+(b-a)*cos(2*ang_x1) ) + atan2( (b-a)*sin(2*ang_x2), (a+b+(b-a)*cos(2*ang_x2)) )))
-    # add or remove triangle enclosed by x1, x2 and origin of ellipse to get area of ellipse above baseline
-    if y_int > y0:
-        area = sec_area + (dy*(dx1/2 + dx2/2))
-    else:
-        area = sec_area - (dy*(dx1/2 + dx2/2))
+    # signed distance of the baseline from the center in the unit circle frame
+    d = (y_int - y0) / sqrt(a**2 * sin(phi)**2 + b**2 * cos(phi)**2)
+    d = min(max(d, -1.0), 1.0)
+    return a*b*(pi - acos(d) + d*sqrt(1 - d**2))
+
+def _profile_rows(points, y_base) -> Tuple[np.ndarray,np.ndarray]:
+    """
+    outermost edge points left and right of the droplet axis in every pixel row from the apex down to the baseline
+
+    the axis is the middle of the bounding box of the points; a row only counts if it has edge points on both sides,
+    rows with edges on one side only, eg. from scanline edges or beside the needle mask, would measure a wrong width
+
+    :param points: N x 2 array of (x,y) edge points
+    :param y_base: y coordinate of baseline
+    :raises ContourError: if there are no points above the baseline
+    :returns: tuple of (left, right) arrays of x coordinates, nan in rows without edge points on both sides
+    """
+    points = points[points[:,1] < y_base]
+    if len(points) == 0:
+        raise ContourError('No contour points above baseline')
+    rows = np.round(points[:,1]).astype(np.intp)
+    top = rows.min()
+    # down to the row directly above the baseline, edge backends may miss the last rows where the outline is flat
+    bottom = max(rows.max(), int(ceil(y_base)) - 1)
+    left = np.full(bottom - top + 1, np.inf)
+    right = np.full(len(left), -np.inf)
+    np.minimum.at(left, rows - top, points[:,0])
+    np.maximum.at(right, rows - top, points[:,0])
+    x_axis = (points[:,0].min() + points[:,0].max())/2
+    complete = (left < x_axis) & (right > x_axis)
+    left[~complete] = np.nan
+    right[~complete] = np.nan
+    return left, right
+
+def _profile_widths(points, y_base) -> np.ndarray:
+    """
+    width of the droplet silhouette in every pixel row from the topmost complete row down to the baseline
 
-    return area
+    :param points: N x 2 array of (x,y) edge points
+    :param y_base: y coordinate of baseline
+    :raises ContourError: if no row has edge points on both sides
+    :returns: array of widths, rows without edge points on both sides are interpolated
+    """
+    left, right = _profile_rows(points, y_base)
+    width = right - left
+    found = np.flatnonzero(np.isfinite(width))
+    if len(found) == 0:
+        raise ContourError('No contour rows with edges on both sides')
+    # rows above the first complete one are only a few px of the apex
+    width = width[found[0]:]
+    rows = np.arange(len(width))
+    return np.interp(rows, found - found[0], width[found - found[0]])
+
+def calc_profile_area(points, y_base) -> float:
+    """
+    calculate the area of the droplet silhouette from its edge points by summing up the width of every pixel row
+
+    :param points: N x 2 array of (x,y) edge points
+    :param y_base: y coordinate of baseline
+    :returns: area of droplet in px^2
+    """
+    return float(_profile_widths(points, y_base).sum())
+
+def calc_profile_volume(points, y_base) -> Tuple[float,float]:
+    """
+    calculate volume and liquid-air surface area of the droplet from its edge points, assuming it is rotationally symmetric
+
+    every pixel row is a disk with the width of the silhouette as diameter, the surface is made up of the
+    truncated cones between the rows and the disk of the top row; rows without edge points on both sides,
+    eg. behind the needle mask, are interpolated
+
+    :param points: N x 2 array of (x,y) edge points
+    :param y_base: y coordinate of baseline
+    :returns: tuple of (volume, surface) in px^3 and px^2, the contact area with the substrate is not part of the surface
+    """
+    radius = np.maximum(_profile_widths(points, y_base), 0)/2
+    volume = pi*np.dot(radius, radius)
+    surface = pi*(radius[0]**2 + np.dot(radius[:-1] + radius[1:], np.hypot(np.diff(radius), 1)))
+    return float(volume), float(surface)
 
 def calc_height_of_droplet(ellipse_pars, y_base) -> float:
     """
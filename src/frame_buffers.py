@@ -0,0 +1,59 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Preallocated image buffers for the evaluation hot path
+
+import logging
+from typing import Dict, Tuple
+import numpy as np
+
+
+class FrameBuffers:
+    """
+    named image buffers that are reused between frames to avoid allocating new arrays for every frame
+
+    buffers are allocated once large enough for the requested shape, smaller regions are returned as views
+    into them, so a changing search window does not cause reallocations;
+    call :meth:`invalidate` if the image size changes to release the buffers
+
+    the returned views are overwritten by the next frame, results that need to persist have to be copied
+    """
+    def __init__(self):
+        self._buffers: Dict[str, np.ndarray] = {}
+
+    def invalidate(self):
+        """ release all buffers, they are allocated again with the next requested size """
+        self._buffers.clear()
+
+    def get(self, name, shape: Tuple[int,int], dtype=np.uint8) -> np.ndarray:
+        """
+        return a buffer of the given shape, its content is undefined
+
+        :param name: name of the buffer
+        :param shape: (height, width) of the required buffer
+        :param dtype: data type of the buffer
+        :returns: view of shape `shape` into the buffer
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.shape[0] < shape[0] or buf.shape[1] < shape[1]:
+            if buf is not None:
+                shape_alloc = (max(buf.shape[0], shape[0]), max(buf.shape[1], shape[1]))
+            else:
+                shape_alloc = shape
+            logging.debug(f'frame buffers: allocate {name} {shape_alloc}')
+            buf = np.empty(shape_alloc, dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:shape[0], :shape[1]]
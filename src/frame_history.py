@@ -0,0 +1,139 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# History of the raw results of every evaluated frame
+
+# The records are stored in preallocated chunks of a structured array. New chunks are allocated until the
+# maximum number of frames is reached, afterwards the oldest chunk is reused, so the memory is bounded
+# and appending never copies the existing records.
+
+from collections import deque
+from typing import Deque
+import numpy as np
+
+HISTORY_DTYPE = np.dtype([
+    ('timestamp',   np.float64),
+    ('angle_l',     np.float64),
+    ('angle_r',     np.float64),
+    ('base_diam',   np.float64),
+    ('area',        np.float64),
+    ('height',      np.float64),
+    ('base_y',      np.float64),
+    ('base_tilt',   np.float64),
+    ('inlier_ratio', np.float64),
+    ('volume',      np.float64),
+    ('surface',     np.float64),
+])
+""" record layout of the history, timestamp in s, angles in deg, lengths in px, areas in px^2, volume in px^3, base_tilt in rad """
+
+HISTORY_CHUNK_SIZE = 4096
+""" number of records allocated at once """
+HISTORY_MAX_FRAMES = 1 << 20
+""" max number of records kept, about 90 MB or 10 h at 30 fps """
+
+_FIELDS = HISTORY_DTYPE.names[1:]
+
+
+class FrameHistory:
+    """
+    bounded store of the raw results of every evaluated frame, ordered by time
+
+    timestamps have to be ascending, eg. from time.perf_counter, so time ranges can be found by bisection;
+    if the history is full, the oldest :data:`HISTORY_CHUNK_SIZE` records are dropped at once
+
+    :param chunk_size: number of records allocated at once
+    :param max_frames: max number of records kept, rounded up to full chunks
+    """
+    def __init__(self, chunk_size=HISTORY_CHUNK_SIZE, max_frames=HISTORY_MAX_FRAMES):
+        self.chunk_size = chunk_size
+        self.max_chunks = max(-(-max_frames // chunk_size), 1)
+        self.dropped = 0
+        """ number of records dropped because the history was full """
+        self._chunks: Deque[np.ndarray] = deque()
+        # number of used records in the last chunk
+        self._fill = 0
+
+    def __len__(self) -> int:
+        if not self._chunks:
+            return 0
+        return (len(self._chunks) - 1)*self.chunk_size + self._fill
+
+    def clear(self):
+        """ remove all records and release the memory """
+        self._chunks.clear()
+        self._fill = 0
+        self.dropped = 0
+
+    def append(self, timestamp, result):
+        """
+        add the result of a frame
+
+        :param timestamp: time the frame was taken in s
+        :param result: object with an attribute for every field of :data:`HISTORY_DTYPE` except timestamp,
+            eg. :class:`evaluate_droplet.DropletResult`
+        """
+        if not self._chunks or self._fill == self.chunk_size:
+            if len(self._chunks) < self.max_chunks:
+                chunk = np.empty(self.chunk_size, dtype=HISTORY_DTYPE)
+            else:
+                # reuse the oldest chunk
+                chunk = self._chunks.popleft()
+                self.dropped += self.chunk_size
+            self._chunks.append(chunk)
+            self._fill = 0
+        self._chunks[-1][self._fill] = (timestamp,) + tuple(getattr(result, name) for name in _FIELDS)
+        self._fill += 1
+
+    def _used(self):
+        """ iterate over the used part of all chunks, oldest first """
+        last = len(self._chunks) - 1
+        for i, chunk in enumerate(self._chunks):
+            yield chunk if i < last else chunk[:self._fill]
+
+    def slice(self, t_start=None, t_end=None) -> np.ndarray:
+        """
+        return the records within a time range
+
+        :param t_start: first timestamp to include, None for the oldest record
+        :param t_end: timestamp up to which records are included (exclusive), None for the newest record
+        :returns: structured array of :data:`HISTORY_DTYPE`, a copy of the stored records
+        """
+        parts = []
+        for chunk in self._used():
+            if len(chunk) == 0:
+                continue
+            # skip chunks completely outside of the range without searching them
+            if (t_start is not None and chunk['timestamp'][-1] < t_start) or (t_end is not None and chunk['timestamp'][0] >= t_end):
+                continue
+            times = chunk['timestamp']
+            start = np.searchsorted(times, t_start, 'left') if t_start is not None else 0
+            end = np.searchsorted(times, t_end, 'left') if t_end is not None else len(chunk)
+            parts.append(chunk[start:end])
+        if not parts:
+            return np.empty(0, dtype=HISTORY_DTYPE)
+        return np.concatenate(parts)
+
+    def last(self, duration) -> np.ndarray:
+        """
+        return the records of the last seconds
+
+        :param duration: length of the time range in s, counted back from the newest record
+        :returns: structured array of :data:`HISTORY_DTYPE`
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=HISTORY_DTYPE)
+        newest = self._chunks[-1]['timestamp'][self._fill - 1]
+        return self.slice(newest - duration)
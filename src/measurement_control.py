@@ -153,6 +153,9 @@ class MeasurementControl(QGroupBox):
             QMessageBox.warning(self, 'MAEsure Error', f'An error occured:\n{str(ex)}', QMessageBox.Ok)
             logging.exception("measurement control: error", exc_info=ex)
             return
+        # the first datapoint only covers frames of the measurement
+        Droplet().take_stats()
+        Droplet().take_multi_stats()
         self.start_measurement_signal.emit(self.ui.plotHoldChk.isChecked())
         self.stopped = False
         self.aborted = False
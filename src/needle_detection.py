@@ -0,0 +1,143 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Automatic detection of the syringe needle
+
+# The needle enters the image from the top as dark vertical bar. It is found as the widest run of dark columns
+# in the intensity profile of the top rows, then followed downwards as long as it stays dark with bright background
+# on both sides. The result is cached and only detected again if the column profile changes or after some frames.
+
+import logging
+from typing import Tuple
+import cv2
+import numpy as np
+
+# number of top image rows averaged to the column profile
+NEEDLE_PROFILE_ROWS = 16
+# min difference in gray values between needle and background
+NEEDLE_MIN_CONTRAST = 40
+# max width of the needle as fraction of the image width
+NEEDLE_MAX_WIDTH = 0.5
+# margin in px added left and right of the needle and below a free needle tip
+NEEDLE_PADDING = 3
+NEEDLE_REFRESH_INTERVAL = 30
+""" number of frames after which the cached needle is detected again """
+NEEDLE_CHANGE_THRESHOLD = 8.0
+""" mean change of the column profile in gray values that triggers a new detection """
+
+
+def column_profile(img, rows=NEEDLE_PROFILE_ROWS) -> np.ndarray:
+    """
+    mean intensity of every column over the top rows of the image
+
+    :param img: grayscale image
+    :param rows: number of rows to average
+    :returns: float32 array with one value per column
+    """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    return cv2.reduce(img[:rows], 0, cv2.REDUCE_AVG, dtype=cv2.CV_32F).ravel()
+
+def detect_needle(img, y_base, profile=None, padding=NEEDLE_PADDING) -> Tuple[int,int,int,int]:
+    """
+    find the needle entering the image from the top and its vertical extent
+
+    the needle ends where it gets bright (free tip) or where the background next to it gets dark (tip in the droplet),
+    so the mask only covers the droplet where the needle hides its outline
+
+    :param img: grayscale image
+    :param y_base: the y coordinate of the surface the droplet sits on, the needle is only searched above
+    :param profile: column profile of the image, see :func:`column_profile`
+    :param padding: margin in px added left and right of the needle and below a free tip
+    :returns: needle mask as (x,y,w,h) tuple or None if no needle was found
+    """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    width = img.shape[1]
+    y_base = min(int(y_base), img.shape[0])
+    if profile is None:
+        profile = column_profile(img, min(NEEDLE_PROFILE_ROWS, y_base))
+    p_min, p_max = float(profile.min()), float(profile.max())
+    if p_max - p_min < NEEDLE_MIN_CONTRAST:
+        return None
+    thresh = (p_min + p_max)/2
+    # runs of dark columns, starts and ends from the sign changes of the padded mask
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], (profile < thresh).view(np.int8), [0]))))
+    starts, ends = changes[::2], changes[1::2]
+    widest = np.argmax(ends - starts)
+    x1, x2 = int(starts[widest]), int(ends[widest])
+    if x2 - x1 > NEEDLE_MAX_WIDTH*width:
+        return None
+    # follow the needle down: dark inside, bright on both sides
+    side_l = slice(max(x1 - padding - 2, 0), max(x1 - padding, 0))
+    side_r = slice(min(x2 + padding, width), min(x2 + padding + 2, width))
+    band = img[:y_base]
+    inside = cv2.reduce(band[:, x1:x2], 1, cv2.REDUCE_AVG, dtype=cv2.CV_32F).ravel() < thresh
+    bright_l = cv2.reduce(band[:, side_l], 1, cv2.REDUCE_AVG, dtype=cv2.CV_32F).ravel() >= thresh if side_l.start < side_l.stop else True
+    bright_r = cv2.reduce(band[:, side_r], 1, cv2.REDUCE_AVG, dtype=cv2.CV_32F).ravel() >= thresh if side_r.start < side_r.stop else True
+    needle_rows = inside & bright_l & bright_r
+    tip = int(np.argmin(needle_rows)) if not needle_rows.all() else y_base
+    # the needle has to reach through the rows of the profile, otherwise it is eg. the apex of a droplet
+    if tip < min(NEEDLE_PROFILE_ROWS, y_base):
+        return None
+    if tip < y_base and not inside[tip]:
+        # free tip, also mask the edge at its end
+        tip = min(tip + padding, y_base)
+    x = max(x1 - padding, 0)
+    return x, 0, min(x2 + padding, width) - x, tip
+
+
+class NeedleDetector:
+    """
+    detects the needle and keeps the result until the image changes
+
+    the column profile of the top rows is compared to the one of the last detection every frame,
+    which is much cheaper than the detection itself
+
+    :param refresh_interval: number of frames after which the needle is detected again
+    :param change_threshold: mean change of the column profile in gray values that triggers a new detection
+    """
+    def __init__(self, refresh_interval=NEEDLE_REFRESH_INTERVAL, change_threshold=NEEDLE_CHANGE_THRESHOLD):
+        self.refresh_interval = refresh_interval
+        self.change_threshold = change_threshold
+        self.rect: Tuple[int,int,int,int] = None
+        """ last detected needle mask as (x,y,w,h) or None """
+        self._profile: np.ndarray = None
+        self._frames = 0
+
+    def reset(self):
+        """ forget the cached needle, next call of :meth:`update` detects it again """
+        self.rect = None
+        self._profile = None
+        self._frames = 0
+
+    def update(self, img, y_base) -> Tuple[int,int,int,int]:
+        """
+        return the needle mask, detect it again if the cached one is outdated
+
+        :param img: grayscale image
+        :param y_base: the y coordinate of the surface the droplet sits on
+        :returns: needle mask as (x,y,w,h) tuple or None if there is no needle
+        """
+        profile = column_profile(img, min(NEEDLE_PROFILE_ROWS, int(y_base)))
+        self._frames += 1
+        if (self._profile is None or self._profile.shape != profile.shape or self._frames > self.refresh_interval
+                or cv2.norm(profile, self._profile, cv2.NORM_L1) > self.change_threshold*len(profile)):
+            self.rect = detect_needle(img, y_base, profile)
+            self._profile = profile
+            self._frames = 0
+            logging.debug(f'needle detection: {self.rect}')
+        return self.rect
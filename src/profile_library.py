@@ -0,0 +1,274 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Precomputed library of dimensionless young laplace drop profiles
+
+# The library holds one record per bond number with the profile sampled along the arc length
+# and the shape of the drop cut off at every contact angle of a fixed grid.
+# It is stored as .npy file and memory mapped, so loading is instant and only the used rows are read from disk.
+
+import os
+import logging
+import threading
+from math import tan, inf, pi
+from typing import Tuple
+import numpy as np
+
+import evaluate_droplet # not from-imported, evaluate_droplet imports this module to register the backend
+from eval_pipeline import ContourError, EvaluationPipeline, FrameData, register_backend
+from young_laplace import integrate_profile, YoungLaplaceFit, YL_STEP, YL_MAX_ARC, YL_BETA_RANGE
+
+LIBRARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'YoungLaplaceLibrary.npy')
+""" default location of the library file next to this module, it is built on first use if it does not exist """
+# number of bond numbers in the library, spaced quadratically to resolve small bond numbers better
+LIBRARY_BETA_COUNT = 256
+# contact angles of the library in rad
+LIBRARY_ANGLES = np.radians(np.arange(1.0, 180.0, 0.5))
+# number of lowest rows of the silhouette used to measure the base radius
+BASE_ROWS = 3
+# gauss newton iterations of the young_laplace_lookup backend starting from the library drop
+LIBRARY_REFINE_ITER = 3
+
+# serializes building and loading of the library files between threads, reentrant as loading can build
+_library_lock = threading.RLock()
+
+
+def library_dtype(samples, angles) -> np.dtype:
+    """
+    record layout of the library, one record per bond number
+
+    - **beta**: the bond number
+    - **x, z, psi, vol**: the profile sampled every :data:`young_laplace.YL_STEP` along the arc length, see :func:`young_laplace.integrate_profile`
+    - **height, radius, width, area, volume**: height, base radius, max half width, silhouette area and volume
+      of the drop cut off at each angle of :data:`LIBRARY_ANGLES`, in units of the apex radius
+
+    :param samples: number of profile samples
+    :param angles: number of contact angles
+    """
+    return np.dtype([('beta', np.float64)]
+                    + [(name, np.float64, (samples,)) for name in ('x', 'z', 'psi', 'vol')]
+                    + [(name, np.float64, (angles,)) for name in ('height', 'radius', 'width', 'area', 'volume')])
+
+def build_library(path=LIBRARY_FILE, beta_count=LIBRARY_BETA_COUNT, angles=LIBRARY_ANGLES) -> np.ndarray:
+    """
+    integrate the profiles for all bond numbers and write the library to disk
+
+    the file is written under a temporary name and replaces path once it is complete, so it is never mapped half written
+
+    :param path: file to write, if None the library is only kept in memory
+    :param beta_count: number of bond numbers between the limits of :data:`young_laplace.YL_BETA_RANGE`
+    :param angles: contact angles in rad at which the drop shapes are tabulated
+    :returns: the library as structured array, memory mapped read only if written to disk
+    """
+    with _library_lock:
+        return _build_library(path, beta_count, angles)
+
+def _build_library(path, beta_count, angles) -> np.ndarray:
+    """ build the library, see :func:`build_library` """
+    beta_min, beta_max = YL_BETA_RANGE
+    betas = beta_min + (beta_max - beta_min)*np.linspace(0, 1, beta_count)**2
+    samples = int(YL_MAX_ARC / YL_STEP) + 1
+    x, z, psi, vol = (np.pad(arr, ((0, samples - len(arr)), (0,0)), mode='edge')
+                      for arr in integrate_profile(betas, ds=YL_STEP, s_max=YL_MAX_ARC))
+    dtype = library_dtype(samples, len(angles))
+    if path is None:
+        lib = np.zeros(beta_count, dtype=dtype)
+    else:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        lib = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(beta_count,))
+    lib['beta'] = betas
+    lib['x'], lib['z'], lib['psi'], lib['vol'] = x.T, z.T, psi.T, vol.T
+    # silhouette area 2*int(x dz) along the profile
+    area = np.zeros_like(x)
+    area[1:] = np.cumsum((x[1:] + x[:-1])*np.diff(z, axis=0), axis=0)
+    width = np.maximum.accumulate(x, axis=0)
+    arc = np.arange(samples)*YL_STEP
+    for i in range(beta_count):
+        # psi only increases up to 180 deg, beyond that the profile is not used
+        s_cut = np.interp(angles, np.maximum.accumulate(psi[:,i]), arc)
+        for name, values in (('height', z), ('radius', x), ('width', width), ('area', area), ('volume', vol)):
+            lib[name][i] = np.interp(s_cut, arc, values[:,i])
+    if path is not None:
+        lib.flush()
+        # the file has to be unmapped before it can be replaced on windows
+        del lib
+        os.replace(tmp_path, path)
+        logging.info(f'profile library: built {path}')
+        lib = np.load(path, mmap_mode='r')
+    return lib
+
+def measure_shape(points, y_base) -> Tuple[float,float,float,float,float]:
+    """
+    measure the droplet silhouette from its edge points row by row
+
+    :param points: N x 2 array of (x,y) edge points
+    :param y_base: y coordinate of the baseline
+    :raises ContourError: if no points are above the baseline or no row has edge points on both sides
+    :returns: tuple of (x_center, height, radius, width, area) in px, radius and width are half widths at the base and at the widest row
+    """
+    left, right = evaluate_droplet._profile_rows(points, y_base)
+    found = np.flatnonzero(np.isfinite(left))
+    if len(found) == 0:
+        raise ContourError('No contour rows with edges on both sides')
+    # rows without edges on both sides below the first complete one are interpolated
+    widths = np.interp(np.arange(found[0], len(left)), found, (right - left)[found])
+    x_center = float(np.mean((left[found] + right[found])/2))
+    height = y_base - float(points[points[:,1] < y_base, 1].min())
+    radius = float(np.mean(widths[-BASE_ROWS:]))/2
+    return x_center, height, radius, float(widths.max())/2, float(widths.sum())
+
+
+class ProfileLibrary:
+    """
+    lookup of precomputed young laplace profiles by bond number and contact angle
+
+    the profiles are interpolated linearly between the tabulated bond numbers and can replace the
+    integration in :class:`young_laplace.YoungLaplaceFit`; the drop shapes tabulated per contact angle
+    give start values for the fit from the silhouette alone, the angle of the nearest library drop
+    can be off by tens of degrees above 90 deg
+
+    :param lib: the library as structured array, see :func:`library_dtype`
+    """
+    def __init__(self, lib: np.ndarray):
+        self.lib = lib
+        self.betas = np.array(lib['beta'])
+        self.angles = LIBRARY_ANGLES
+        if lib.dtype['height'].shape[0] != len(self.angles):
+            raise ValueError('Profile library does not match angle grid')
+        # scale invariant shape descriptors for every (beta, angle) pair:
+        # aspect angle 2*atan(height/radius), equals the contact angle for a spherical cap, and area/(2*width*height)
+        height, radius, width, area = (np.array(lib[name]) for name in ('height', 'radius', 'width', 'area'))
+        desc = np.stack((2*np.arctan2(height, radius), area/(2*width*height)), axis=-1).reshape(-1, 2)
+        self._desc_scale = 1/desc.std(axis=0)
+        # one contiguous array per descriptor, the distance is much faster to compute than on the N x 2 array
+        self._desc = tuple(np.ascontiguousarray(col) for col in (desc*self._desc_scale).T)
+
+    @classmethod
+    def load(cls, path=LIBRARY_FILE) -> 'ProfileLibrary':
+        """
+        memory map the library file, build it first if it does not exist or does not fit the current settings
+
+        :param path: library file
+        """
+        with _library_lock:
+            lib = None
+            if os.path.exists(path):
+                lib = np.load(path, mmap_mode='r')
+                if lib.dtype != library_dtype(int(YL_MAX_ARC / YL_STEP) + 1, len(LIBRARY_ANGLES)):
+                    logging.warning(f'profile library: {path} is outdated, rebuilding')
+                    del lib
+                    lib = None
+            if lib is None:
+                lib = build_library(path)
+        return cls(lib)
+
+    def profiles(self, beta, z_max=inf):
+        """
+        interpolate the profiles for one or more bond numbers, drop in replacement for :func:`young_laplace.integrate_profile`
+
+        :param beta: bond number or array of k bond numbers
+        :param z_max: depth below the apex after which the profiles are not needed anymore
+        :returns: tuple of arrays (x, z, psi, vol), each n x k
+        """
+        beta = np.atleast_1d(np.asarray(beta, dtype=np.float64))
+        idx = np.clip(np.searchsorted(self.betas, beta) - 1, 0, len(self.betas) - 2)
+        t = ((beta - self.betas[idx]) / (self.betas[idx + 1] - self.betas[idx]))[:,None]
+        rows_0 = self.lib[idx]
+        rows_1 = self.lib[idx + 1]
+        z = (1 - t)*rows_0['z'] + t*rows_1['z']
+        # cut after all profiles passed z_max or 180 deg
+        psi = (1 - t)*rows_0['psi'] + t*rows_1['psi']
+        done = np.all((z >= z_max) | (psi >= pi), axis=0)
+        n = np.argmax(done) + 1 if done.any() else z.shape[1]
+        x = (1 - t)*rows_0['x'][:,:n] + t*rows_1['x'][:,:n]
+        vol = (1 - t)*rows_0['vol'][:,:n] + t*rows_1['vol'][:,:n]
+        return x.T, z[:,:n].T, psi[:,:n].T, vol.T
+
+    def lookup(self, height, radius, width, area) -> Tuple[float,float,float]:
+        """
+        find the library drop whose silhouette is most similar to the measured one
+
+        :param height: drop height in px
+        :param radius: base radius in px
+        :param width: max half width in px
+        :param area: silhouette area in px^2
+        :raises ContourError: if the measurements do not describe a drop
+        :returns: tuple of (beta, contact_angle, R0), angle in rad and apex radius in px
+        """
+        i_beta, i_angle = self._nearest(height, radius, width, area)
+        r0 = height / self.lib['height'][i_beta, i_angle]
+        return self.betas[i_beta], self.angles[i_angle], r0
+
+    def _nearest(self, height, radius, width, area) -> Tuple[int,int]:
+        """ indices of bond number and angle of the nearest library drop in descriptor space """
+        if height <= 0 or radius <= 0 or width <= 0:
+            raise ContourError('Degenerate drop silhouette')
+        desc = np.array((2*np.arctan2(height, radius), area/(2*width*height)))*self._desc_scale
+        dist = np.square(self._desc[0] - desc[0]) + np.square(self._desc[1] - desc[1])
+        return np.unravel_index(np.argmin(dist), (len(self.betas), len(self.angles)))
+
+    def initial_params(self, points, y_base) -> np.ndarray:
+        """
+        start parameters for :meth:`young_laplace.YoungLaplaceFit.fit` from the library drop closest to the points
+
+        :param points: N x 2 array of (x,y) edge points
+        :param y_base: y coordinate of the baseline
+        :returns: array of (x_a, y_a, R0, beta)
+        """
+        x_center, height, radius, width, area = measure_shape(points, y_base)
+        beta, _, r0 = self.lookup(height, radius, width, area)
+        return np.array((x_center, y_base - height, r0, beta))
+
+
+_libraries = {}
+
+def load_library(path=LIBRARY_FILE) -> ProfileLibrary:
+    """ return the library stored at path, it is only loaded once per path, building it can take minutes """
+    with _library_lock:
+        if path not in _libraries:
+            _libraries[path] = ProfileLibrary.load(path)
+        return _libraries[path]
+
+
+@register_backend('fit', 'young_laplace_lookup')
+def fit_young_laplace_lookup(data: FrameData, pipeline: EvaluationPipeline):
+    """
+    young laplace fit started from the library drop whose silhouette matches the contour best
+
+    the silhouette alone does not pin down the contact angle, especially above 90 deg, so the library drop is refined
+    with a few gauss newton iterations on the interpolated library profiles; unlike the `young_laplace` backend every
+    frame is fitted from scratch, the runtime does not depend on the previous frame
+
+    uses the library in pipeline option `yl_library`, see :func:`load_library`; it is not loaded here, as building it
+    would block the evaluation for minutes
+
+    :raises ContourError: if the option `yl_library` is not set yet
+    """
+    library: ProfileLibrary = pipeline.options.get('yl_library')
+    if library is None:
+        raise ContourError('Profile library not loaded yet')
+    points = data.points if data.points is not None else data.contour.reshape(-1,2).astype(np.float64)
+    points = points[points[:,1] < data.y_base - 1]
+    fitter = YoungLaplaceFit(library)
+    try:
+        params = fitter.fit(points, data.y_base, library.initial_params(points, data.y_base), max_iter=LIBRARY_REFINE_ITER)
+        angle, x_int_l, x_int_r, area, height, volume, cap_length = fitter.evaluate(params, data.y_base)
+    except (ContourError, np.linalg.LinAlgError):
+        raise ContourError('Young laplace lookup failed')
+    slope = tan(angle)
+    data.tangents = ((x_int_l, -slope), (x_int_r, slope))
+    data.extra.update(area=area, height=height, volume=volume, cap_length=cap_length,
+                      apex=(params[0], params[1]), apex_radius=params[2], bond=params[3], fit_rms=fitter.rms)
@@ -0,0 +1,136 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Droplet outline from horizontal and vertical scanlines
+
+# A backlit droplet is a dark region on bright background, often with a bright spot in its center. Every row from the
+# baseline up to the apex is scanned for its outermost dark pixels, the apex is reached where a row has no dark pixels
+# or they do not overlap the ones of the row below anymore. Every column of the droplet is scanned from the apex down
+# for the top edge. The edges are refined to sub-pixel precision with a parabola through the intensity differences
+# around them. Row edges are kept where the outline is steep, column edges where it is flat, which gives an ordered
+# profile from the left over the apex to the right contact point.
+
+from typing import Tuple
+import cv2
+import numpy as np
+
+from eval_pipeline import ContourError
+
+SCANLINE_MIN_CONTRAST = 30
+""" default for pipeline option `scanline_min_contrast`: min difference in gray values between droplet and background """
+# margin in px around the needle mask in which edges belong to the needle
+SCANLINE_MASK_MARGIN = 1
+
+
+def _refine(img, lines, pos, sign, vertical=False) -> np.ndarray:
+    """
+    sub-pixel position of edges between the pixels pos and pos + 1 along scanlines
+
+    :param img: grayscale image
+    :param lines: array of row indices of horizontal scanlines or column indices of vertical ones
+    :param pos: array of pixel positions along the scanlines
+    :param sign: 1 for dark to bright edges, -1 for bright to dark
+    :param vertical: True if the scanlines are columns
+    :returns: edge positions along the scanlines
+    """
+    last = img.shape[0 if vertical else 1] - 1
+    # the 4 pixels around the edge, the differences between them are located at pos - 0.5, pos + 0.5 and pos + 1.5
+    idx = np.clip(pos[:,None] + np.arange(-1, 3), 0, last)
+    vals = (img[idx, lines[:,None]] if vertical else img[lines[:,None], idx]).astype(np.float32)
+    g_0, g_1, g_2 = (sign*np.diff(vals, axis=1)).T
+    denom = g_0 - 2*g_1 + g_2
+    offset = np.divide(0.5*(g_0 - g_2), denom, out=np.zeros(len(pos), dtype=np.float32), where=denom < 0)
+    np.clip(offset, -1.0, 1.0, out=offset)
+    return pos + 0.5 + offset
+
+def _in_mask(x, y, mask) -> np.ndarray:
+    """ whether the points lie within the needle mask and its margin """
+    if mask is None:
+        return np.zeros(len(x), dtype=bool)
+    mx, my, mw, mh = mask
+    m = SCANLINE_MASK_MARGIN
+    return (x >= mx - m) & (x <= mx + mw + m) & (y >= my - m) & (y <= my + mh + m)
+
+def scan_profile(img, mask=None, min_contrast=SCANLINE_MIN_CONTRAST) -> Tuple[np.ndarray,bool]:
+    """
+    find the droplet outline with scanlines
+
+    edges within the needle mask are ignored, so a needle in the droplet only hides part of the outline
+    instead of splitting it
+
+    :param img: grayscale region above the baseline, its last row lies directly above the baseline
+    :param mask: needle mask as (x,y,w,h) in coordinates of the region or None
+    :param min_contrast: min difference in gray values between droplet and background on the last row
+    :raises ContourError: if there is no droplet on the last row
+    :returns: tuple of (points, clipped): N x 2 float array of (x,y) edge points in coordinates of the region,
+        ordered from the left contact point over the apex to the right one; clipped is True if the droplet
+        reaches the border of the region
+    """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    height, width = img.shape
+    if height < 3 or width < 3:
+        raise ContourError('Region too small for scanline detection')
+    bottom = img[-1]
+    lo, hi = int(bottom.min()), int(bottom.max())
+    if hi - lo < min_contrast:
+        raise ContourError('No droplet found on baseline')
+    # 1 for dark pixels, flipped and transposed with opencv so the searches below run along contiguous rows
+    dark = cv2.threshold(img, (lo + hi)/2, 1, cv2.THRESH_BINARY_INV)[1].view(bool)
+    # outermost dark pixels of every row
+    first = np.argmax(dark, axis=1)
+    last = width - 1 - np.argmax(cv2.flip(dark.view(np.uint8), 1).view(bool), axis=1)
+    any_dark = dark[np.arange(height), first]
+    # follow the droplet up while the dark pixels of a row overlap the ones below
+    connected = any_dark[:-1] & (first[:-1] <= last[1:]) & (last[:-1] >= first[1:])
+    gaps = np.flatnonzero(~connected)
+    top = int(gaps[-1]) + 1 if len(gaps) > 0 else 0
+
+    # horizontal scanlines, edge between first - 1 and first and between last and last + 1
+    x_first, x_last = first[top:], last[top:]
+    inside_l, inside_r = x_first > 0, x_last < width - 1
+    rows = np.arange(top, height)
+    x_l = _refine(img, rows, x_first - 1, -1)
+    x_r = _refine(img, rows, x_last, 1)
+    # runs reaching the border end there
+    needle_l = _in_mask(np.where(inside_l, x_l, 0), rows, mask)
+    needle_r = _in_mask(np.where(inside_r, x_r, width - 1), rows, mask)
+    clipped = bool(np.any(~inside_l & ~needle_l) or np.any(~inside_r & ~needle_r))
+    # keep where the outline is steep, changes less than a pixel from row to row
+    steep_l = np.abs(np.gradient(x_l)) <= 1 if len(x_l) > 1 else np.ones(len(x_l), dtype=bool)
+    steep_r = np.abs(np.gradient(x_r)) <= 1 if len(x_r) > 1 else np.ones(len(x_r), dtype=bool)
+    keep_l = inside_l & ~needle_l & steep_l
+    keep_r = inside_r & ~needle_r & steep_r
+
+    # vertical scanlines from the apex down through all columns of the droplet, edge between t - 1 and t
+    col_l, col_r = int(x_first.min()), int(x_last.max()) + 1
+    cols = cv2.transpose(dark[top:, col_l:col_r].view(np.uint8)).view(bool)
+    t = top + np.argmax(cols, axis=1)
+    # the droplet reaches the top of the region, except the needle covers it
+    inside_t = t > 0
+    x_cols = np.arange(col_l, col_r)
+    y_t = _refine(img, x_cols, t - 1, -1, vertical=True)
+    needle_t = _in_mask(x_cols, np.where(inside_t, y_t, 0), mask)
+    clipped |= bool(np.any(~inside_t & ~needle_t))
+    flat_t = np.abs(np.gradient(y_t)) < 1 if len(y_t) > 1 else np.ones(len(y_t), dtype=bool)
+    keep_t = inside_t & ~needle_t & flat_t
+
+    points = np.concatenate((
+        np.column_stack((x_l[keep_l], rows[keep_l]))[::-1],
+        np.column_stack((x_cols[keep_t], y_t[keep_t])),
+        np.column_stack((x_r[keep_r], rows[keep_r])),
+    )).astype(np.float64)
+    return points, clipped
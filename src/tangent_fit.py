@@ -0,0 +1,152 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Local polynomial fit of the droplet contour at the contact points
+#
+# On synthetic Young-Laplace drops of 20-150 deg the angles are within about 2 deg. The fit only sees the outline
+# close to the contact point, so on real images highlights and the blurred droplet corner at the substrate change
+# the angle, it can differ from the ellipse and Young-Laplace fits by tens of degrees there.
+
+from math import inf
+from typing import Tuple
+import numpy as np
+
+from eval_pipeline import ContourError
+
+TANGENT_FIT_DISTANCE = 20
+""" default for pipeline option `tangent_fit_distance`: radius in px around the contact point of the contour points used for the fit """
+TANGENT_FIT_ORDER = 2
+""" default for pipeline option `tangent_fit_order`: order of the polynomial """
+TANGENT_FIT_SUBPIXEL = True
+""" default for pipeline option `tangent_fit_subpixel`: refine the fitted points to sub-pixel precision """
+TANGENT_FIT_MARGIN = 2
+""" default for pipeline option `tangent_fit_margin`: height in px above the baseline whose points are not fitted """
+# max jump in px of the outermost point between two rows, the contour is following the substrate edge beyond it
+TANGENT_MAX_ROW_JUMP = 8
+# max height in px of the gap between the outline and the margin, the polynomial is not extrapolated further
+TANGENT_MAX_GAP = 5
+# min distance in px of a point to the first polynomial to be left out of the second fit
+TANGENT_OUTLIER_DISTANCE = 1.0
+
+
+def split_sides(points, y_base) -> Tuple[np.ndarray,np.ndarray]:
+    """
+    split the contour points above the baseline into the left and right half of the droplet
+
+    :param points: N x 2 array of (x,y) contour points
+    :param y_base: y coordinate of the baseline
+    :returns: tuple of (left, right) point arrays
+    """
+    points = points[points[:,1] < y_base]
+    if len(points) == 0:
+        raise ContourError('No contour points above baseline')
+    x_mid = (points[:,0].min() + points[:,0].max())/2
+    return points[points[:,0] < x_mid], points[points[:,0] >= x_mid]
+
+def _outline(points, left) -> Tuple[np.ndarray,np.ndarray]:
+    """
+    points of the droplet outline on one side without the substrate edge
+
+    where the contour leaves the droplet and runs along the substrate edge, it sticks out of the outline;
+    the outline above the lowest :data:`TANGENT_MAX_GAP` rows is continued downwards with the median step between its rows,
+    points in these rows further out than :data:`TANGENT_MAX_ROW_JUMP` or three times the step from it are removed
+
+    :param points: N x 2 array of (x,y) contour points of one side of the droplet
+    :param left: True if the points belong to the left side of the droplet
+    :returns: tuple of (points, end): the points of the outline and its outermost lowest point
+    """
+    sign = -1 if left else 1
+    outward = sign*points[:,0]
+    rows = np.round(points[:,1]).astype(np.intp)
+    top = rows.min()
+    outer = np.full(rows.max() - top + 1, -np.inf)
+    np.maximum.at(outer, rows - top, outward)
+    found = np.flatnonzero(np.isfinite(outer))
+    # the substrate edge can only stick out in the lowest rows, the rows above give the normal step between rows
+    steps = np.diff(outer[found])
+    band = max(len(steps) - TANGENT_MAX_GAP, 0)
+    step = np.median(steps[:band]) if band > 0 else 0.0
+    # outline continued with the step from the first row of the band
+    limit = outer[found[band]] + step*(rows - top - found[band]) + min(TANGENT_MAX_ROW_JUMP, 3*max(abs(step), 1.0))
+    keep = (rows - top <= found[band]) | (outward <= limit)
+    points, outward, rows = points[keep], outward[keep], rows[keep]
+    lowest = np.flatnonzero(rows == rows.max())
+    return points, points[lowest[np.argmax(outward[lowest])]]
+
+def _fit_window(points, center, distance, order, y_base) -> Tuple[float,float]:
+    """ fit the polynomial to the points within distance of center, returns (x_int, slope) at the baseline """
+    rel = points - center
+    dist = np.hypot(rel[:,0], rel[:,1])
+    selected = dist <= distance
+    if np.count_nonzero(selected) <= order + 1:
+        raise ContourError('Not enough contour points for tangent fit')
+    rel = rel[selected]
+    dist = dist[selected]
+    # local coordinates u along the chord to the farthest point, v normal to it
+    chord = rel[np.argmax(dist)] / dist.max()
+    normal = np.array((-chord[1], chord[0]))
+    u = rel @ chord
+    v = rel @ normal
+    poly = np.linalg.lstsq(np.vander(u, order + 1), v, rcond=None)[0]
+    # refit without points off the polynomial, eg. reflections on the droplet edge
+    dev = np.abs(v - np.polyval(poly, u))
+    inliers = dev <= max(TANGENT_OUTLIER_DISTANCE, 3*np.median(dev))
+    if not inliers.all() and np.count_nonzero(inliers) > order + 1:
+        poly = np.linalg.lstsq(np.vander(u[inliers], order + 1), v[inliers], rcond=None)[0]
+    # image y along the polynomial: center_y + u*chord_y + p(u)*normal_y = y_base
+    y_poly = np.polyadd(poly*normal[1], (chord[1], center[1] - y_base))
+    roots = np.roots(y_poly)
+    roots = roots[np.abs(roots.imag) < 1e-9].real
+    if len(roots) == 0:
+        raise ContourError('Tangent fit does not reach baseline')
+    u_int = roots[np.argmin(np.abs(roots))]
+    x_int = center[0] + u_int*chord[0] + np.polyval(poly, u_int)*normal[0]
+    # tangent direction at the intersection
+    dv = np.polyval(np.polyder(poly), u_int)
+    t_x = chord[0] + dv*normal[0]
+    t_y = chord[1] + dv*normal[1]
+    slope = t_y/t_x if t_x != 0 else inf
+    return float(x_int), float(slope)
+
+def fit_contact_tangent(points, y_base, left, distance=TANGENT_FIT_DISTANCE, order=TANGENT_FIT_ORDER,
+                        margin=TANGENT_FIT_MARGIN) -> Tuple[float,float]:
+    """
+    fit a polynomial to the contour points of one side of the droplet close to the baseline
+    and return its intersection with the baseline and its slope there
+
+    the polynomial is fitted in a coordinate system rotated along the chord through the selected points,
+    so steep and flat contours are handled the same way; the points are selected around the lowest point of
+    the outline first and around the contact point of this fit in a second pass
+
+    :param points: N x 2 array of (x,y) contour points of one side of the droplet above the baseline
+    :param y_base: y coordinate of the baseline
+    :param left: True if the points belong to the left side of the droplet
+    :param distance: only points within this distance in px of the contact point are used
+    :param order: order of the polynomial
+    :param margin: points less than this height in px above the baseline are not used,
+        they belong to the blurred substrate edge or the reflection of the droplet
+    :raises ContourError: if there are not enough points or the polynomial does not reach the baseline
+    :returns: tuple of (x_int, slope), slope as dy/dx in image coordinates
+    """
+    points = points[points[:,1] <= y_base - margin]
+    if len(points) <= order + 1:
+        raise ContourError('Not enough contour points for tangent fit')
+    points, end = _outline(points, left)
+    if end[1] < y_base - margin - TANGENT_MAX_GAP:
+        raise ContourError('Contour does not reach the baseline for tangent fit')
+    x_int, slope = _fit_window(points, end, distance, order, y_base)
+    # the points in the margin are missing from the window around the contact point
+    return _fit_window(points, np.array((x_int, y_base)), distance + margin, order, y_base)
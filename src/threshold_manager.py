@@ -0,0 +1,109 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Canny threshold caching
+
+from typing import Tuple
+import cv2
+import numpy as np
+
+# ratio between low and high canny threshold
+LOW_THRESH_RATIO = 0.5
+# subsampling step for the drift check, only every n-th row and column is looked at
+DRIFT_SUBSAMPLE = 8
+# number of histogram bins for the drift check
+DRIFT_HIST_BINS = 16
+# max change of mean intensity in gray values before thresholds are recomputed
+DRIFT_MEAN_TOLERANCE = 8.0
+# max bhattacharyya distance between histograms before thresholds are recomputed
+DRIFT_HIST_TOLERANCE = 0.1
+
+
+def calc_otsu_thresholds(img, high_factor=1.0, low_ratio=LOW_THRESH_RATIO) -> Tuple[float,float]:
+    """
+    calculate the canny thresholds from the otsu threshold of the image
+
+    values only for 8bit images!
+
+    :param img: grayscale image or image region as np.ndarray
+    :param high_factor: factor between otsu threshold and high threshold
+    :param low_ratio: ratio between low and high threshold
+    :returns: tuple of (low, high) threshold
+    """
+    thresh_high, _ = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    thresh_high *= high_factor
+    return low_ratio*thresh_high, thresh_high
+
+
+class ThresholdManager:
+    """
+    caches the canny thresholds between frames
+
+    the otsu threshold is only recomputed if a cheap check on a subsampled image detects a change in lighting,
+    either by a shift of the mean intensity or by a change of the intensity histogram
+
+    :param mean_tolerance: max change of the mean intensity in gray values
+    :param hist_tolerance: max bhattacharyya distance between the histograms
+    """
+    def __init__(self, mean_tolerance=DRIFT_MEAN_TOLERANCE, hist_tolerance=DRIFT_HIST_TOLERANCE):
+        self.mean_tolerance = mean_tolerance
+        self.hist_tolerance = hist_tolerance
+        self.high_factor = 1.0
+        """ factor between otsu threshold and high threshold, see :meth:`set_profile` """
+        self.low_ratio = LOW_THRESH_RATIO
+        """ ratio between low and high threshold, see :meth:`set_profile` """
+        self.thresholds: Tuple[float,float] = None
+        self._ref_mean: float = 0.0
+        self._ref_hist: np.ndarray = None
+
+    def invalidate(self):
+        """ discard the cached thresholds, they will be recomputed on next call """
+        self.thresholds = None
+        self._ref_hist = None
+
+    def set_profile(self, high_factor, low_ratio):
+        """
+        set how the thresholds are derived from the otsu threshold, eg. from :func:`canny_tuning.tune_canny`
+
+        :param high_factor: factor between otsu threshold and high threshold
+        :param low_ratio: ratio between low and high threshold
+        """
+        self.high_factor = high_factor
+        self.low_ratio = low_ratio
+        self.invalidate()
+
+    def get_thresholds(self, img) -> Tuple[float,float]:
+        """
+        return the canny thresholds for the image, recompute them if lighting has drifted
+
+        :param img: the evaluated image region as np.ndarray
+        :returns: tuple of (low, high) threshold
+        """
+        sample = np.ascontiguousarray(img[::DRIFT_SUBSAMPLE, ::DRIFT_SUBSAMPLE])
+        mean = float(np.mean(sample))
+        hist = cv2.calcHist([sample], [0], None, [DRIFT_HIST_BINS], [0, 256])
+        cv2.normalize(hist, hist, 1.0, 0.0, cv2.NORM_L1)
+        if self.thresholds is None or self._has_drifted(mean, hist):
+            self.thresholds = calc_otsu_thresholds(img, self.high_factor, self.low_ratio)
+            self._ref_mean = mean
+            self._ref_hist = hist
+        return self.thresholds
+
+    def _has_drifted(self, mean, hist) -> bool:
+        """ compare current image statistics with the ones at the time of the last threshold calculation """
+        if abs(mean - self._ref_mean) > self.mean_tolerance:
+            return True
+        return cv2.compareHist(self._ref_hist, hist, cv2.HISTCMP_BHATTACHARYYA) > self.hist_tolerance
@@ -0,0 +1,271 @@
+#     MAEsure is a program to measure the surface energy of MAEs via contact angle
+#     Copyright (C) 2021  Raphael Kriegl
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Axisymmetric drop shape analysis (ADSA) for sessile drops
+
+# The drop profile is described in coordinates relative to the apex, made dimensionless by the apex radius R0:
+#   dx/ds = cos(psi), dz/ds = sin(psi), dpsi/ds = 2 + beta*z - sin(psi)/x
+# with the arc length s, the tangent angle psi, z pointing from the apex down to the substrate
+# and the bond number beta = delta_rho*g*R0^2/gamma. The contact angle is psi at the substrate.
+
+from math import sqrt, tan, inf
+from typing import Tuple
+import cv2
+import numpy as np
+
+from eval_pipeline import ContourError, EvaluationPipeline, FrameData, register_backend
+
+# arc length step of the profile integration (dimensionless)
+YL_STEP = 0.02
+# max arc length of the profile integration (dimensionless)
+YL_MAX_ARC = 8.0
+# relative step to calculate the derivative of the profile with respect to beta
+YL_BETA_DELTA = 1e-3
+# allowed range of the bond number
+YL_BETA_RANGE = (0.0, 50.0)
+# initial bond number if no previous fit is available
+YL_BETA_INIT = 0.2
+# max gauss newton iterations for a new fit and when starting from the last result
+YL_MAX_ITER_COLD = 30
+YL_MAX_ITER_WARM = 5
+# stop iterating if the parameter update is below this value in px
+YL_TOLERANCE = 1e-3
+
+
+def integrate_profile(beta, z_max=inf, ds=YL_STEP, s_max=YL_MAX_ARC):
+    """
+    integrate the dimensionless sessile drop profile with a fixed step runge kutta scheme
+
+    the integration is vectorized over several bond numbers, so profiles for derivatives or a whole library
+    are calculated in one pass; it stops when all profiles passed z_max or psi reached 180 deg
+
+    :param beta: bond number or array of k bond numbers
+    :param z_max: depth below the apex at which the integration can stop
+    :param ds: arc length step
+    :param s_max: max arc length
+    :returns: tuple of arrays (x, z, psi, vol), each n x k, vol is the enclosed volume pi*int(x^2 dz) from the apex
+    """
+    beta = np.atleast_1d(np.asarray(beta, dtype=np.float64))
+    state = np.zeros((4, len(beta)))
+    steps = [state]
+    def deriv(st):
+        x, z, psi, _ = st
+        sin_psi = np.sin(psi)
+        # limit sin(psi)/x -> 1 at the apex
+        curv = np.divide(sin_psi, x, out=np.ones_like(x), where=x > 1e-12)
+        return np.array((np.cos(psi), sin_psi, 2 + beta*z - curv, np.pi*x*x*sin_psi))
+    for _ in range(int(s_max / ds)):
+        k1 = deriv(state)
+        k2 = deriv(state + 0.5*ds*k1)
+        k3 = deriv(state + 0.5*ds*k2)
+        k4 = deriv(state + ds*k3)
+        state = state + ds/6*(k1 + 2*k2 + 2*k3 + k4)
+        steps.append(state)
+        if np.all((state[1] >= z_max) | (state[2] >= np.pi)):
+            break
+    profile = np.array(steps)
+    return profile[:,0], profile[:,1], profile[:,2], profile[:,3]
+
+def interp_at_depth(z, values, z_c):
+    """
+    interpolate profile values at depth z_c, z has to be increasing
+
+    :raises ContourError: if the profile does not reach z_c
+    """
+    if z[-1] < z_c:
+        raise ContourError('Drop profile does not reach baseline')
+    return np.interp(z_c, z, values)
+
+
+class YoungLaplaceFit:
+    """
+    fits the young laplace profile of a sessile drop to edge points with gauss newton iterations
+
+    parameters are the apex position (x_a, y_a) in px, the apex radius R0 in px and the bond number beta;
+    the parameters of the last successful fit are used as start values for the next one
+
+    the distance of each point to the profile is measured along the normal of the nearest profile sample
+
+    :param library: optional :class:`profile_library.ProfileLibrary` to interpolate the profiles from instead of integrating them
+    """
+    def __init__(self, library=None):
+        self.library = library
+        self.params: np.ndarray = None
+        self.iterations = 0
+        self.rms = 0.0
+
+    def reset(self):
+        """ forget the last fit, next fit will start from an estimate """
+        self.params = None
+
+    def initial_guess(self, points, y_base) -> np.ndarray:
+        """
+        estimate start parameters from the points, apex radius from an ellipse fit
+
+        :param points: N x 2 array of (x,y) edge points
+        :param y_base: y coordinate of the baseline
+        """
+        (x0, y0), (w, h), angle = cv2.fitEllipse(points.astype(np.float32))
+        # semi axes in x and y direction, ignoring tilt
+        if 45 < angle < 135:
+            w, h = h, w
+        a, b = w/2, h/2
+        y_apex = points[:,1].min()
+        x_apex = points[np.argmin(points[:,1]), 0] if b == 0 else x0
+        r0 = a*a/b if b > 0 else a
+        return np.array((x_apex, y_apex, r0, YL_BETA_INIT))
+
+    def fit(self, points, y_base, params=None, max_iter=None) -> np.ndarray:
+        """
+        fit the profile to the points
+
+        :param points: N x 2 array of (x,y) edge points above the baseline
+        :param y_base: y coordinate of the baseline
+        :param params: optional start parameters (x_a, y_a, R0, beta), defaults to last result or estimate
+        :param max_iter: max iterations, defaults to :data:`YL_MAX_ITER_WARM` when starting from the last result, else :data:`YL_MAX_ITER_COLD`
+        :raises ContourError: if the fit does not converge
+        :returns: fitted parameters (x_a, y_a, R0, beta)
+        """
+        if len(points) < 5:
+            raise ContourError('Not enough points for young laplace fit')
+        warm = params is None and self.params is not None
+        if params is None:
+            params = self.params if self.params is not None else self.initial_guess(points, y_base)
+        params = np.array(params, dtype=np.float64)
+        if max_iter is None:
+            max_iter = YL_MAX_ITER_WARM if warm else YL_MAX_ITER_COLD
+        damping = 1e-3
+        res, jac = self._residuals(points, params, y_base)
+        cost = res @ res
+        for self.iterations in range(1, max_iter + 1):
+            jtj = jac.T @ jac
+            step = np.linalg.solve(jtj + damping*np.diag(np.diag(jtj) + 1e-9), -jac.T @ res)
+            new_params = params + step
+            new_params[2] = max(new_params[2], 1.0)
+            new_params[3] = np.clip(new_params[3], *YL_BETA_RANGE)
+            new_res, new_jac = self._residuals(points, new_params, y_base)
+            new_cost = new_res @ new_res
+            if new_cost < cost:
+                params, res, jac, cost = new_params, new_res, new_jac, new_cost
+                damping = max(damping/10, 1e-7)
+                if np.max(np.abs(step[:3])) < YL_TOLERANCE:
+                    break
+            else:
+                damping *= 10
+                if damping > 1e6:
+                    break
+        if not np.all(np.isfinite(params)):
+            raise ContourError('Young laplace fit diverged')
+        self.params = params
+        self.rms = sqrt(cost / len(points))
+        return params
+
+    def _residuals(self, points, params, y_base):
+        """ signed normal distances of the points to the profile and their jacobian with respect to the parameters """
+        x_a, y_a, r0, beta = params
+        d_beta = YL_BETA_DELTA*max(beta, 1.0)
+        z_max = (points[:,1].max() - y_a)/r0 + 2*YL_STEP
+        x, z, psi, _ = self.profiles((beta, beta + d_beta), z_max)
+        sigma = np.where(points[:,0] >= x_a, 1.0, -1.0)
+        u = np.abs(points[:,0] - x_a)/r0
+        w = (points[:,1] - y_a)/r0
+        # nearest profile sample for each point
+        dist = (u[:,None] - x[None,:,0])**2 + (w[:,None] - z[None,:,0])**2
+        idx = np.argmin(dist, axis=1)
+        px, pz, ppsi = x[idx,0], z[idx,0], psi[idx,0]
+        sin_psi, cos_psi = np.sin(ppsi), np.cos(ppsi)
+        # distance along the normal (sin psi, -cos psi) in dimensionless coordinates
+        res = r0*((u - px)*sin_psi - (w - pz)*cos_psi)
+        jac = np.empty((len(points), 4))
+        jac[:,0] = -sigma*sin_psi
+        jac[:,1] = cos_psi
+        jac[:,2] = -(px*sin_psi - pz*cos_psi)
+        dx = (x[idx,1] - px)/d_beta
+        dz = (z[idx,1] - pz)/d_beta
+        jac[:,3] = -r0*(dx*sin_psi - dz*cos_psi)
+        return res, jac
+
+    def profiles(self, beta, z_max=inf):
+        """ profiles for the bond numbers from the library if set, else integrated, see :func:`integrate_profile` """
+        if self.library is not None:
+            return self.library.profiles(beta, z_max)
+        return integrate_profile(beta, z_max)
+
+    def evaluate(self, params, y_base):
+        """
+        calculate the drop properties at the baseline from the fitted parameters
+
+        :param params: fitted parameters (x_a, y_a, R0, beta)
+        :param y_base: y coordinate of the baseline
+        :raises ContourError: if the profile does not reach the baseline
+        :returns: tuple of (contact_angle, x_int_l, x_int_r, area, height, volume, cap_length), angle in rad, lengths in px
+        """
+        x_a, y_a, r0, beta = params
+        height = y_base - y_a
+        if height <= 0:
+            raise ContourError('Apex below baseline')
+        z_c = height / r0
+        x, z, psi, vol = self.profiles(beta, z_c + YL_STEP)
+        x, z, psi, vol = x[:,0], z[:,0], psi[:,0], vol[:,0]
+        # profile only single valued in z up to 180 deg
+        valid = psi < np.pi
+        x, z, psi, vol = x[valid], z[valid], psi[valid], vol[valid]
+        angle = interp_at_depth(z, psi, z_c)
+        radius = interp_at_depth(z, x, z_c)*r0
+        volume = interp_at_depth(z, vol, z_c)*r0**3
+        # silhouette area 2*int(x dz)
+        below = z <= z_c
+        zs = np.append(z[below], z_c)
+        xs = np.append(x[below], radius/r0)
+        area = 2*np.trapz(xs, zs)*r0**2
+        cap_length = r0/sqrt(beta) if beta > 0 else inf
+        return angle, x_a - radius, x_a + radius, area, height, volume, cap_length
+
+
+@register_backend('fit', 'young_laplace')
+class YoungLaplaceBackend:
+    """
+    pipeline fit backend: axisymmetric drop shape analysis of a sessile drop
+
+    fits the young laplace profile to the contour points above the baseline, warm started from the previous frame;
+    sets the contact points and tangents as well as area, height, volume and capillary length in px
+
+    if the pipeline option `yl_library` holds a :class:`profile_library.ProfileLibrary`, the profiles are taken from it
+    and the first fit is started from the library drop most similar to the contour
+    """
+    def __init__(self):
+        self.fitter = YoungLaplaceFit()
+
+    def reset(self):
+        self.fitter.reset()
+
+    def __call__(self, data: FrameData, pipeline: EvaluationPipeline):
+        points = data.points if data.points is not None else data.contour.reshape(-1,2).astype(np.float64)
+        points = points[points[:,1] < data.y_base - 1]
+        self.fitter.library = pipeline.options.get('yl_library')
+        try:
+            seed = None
+            if self.fitter.params is None and self.fitter.library is not None:
+                seed = self.fitter.library.initial_params(points, data.y_base)
+            params = self.fitter.fit(points, data.y_base, seed)
+            angle, x_int_l, x_int_r, area, height, volume, cap_length = self.fitter.evaluate(params, data.y_base)
+        except (ContourError, np.linalg.LinAlgError):
+            self.fitter.reset()
+            raise ContourError('Young laplace fit failed')
+        slope = tan(angle)
+        data.tangents = ((x_int_l, -slope), (x_int_r, slope))
+        data.extra.update(area=area, height=height, volume=volume, cap_length=cap_length,
+                          apex=(params[0], params[1]), apex_radius=params[2], bond=params[3], fit_rms=self.fitter.rms)
@@ -0,0 +1,20 @@
+import os
+import cv2
+
+from evaluate_droplet import evaluate_droplet_result
+from eval_pipeline import EvaluationPipeline
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'untitled1.png')
+# the detected baseline keeps a few rows of the blurred droplet foot out of the crop, the manual one does not
+MAX_ANGLE_DIFFERENCE = 6.0
+
+
+def test_auto_baseline_matches_manual():
+    img = cv2.imread(IMAGE, cv2.IMREAD_GRAYSCALE)
+    pipeline = EvaluationPipeline(auto_baseline=True)
+    for _ in range(3):
+        auto = evaluate_droplet_result(img, 250, None, pipeline)
+        assert 280 <= auto.base_y <= 285
+        manual = evaluate_droplet_result(img, int(round(auto.base_y)), None, EvaluationPipeline())
+        assert abs(auto.angle_l - manual.angle_l) < MAX_ANGLE_DIFFERENCE
+        assert abs(auto.angle_r - manual.angle_r) < MAX_ANGLE_DIFFERENCE